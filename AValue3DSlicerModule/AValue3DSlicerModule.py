@@ -1,4 +1,5 @@
 import os
+import sys
 import inspect
 import unittest
 import vtk, qt, ctk, slicer
@@ -7,6 +8,81 @@ import logging
 import urllib
 import math
 import time
+import csv
+import json
+import shutil
+import tempfile
+import subprocess
+import collections
+import contextlib
+import hashlib
+import glob
+import re
+import Queue
+import threading
+import numpy as np
+from vtk.util.numpy_support import vtk_to_numpy, numpy_to_vtk
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+try:
+	import OtolaryngologyLib
+except ImportError: #Source tree, the shared package is only installed next to the modules by the build
+	sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))), 'OtolaryngologyLib'))
+from OtolaryngologyLib import (	LandmarkSet, fiducialArray, matchLandmarks, setTransformMatrix, fitLandmarkTransform,
+								readNRRDRegion, writeNRRD, CDL_ESTIMATORS, registerCDLEstimator, computeAValues,
+								cohortStatistics, readCohortPositions )
+from OtolaryngologyLib.regions import (	TIGHT_ROI, otsuThreshold, maskBoundingBox, fitROIToForeground, voxelCropRange,
+										extractVoxelRange )
+from OtolaryngologyLib.tracing import StageTrace
+
+#Folder holding the atlas, landmark & A-value data (data must be in the same folder as the .py script)
+MODULE_DIR = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+
+#Atlas volume, A-value fiducials & registration landmarks for each side (isRight)
+ATLAS_FILES = {	True	: ('initialAtlasR.nrrd', 'Atlas_AValue_F.fcsv', 'initialLandmarkREG_R.fcsv'),
+				False	: ('initialAtlasL.nrrd', 'Atlas_AValue_MF.fcsv', 'initialLandmarkREG_L.fcsv') }
+
+#Coarse-to-fine levels of the multi-resolution registration mode. shrinkFactor is
+#the voxel averaging factor, other keys override the BRAINSFit parameters per level
+REGISTRATION_PYRAMID = [	{'shrinkFactor': 4, 'numberOfIterations': 1500, 'samplingPercentage': 1},
+							{'shrinkFactor': 2, 'numberOfIterations': 1000, 'samplingPercentage': 0.5},
+							{'shrinkFactor': 1, 'numberOfIterations': 500, 'samplingPercentage': 0.2} ]
+
+#Preview registration of run: volumes averaged down by shrinkFactor, other keys override the
+#BRAINSFit parameters of both registrations (see REGISTRATION_PYRAMID)
+REGISTRATION_PREVIEW = {'shrinkFactor': 4, 'numberOfIterations': 300, 'samplingPercentage': 0.2}
+
+#Adaptive stopping mode of the registrations in run: BRAINSFit runs in checkpointed chunks of
+#chunkIterations (up to the fixed iteration budget) and stops once the metric improved less than
+#metricTolerance (relative, first to last metric of one chunk) in each of the last window chunks, or
+#once the A-value fiducials moved less than motionThreshold (fraction of the smallest fixed voxel
+#spacing) between two checkpoints
+ADAPTIVE_STOPPING = {'chunkIterations': 300, 'window': 2, 'metricTolerance': 0.001, 'motionThreshold': 0.25}
+
+#Fusion methods of the multi-atlas mode (see fuseAtlasPositions)
+ATLAS_FUSION_METHODS = ['median', 'weighted']
+
+#Landmark files expected for every batch manifest row, in the order they are placed in the widget
+BATCH_LANDMARK_COLUMNS = ['OW', 'CN', 'A', 'RW']
+
+#Description prefixes (lower case, no spaces) naming each landmark column in the atlas landmark files
+LANDMARK_DESCRIPTIONS = {'OW': 'ovalwindow', 'CN': 'cochle', 'A': 'apex', 'RW': 'roundwindow'}
+
+#Columns of the batch result file, one row per case
+BATCH_RESULT_FIELDS = [	'caseID', 'status', 'aValue', 'cdlAlexiadesOC', 'cdlKochOC', 'cdlKochLW',
+						'roundWindow', 'lateralWall', 'numberOfAtlases', 'aValueSpread', 'affineIterations', 'affineStopReason',
+						'bsplineIterations', 'bsplineStopReason', 'elapsedTime', 'imageMemoryMB',
+						'peakRSSMB', 'childPeakRSSMB', 'imageAllocatedMB', 'fullCopies',
+						'threads', 'cpuUtilization', 'error' ]
+
+#Stages of the batch pipeline (see PipelineScheduler), run by the logic method of the same name.
+#'worker' stages run in threads and must not touch the scene, concurrency is the number of cases
+#a stage works on at once and queueSize the number of cases waiting for it
+PIPELINE_STAGES = [	{'name': 'load',	'method': 'pipelineLoad',		'thread': 'worker',	'concurrency': 2, 'queueSize': 1},
+					{'name': 'crop',	'method': 'pipelineCrop',		'thread': 'main',	'concurrency': 1, 'queueSize': 2},
+					{'name': 'affine',	'method': 'pipelineAffine',		'thread': 'worker',	'concurrency': 2, 'queueSize': 2},
+					{'name': 'bspline',	'method': 'pipelineBSpline',	'thread': 'worker',	'concurrency': 2, 'queueSize': 2},
+					{'name': 'measure',	'method': 'pipelineMeasure',	'thread': 'main',	'concurrency': 1, 'queueSize': 4} ]
 
 #
 # AValue3DSlicerModule
@@ -140,6 +216,14 @@ class AValue3DSlicerModuleWidget(ScriptedLoadableModuleWidget):
 		imageCropping.addWidget(self.cropButton)
 		parametersFormLayout.addRow("Select & Crop Region of Interest: ", imageCropping)
 
+		#
+		# Tight ROI checkbox
+		#
+		self.tightROICheckBox = qt.QCheckBox()
+		self.tightROICheckBox.checked = False
+		self.tightROICheckBox.setToolTip("If checked the ROI only encloses the atlas foreground plus a margin, so less background is registered")
+		parametersFormLayout.addRow("Tight ROI: ", self.tightROICheckBox)
+
 		#
 		# output volume selector
 		#
@@ -171,6 +255,30 @@ class AValue3DSlicerModuleWidget(ScriptedLoadableModuleWidget):
 		self.outputTransformSelector.setToolTip( "output transform " )
 		parametersFormLayout.addRow("Output BSpline Transform: ", self.outputTransformSelector)
 
+		#
+		# Multi-resolution registration checkbox
+		#
+		self.pyramidCheckBox = qt.QCheckBox()
+		self.pyramidCheckBox.checked = False
+		self.pyramidCheckBox.setToolTip("If checked affine & BSpline registrations run coarse-to-fine over an image pyramid")
+		parametersFormLayout.addRow("Multi-Resolution Registration: ", self.pyramidCheckBox)
+
+		#
+		# Adaptive stopping checkbox
+		#
+		self.adaptiveStoppingCheckBox = qt.QCheckBox()
+		self.adaptiveStoppingCheckBox.checked = False
+		self.adaptiveStoppingCheckBox.setToolTip("If checked registrations stop once the metric & the A-value fiducials stop changing")
+		parametersFormLayout.addRow("Adaptive Stopping: ", self.adaptiveStoppingCheckBox)
+
+		#
+		# Preview registration checkbox
+		#
+		self.previewCheckBox = qt.QCheckBox()
+		self.previewCheckBox.checked = False
+		self.previewCheckBox.setToolTip("If checked a provisional A-value from low resolution volumes is shown before the full registration completes")
+		parametersFormLayout.addRow("Preview Registration: ", self.previewCheckBox)
+
 		#
 		# Calculate A-Value Button
 		#
@@ -179,6 +287,35 @@ class AValue3DSlicerModuleWidget(ScriptedLoadableModuleWidget):
 		self.applyButton.enabled = False
 		parametersFormLayout.addRow(self.applyButton)
 
+		#
+		# Registration progress & cancellation (registration runs in the background)
+		#
+		self.registrationProgress = qt.QProgressBar()
+		self.registrationProgress.setRange(0, 100)
+		self.registrationProgress.value = 0
+		self.cancelButton = qt.QPushButton("Cancel")
+		self.cancelButton.toolTip = "Cancel the running registration"
+		self.cancelButton.enabled = False
+
+		registrationStatus = qt.QHBoxLayout()
+		registrationStatus.addWidget(self.registrationProgress)
+		registrationStatus.addWidget(self.cancelButton)
+		parametersFormLayout.addRow("Registration: ", registrationStatus)
+		self.registrationJob = None
+
+		#
+		# A-value result (provisional while the full resolution registration runs)
+		#
+		self.resultLabel = qt.QLabel()
+		parametersFormLayout.addRow("Result: ", self.resultLabel)
+
+		#
+		# Next Case Button
+		#
+		self.nextCaseButton = qt.QPushButton("Next Case")
+		self.nextCaseButton.toolTip = "Remove the atlas, landmarks, transforms & intermediate volumes of the current case"
+		parametersFormLayout.addRow(self.nextCaseButton)
+
 		# connections
 		self.leftAtlas.connect('toggled(bool)', self.onLeftEarSelection)
 		self.rightAtlas.connect('toggled(bool)', self.onRightEarSelection)
@@ -194,6 +331,8 @@ class AValue3DSlicerModuleWidget(ScriptedLoadableModuleWidget):
 		self.outputSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
 		self.outputTransformSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
 		self.applyButton.connect('clicked(bool)', self.onApplyButton)
+		self.cancelButton.connect('clicked(bool)', self.onCancelButton)
+		self.nextCaseButton.connect('clicked(bool)', self.onNextCaseButton)
 
 		# Add vertical spacer
 		self.layout.addStretch(1)
@@ -211,7 +350,8 @@ class AValue3DSlicerModuleWidget(ScriptedLoadableModuleWidget):
 		self.OWButton.enabled 		= self.inputSelector.currentNode()
 		self.applyButton.enabled 	= self.inputSelector.currentNode() \
 									and self.outputSelector.currentNode() \
-									and self.outputTransformSelector.currentNode()
+									and self.outputTransformSelector.currentNode() \
+									and (self.registrationJob is None or self.registrationJob.isDone())
 
 	def onLeftEarSelection(self):
 		if self.leftAtlas.isChecked() == True:
@@ -235,12 +375,12 @@ class AValue3DSlicerModuleWidget(ScriptedLoadableModuleWidget):
 			self.atlasSelection = "none"
 
 		self.AtlasLoaded, self.atlasVolume, self.atlasFid = logic.runAtlasLoad(self.atlasSelection)
+		self.atlasView = logic.atlasView
 		self.atlasVolume.SetDisplayVisibility(1) #Make atlas visible
 
 	def onOWButton(self):
 		#Setup Fiduical placement
-		self.placedLandmarkNode = slicer.vtkMRMLMarkupsFiducialNode()
-		slicer.mrmlScene.AddNode(self.placedLandmarkNode)
+		self.placedLandmarkNode = caseScope.addNode(slicer.vtkMRMLMarkupsFiducialNode())
 		#Fiduical Placement Widget
 		self.fiducialWidget = slicer.qSlicerMarkupsPlaceWidget()
 		self.fiducialWidget.buttonsVisible = False
@@ -302,24 +442,24 @@ class AValue3DSlicerModuleWidget(ScriptedLoadableModuleWidget):
 	def onAlignButton(self):
 
 		self.RWButton.enabled = False
-		#Create Landmark transform placeholder
-		self.LandmarkTrans = slicer.vtkMRMLTransformNode()
-		slicer.mrmlScene.AddNode(self.LandmarkTrans)
+		#Landmark transform placeholder (reused between cases)
+		self.LandmarkTrans = caseScope.reusableNode('vtkMRMLTransformNode', 'LandmarkTransform')
 
 		logic = AValue3DSlicerModuleLogic()
 
 		#Run fiducial registration
 		if(self.placedLandmarkNode.GetNumberOfFiducials() == 4):
-			logic.runFiducialRegistration(self.rightAtlas.isChecked(), self.LandmarkTrans, self.placedLandmarkNode)
+			try:
+				logic.runFiducialRegistration(self.rightAtlas.isChecked(), self.LandmarkTrans, self.placedLandmarkNode)
+			except ValueError as e:
+				#Fewer than 3 landmark pairs selected, align can be retried once they are reselected
+				slicer.util.errorDisplay('Landmark registration failed: ' + str(e))
+				return
 		else:
 			slicer.util.infoDisplay("4 Fiducials required for registration") #TODO - add appropriate information to help user!
 
-		#Apply Landmark transform on Atlas Volume then Harden
-		self.atlasVolume.SetAndObserveTransformNodeID(self.LandmarkTrans.GetID())
-		slicer.vtkSlicerTransformLogic().hardenTransform(self.atlasVolume)
-		#Apply Landmark transform on Fiduicals then Harden
-		self.atlasFid.SetAndObserveTransformNodeID(self.LandmarkTrans.GetID())
-		slicer.vtkSlicerTransformLogic().hardenTransform(self.atlasFid)
+		#Apply Landmark transform on Atlas Volume & Fiduicals then Harden (cached atlas is left untouched)
+		self.atlasView.hardenTransform(self.LandmarkTrans)
 
 		#Set Atlas to foreground in Slice Views
 		applicationLogic 	= slicer.app.applicationLogic()
@@ -348,6 +488,7 @@ class AValue3DSlicerModuleWidget(ScriptedLoadableModuleWidget):
 
 		#Define logic & retrieve atlas/template region of interest (ROI)
 		logic = AValue3DSlicerModuleLogic()
+		logic.tightROI	= TIGHT_ROI if self.tightROICheckBox.checked else None
 		self.atlasROI	= logic.runDefineCropROIVoxel(self.atlasVolume)
 
 		#User to ensure proper ROI placement
@@ -376,11 +517,60 @@ class AValue3DSlicerModuleWidget(ScriptedLoadableModuleWidget):
 
 		#Instantiate logic class
 		logic = AValue3DSlicerModuleLogic()
+		logic.adaptiveStopping = ADAPTIVE_STOPPING if self.adaptiveStoppingCheckBox.checked else None
+
+		#Run module logic, registrations run in the background & the A-value is shown once they complete
+		pyramidLevels = REGISTRATION_PYRAMID if self.pyramidCheckBox.checked else None
+		job = logic.run(	self.cropVolume, self.outputSelector.currentNode(),
+							self.atlasVolume, self.LandmarkTrans,
+							self.outputTransformSelector.currentNode(), self.atlasFid,
+							pyramidLevels=pyramidLevels, background=True, preview=self.previewCheckBox.checked )
+		if not job:
+			return
+
+		self.registrationJob = job
+		self.registrationProgress.value = 0
+		self.cancelButton.enabled = True
+		self.resultLabel.text = 'Registering...'
+		job.addProgressCallback(self.onRegistrationProgress)
+		job.addPreviewCallback(self.onRegistrationPreview)
+		job.addCallback(self.onRegistrationFinished)
+		self.onSelect()
+
+	def onRegistrationProgress(self, job):
+		self.registrationProgress.value = int(100 * job.progress())
 
-		#Run module logic
-		logic.run(	self.cropVolume, self.outputSelector.currentNode(),
-					self.atlasVolume, self.LandmarkTrans,
-					self.outputTransformSelector.currentNode(), self.atlasFid )
+	def onRegistrationPreview(self, job):
+		self.resultLabel.text = 'Provisional ' + resultSummary(job.preview) + ' (refining...)'
+
+	def onRegistrationFinished(self, job):
+		self.registrationProgress.value = 100 if job.status == 'Completed' else 0
+		self.cancelButton.enabled = False
+		self.resultLabel.text = resultSummary(job.result) if job.status == 'Completed' else 'Registration ' + job.status.lower()
+		self.onSelect()
+		if job.status == 'Failed':
+			slicer.util.errorDisplay('Registration failed: ' + str(job.error))
+
+	def onCancelButton(self):
+		if self.registrationJob is not None:
+			self.registrationJob.cancel()
+
+	def onNextCaseButton(self):
+
+		#Free every node of the current case, output volume & transform are kept. A running
+		#registration keeps its nodes, pooled transforms included, until it is done; the next
+		#case can be started meanwhile on new pooled nodes
+		if self.registrationJob is not None and not self.registrationJob.isDone():
+			scope = caseScope.detach()
+			self.registrationJob.addCallback(lambda job: scope.finalize())
+		else:
+			report = caseScope.finalize()
+			logging.info('Case scene memory: %0.1f MB in %d nodes' % (report['imageMemoryMB'], report['numberOfNodes']))
+
+		for button in (self.CNButton, self.AButton, self.RWButton, self.alignButton,
+						self.defineCropButton, self.cropButton):
+			button.enabled = False
+		self.onSelect()
 
 	def cleanup(self):
 		pass
@@ -397,6 +587,15 @@ class AValue3DSlicerModuleLogic(ScriptedLoadableModuleLogic):
 	Uses ScriptedLoadableModuleLogic base class, available at:
 	https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
 	"""
+	#Reuse transforms of identical registrations from the on-disk registration cache
+	useRegistrationCache = True
+
+	#Stop registrations early (see ADAPTIVE_STOPPING), None runs the fixed iteration budget
+	adaptiveStopping = None
+
+	#Fit ROIs to the template foreground (see TIGHT_ROI), None fits them to the whole template
+	tightROI = None
+
 	#Check input data is provided
 	def hasImageData(self,volumeNode):
 		"""This is an example logic method that
@@ -429,36 +628,20 @@ class AValue3DSlicerModuleLogic(ScriptedLoadableModuleLogic):
 	#load Atlas and corresponding A-Value Fiducials
 	def loadAtlasNodeAndFiducials(self, isRight):
 
-		#Retrieve required data (data must be in the same folder as the .py script)
-		atlasLocationR 		= os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe()))) + '/initialAtlasR.nrrd'
-		fiducialLocationR 	= os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe()))) + '/Atlas_AValue_F.fcsv'
-		atlasLocationL 		= os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe()))) + '/initialAtlasL.nrrd'
-		fiducialLocationL	= os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe()))) + '/Atlas_AValue_MF.fcsv'
-
-		#create atlasnode
-		if isRight:
-			atlasNode = slicer.util.loadVolume(atlasLocationR, returnNode=True)
-			atlasFiducial = slicer.util.loadMarkupsFiducialList(fiducialLocationR, returnNode=True)
-			logging.info('Loaded right ear atlas')
-		else:
-			atlasNode = slicer.util.loadVolume(atlasLocationL, returnNode=True)
-			atlasFiducial = slicer.util.loadMarkupsFiducialList(fiducialLocationL, returnNode=True)
-			logging.info('Loaded left ear atlas')
-		return atlasNode, atlasFiducial
+		#Decoded atlas is kept in memory, each case gets its own copy-on-write view of it
+		with stageTrace.span('atlasLoad', side='right' if isRight else 'left') as span:
+			self.atlasView = AtlasView(atlasCache.get(isRight))
+			caseScope.addNode(self.atlasView.volumeNode)
+			caseScope.addNode(self.atlasView.fiducialNode)
+			span['volumes'].append(self.atlasView.volumeNode)
+		logging.info('Loaded %s ear atlas' % ('right' if isRight else 'left'))
+		return self.atlasView.volumeNode, self.atlasView.fiducialNode
 
 	#Load fiducial landmark for initial atlas landmark registration
 	def loadAtlasLandmark(self, isRight):
 
-		#Retrieve required data (data must be in the same folder as the .py script)
-		landmarkLocationR	= os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe()))) + '/initialLandmarkREG_R.fcsv'
-		landmarkLocationL	= os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe()))) + '/initialLandmarkREG_L.fcsv'
-
-		if isRight:
-			landmarkFid = slicer.util.loadMarkupsFiducialList(landmarkLocationR, returnNode=True)
-		else:
-			landmarkFid = slicer.util.loadMarkupsFiducialList(landmarkLocationL, returnNode=True)
 		logging.info('loading landmarks')
-		return landmarkFid[1]#Return fiducial only
+		return caseScope.addNode(atlasCache.get(isRight).createFiducialNode('landmarks'))
 
 	def printStatus(self):
 		print('Fiduical placed!!')
@@ -471,38 +654,40 @@ class AValue3DSlicerModuleLogic(ScriptedLoadableModuleLogic):
 		#check atlas selection then retrive atlas
 		if(atlasSelection != 'None'):
 			if atlasSelection == 'right':
-				self.loadedAtlas, self.loadFid 	= self.loadAtlasNodeAndFiducials(True) #Returns tuple
-				self.atlasVolume  				= self.loadedAtlas[1] #Retrieve atlas Volume from tuple
-				self.atlasFiducial 				= self.loadFid[1]
+				self.atlasVolume, self.atlasFiducial = self.loadAtlasNodeAndFiducials(True)
 				self.atlasFiducial.SetDisplayVisibility(0) #do not display atlas fiducials
 				return True, self.atlasVolume, self.atlasFiducial
 			elif atlasSelection == 'left':
-				self.loadedAtlas, self.loadFid	= self.loadAtlasNodeAndFiducials(False) #False implies not right i.e. left
-				self.atlasVolume				= self.loadedAtlas[1]
-				self.atlasFiducial				= self.loadFid[1]
+				self.atlasVolume, self.atlasFiducial = self.loadAtlasNodeAndFiducials(False) #False implies not right i.e. left
 				self.atlasFiducial.SetDisplayVisibility(0) #do not display atlas fiducials
 				return True, self.atlasVolume, self.atlasFiducial
 			else:
 				slicer.util.errorDisplay('Atlas not selected. Choose right or left ear atlas')
 				return False
 
-	def runFiducialRegistration(self, isRight, rigTrans, placedLandmarkNode ):
+	def setMemoryInstrumentation(self, enabled):
+		"""Record peak RSS, allocated image data & full volume copies of every stage (see StageTrace)"""
+		stageTrace.recordMemory = enabled
 
-		#retrive fixed landmarks
-		movingLandmarkNode = self.loadAtlasLandmark(isRight)
+	def hardenTransform(self, node, transformNode):
+		"""Harden transformNode on node, copying shared atlas voxels before they are resampled"""
+		with stageTrace.span('harden', [node] if node.IsA('vtkMRMLVolumeNode') else []):
+			hardenCopyOnWrite(node, transformNode)
 
-		#Setup and Run Landmark Registration
-		cliParamsFidReg = {	'fixedLandmarks'	: placedLandmarkNode.GetID(),
-						   	'movingLandmarks' 	: movingLandmarkNode.GetID(),
-							'transformType' 	: 'Rigid',
-							'saveTransform' 	: rigTrans.GetID() }
+	def runFiducialRegistration(self, isRight, rigTrans, placedLandmarkNode ):
 
-		cliRigTrans = slicer.cli.run(slicer.modules.fiducialregistration, None,
-									  cliParamsFidReg, wait_for_completion=True )
+		with stageTrace.span('landmarkRegistration'):
+			#retrive moving (atlas) landmarks straight from the atlas cache, paired with the placed landmarks
+			#by name. A pair is left out of the fit if either landmark is deselected (see matchLandmarks)
+			atlasLandmarks = atlasCache.get(isRight).markups['landmarks']
+			movingLandmarks, fixedLandmarks = matchLandmarks(	atlasLandmarks, atlasLandmarkNames(atlasLandmarks),
+																LandmarkSet.fromNode(placedLandmarkNode), BATCH_LANDMARK_COLUMNS )
 
-		movingLandmarkNode.SetDisplayVisibility(0) #turn off display for moving landmarks
+			#Solve the rigid landmark registration in-process
+			rigMatrix = fitLandmarkTransform(fixedLandmarks, movingLandmarks)
+			setTransformMatrix(rigTrans, rigMatrix)
 
-		#return cliRigTrans
+		return rigMatrix
 
 
 	def runDefineCropROI(self, cropParam):
@@ -526,144 +711,1675 @@ class AValue3DSlicerModuleLogic(ScriptedLoadableModuleLogic):
 
 		roi.SetXYZ(volCenter)
 		roi.SetRadiusXYZ(volDim[0]/2, volDim[1]/2, volDim[2]/2 )
+		if self.tightROI:
+			fitROIToForeground(roi, vol, **self.tightROI)
 		return roi
 
 	def runDefineCropROIVoxel(self, inputVol):
 
-		#create crop volume parameter node
-		cropParamNode = slicer.vtkMRMLCropVolumeParametersNode()
-		cropParamNode.SetScene(slicer.mrmlScene)
-		cropParamNode.SetName('Template_ROI')
-		cropParamNode.SetInputVolumeNodeID(inputVol.GetID())
-
-		#create ROI
-		template_roi = slicer.vtkMRMLAnnotationROINode()
-		slicer.mrmlScene.AddNode(template_roi)
-		cropParamNode.SetROINodeID(template_roi.GetID())
+		with stageTrace.span('defineROI', [inputVol]):
+			#crop volume parameter node & ROI (reused between cases)
+			cropParamNode = caseScope.reusableNode('vtkMRMLCropVolumeParametersNode', 'Template_ROI')
+			cropParamNode.SetInputVolumeNodeID(inputVol.GetID())
+			template_roi = caseScope.reusableNode('vtkMRMLAnnotationROINode', 'Template_ROI_Box')
+			template_roi.SetDisplayVisibility(1)
+			cropParamNode.SetROINodeID(template_roi.GetID())
 
-		#Fit roi to input image
-		slicer.mrmlScene.AddNode(cropParamNode)
-		slicer.modules.cropvolume.logic().SnapROIToVoxelGrid(cropParamNode)
-		slicer.modules.cropvolume.logic().FitROIToInputVolume(cropParamNode)
+			#Fit roi to input image
+			slicer.modules.cropvolume.logic().SnapROIToVoxelGrid(cropParamNode)
+			slicer.modules.cropvolume.logic().FitROIToInputVolume(cropParamNode)
+			if self.tightROI:
+				fitROIToForeground(template_roi, inputVol, **self.tightROI)
 
 		return template_roi
 
+	def runCropVolumeVoxel(self, volume, ranges):
+		"""Crop volume by voxel index ranges, no interpolation & only the ROI voxels are copied"""
+		imageData, ijkToRAS = extractVoxelRange(volume, ranges)
+
+		cropVol = slicer.vtkMRMLScalarVolumeNode()
+		cropVol.SetName(slicer.mrmlScene.GenerateUniqueName(volume.GetName() + '-subvolume'))
+		cropVol.SetIJKToRASMatrix(ijkToRAS)
+		cropVol.SetAndObserveImageData(imageData)
+		caseScope.addNode(cropVol)
+		cropVol.CreateDefaultDisplayNodes()
+		logging.info('Cropped %s by voxel index range %s' % (volume.GetName(), ranges))
+		return cropVol
 
 	def runCropVolume(self, roi, volume):
 
-		#Create Crop Volume Parameter node
-		cropParamNode = slicer.vtkMRMLCropVolumeParametersNode()
-		cropParamNode.SetScene(slicer.mrmlScene)
-		cropParamNode.SetName('Crop_volume_Node1')
+		with stageTrace.span('crop', [volume]) as span:
 
-		#Create Crop Volume Parameter node
-		cropParamNode = slicer.vtkMRMLCropVolumeParametersNode()
-		cropParamNode.SetScene(slicer.mrmlScene)
-		cropParamNode.SetName('Crop_volume_Node1')
-		cropParamNode.SetInputVolumeNodeID(volume.GetID())
-		cropParamNode.SetROINodeID(roi.GetID())
-		slicer.mrmlScene.AddNode(cropParamNode)
+			#Voxel aligned ROIs are cropped by index range, only oblique ROIs are resampled
+			voxelRange = voxelCropRange(roi, volume)
+			if voxelRange is not None:
+				span['method'] = 'voxelRange'
+				cropVol = self.runCropVolumeVoxel(volume, voxelRange)
+			else:
+				span['method'] = 'cropVolume'
 
-		#Apply Cropping
-		slicer.modules.cropvolume.logic().Apply(cropParamNode)
-		cropVol = slicer.mrmlScene.GetNodeByID(cropParamNode.GetOutputVolumeNodeID()) #TODO - Make cropped output visible!!
+				#Crop Volume Parameter node (reused between cases), every crop gets a new output volume
+				cropParamNode = caseScope.reusableNode('vtkMRMLCropVolumeParametersNode', 'Crop_volume_Node1')
+				cropParamNode.SetInputVolumeNodeID(volume.GetID())
+				cropParamNode.SetROINodeID(roi.GetID())
+				cropParamNode.SetOutputVolumeNodeID(None)
+
+				#Apply Cropping
+				slicer.modules.cropvolume.logic().Apply(cropParamNode)
+				cropVol = caseScope.addNode(slicer.mrmlScene.GetNodeByID(cropParamNode.GetOutputVolumeNodeID())) #TODO - Make cropped output visible!!
+			span['volumes'].append(cropVol)
 
 		return cropVol
 
+	def loadVolumeROI(self, path, roi, name=None):
+		"""
+		Load only the voxels of a NRRD volume file that cover roi (see readNRRDRegion),
+		the rest of the file is never held in memory
+		"""
+		center, radius = [0,0,0], [0,0,0]
+		roi.GetXYZ(center)
+		roi.GetRadiusXYZ(radius)
+		rasBounds = [center[axis] + sign * radius[axis] for axis in range(3) for sign in (-1, 1)]
+		with stageTrace.span('loadVolumeROI', path=path):
+			voxels, regionIJKToRAS = readNRRDRegion(path, rasBounds)
+		return self.volumeFromArray(voxels, regionIJKToRAS, name or os.path.splitext(os.path.basename(path))[0])
+
+	def volumeFromArray(self, voxels, regionIJKToRAS, name):
+		"""Add a volume node holding a copy of the (k, j, i) voxels array to the scene"""
+		imageData = vtk.vtkImageData()
+		imageData.SetDimensions(voxels.shape[::-1])
+		imageData.GetPointData().SetScalars(numpy_to_vtk(voxels.ravel(), deep=True))
+		ijkToRAS = vtk.vtkMatrix4x4()
+		for row in range(4):
+			for column in range(4):
+				ijkToRAS.SetElement(row, column, regionIJKToRAS[row, column])
+
+		volume = slicer.vtkMRMLScalarVolumeNode()
+		volume.SetName(name)
+		volume.SetIJKToRASMatrix(ijkToRAS)
+		volume.SetAndObserveImageData(imageData)
+		caseScope.addNode(volume)
+		volume.CreateDefaultDisplayNodes()
+		logging.info('Loaded %s voxels of %s' % ('x'.join(str(size) for size in voxels.shape[::-1]), name))
+		return volume
+
 	#Automated A-value implementation
-	def run(self, inputVolume, outputVolume, atlasVolume, initialTrans, outputTrans, atlasFid):
+	def shrinkVolume(self, volumeNode, shrinkFactor):
+		"""Add a copy of volumeNode averaged down by shrinkFactor along every axis to the scene"""
+
+		shrink = vtk.vtkImageShrink3D()
+		shrink.SetInputData(volumeNode.GetImageData())
+		shrink.SetShrinkFactors(shrinkFactor, shrinkFactor, shrinkFactor)
+		shrink.AveragingOn()
+		shrink.Update()
+		imageData = vtk.vtkImageData()
+		imageData.ShallowCopy(shrink.GetOutput())
+		imageData.SetOrigin(0, 0, 0) #Geometry is held by the IJKToRAS matrix
+		imageData.SetSpacing(1, 1, 1)
+
+		#Every new voxel is centred on the block of voxels it averages
+		ijkToRAS = vtk.vtkMatrix4x4()
+		volumeNode.GetIJKToRASMatrix(ijkToRAS)
+		blockToIJK = vtk.vtkMatrix4x4()
+		for axis in range(3):
+			blockToIJK.SetElement(axis, axis, shrinkFactor)
+			blockToIJK.SetElement(axis, 3, (shrinkFactor - 1) / 2.0)
+		shrunkIJKToRAS = vtk.vtkMatrix4x4()
+		vtk.vtkMatrix4x4.Multiply4x4(ijkToRAS, blockToIJK, shrunkIJKToRAS)
+
+		shrunkVolume = slicer.vtkMRMLScalarVolumeNode()
+		shrunkVolume.SetName(slicer.mrmlScene.GenerateUniqueName(volumeNode.GetName() + '_x%d' % shrinkFactor))
+		shrunkVolume.SetIJKToRASMatrix(shrunkIJKToRAS)
+		shrunkVolume.SetAndObserveImageData(imageData)
+		caseScope.addNode(shrunkVolume)
+		return shrunkVolume
+
+	def runBRAINSFit(self, cliParams, pyramidLevels=None, initialTrans=None):
+		"""
+		Run a BRAINSFit registration, coarse-to-fine if pyramidLevels are given.
+		Output transforms of previously computed registrations are read from the
+		registration cache instead (returns None in that case).
+		"""
+		cliNodes = list(self.brainsFitSteps(cliParams, pyramidLevels, initialTrans))
+		return cliNodes[-1] if cliNodes else None
+
+	def brainsFitSteps(self, cliParams, pyramidLevels=None, initialTrans=None, background=False):
+		"""
+		Generator version of runBRAINSFit yielding every BRAINSFit CLI node it
+		starts. In background the CLI modules do not block and the generator must
+		only be resumed once the yielded node completed (see RegistrationJob).
+		"""
+		outputTrans = slicer.mrmlScene.GetNodeByID(cliParams[registrationOutputKey(cliParams)])
+
+		cacheKey = None
+		if self.useRegistrationCache:
+			cacheKey = registrationCache.key(cliParams, pyramidLevels, initialTrans)
+			if cacheKey is not None and registrationCache.load(cacheKey, outputTrans):
+				logging.info('Registration transform loaded from cache')
+				return
+
+		if not pyramidLevels:
+			stageTrace.addCLICopies(2) #Fixed & moving volumes are written out for the CLI
+			with threadBudget.job(outputTrans.GetName()) as budget:
+				cliNode = self.startBRAINSFit(cliParams, budget['threads'], background)
+				yield cliNode
+		else:
+			for cliNode in self.pyramidRegistrationSteps(cliParams, pyramidLevels, background):
+				yield cliNode
+
+		if cacheKey is not None and cliNode.GetStatusString() == 'Completed':
+			registrationCache.store(cacheKey, outputTrans)
+
+	def startBRAINSFit(self, cliParams, numberOfThreads, background=False):
+		"""Start the BRAINSFit CLI limited to numberOfThreads (see ThreadBudget), returns its CLI node"""
+		cliParams = dict(cliParams, numberOfThreads=numberOfThreads)
+		return caseScope.addNode(slicer.cli.run(slicer.modules.brainsfit, None, cliParams, wait_for_completion=not background))
+
+	def runPyramidRegistration(self, cliParams, pyramidLevels):
+		"""
+		Run BRAINSFit once per pyramid level, coarse to fine. Each level registers
+		shrunk copies of the fixed & moving volumes and is initialized with the
+		transform found at the previous level.
+		"""
+		return list(self.pyramidRegistrationSteps(cliParams, pyramidLevels))[-1]
+
+	def pyramidRegistrationSteps(self, cliParams, pyramidLevels, background=False):
+		"""Generator version of runPyramidRegistration yielding the CLI node of every level"""
+		outputKey		= registrationOutputKey(cliParams)
+		outputTrans		= slicer.mrmlScene.GetNodeByID(cliParams[outputKey])
+		fixedVolume		= slicer.mrmlScene.GetNodeByID(cliParams['fixedVolume'])
+		movingVolume	= slicer.mrmlScene.GetNodeByID(cliParams['movingVolume'])
+
+		previousTrans = None
+		for levelIndex, level in enumerate(pyramidLevels):
+			shrinkFactor = level.get('shrinkFactor', 1)
+			levelParams = dict(cliParams)
+			levelParams.update(dict((key, value) for key, value in level.items() if key != 'shrinkFactor'))
+
+			levelNodes = []
+			if shrinkFactor > 1:
+				levelNodes = [self.shrinkVolume(fixedVolume, shrinkFactor), self.shrinkVolume(movingVolume, shrinkFactor)]
+				levelParams['fixedVolume']	= levelNodes[0].GetID()
+				levelParams['movingVolume']	= levelNodes[1].GetID()
+			if previousTrans is not None:
+				levelParams['initialTransform'] = previousTrans.GetID()
+
+			if levelIndex == len(pyramidLevels) - 1:
+				levelTrans = outputTrans
+			else:
+				levelTrans = caseScope.addNode(outputTrans.CreateNodeInstance())
+			levelParams[outputKey] = levelTrans.GetID()
+
+			logging.info('Pyramid level %d (shrink factor %d)' % (levelIndex + 1, shrinkFactor))
+			with stageTrace.span('pyramidLevel', levelNodes, level=levelIndex + 1, shrinkFactor=shrinkFactor):
+				if shrinkFactor == 1:
+					stageTrace.addCLICopies(2)
+				with threadBudget.job('%s level %d' % (outputTrans.GetName(), levelIndex + 1)) as budget:
+					cliNode = self.startBRAINSFit(levelParams, budget['threads'], background)
+					yield cliNode
+
+			for node in levelNodes + ([previousTrans] if previousTrans is not None else []):
+				slicer.mrmlScene.RemoveNode(node)
+			previousTrans = levelTrans
+
+	def evaluateTransformsAtPoints(self, points, transformNodes):
+		"""Map N x 3 points through the to-parent transforms of transformNodes, applied in order"""
+		composite = vtk.vtkGeneralTransform()
+		composite.PostMultiply()
+		for transformNode in transformNodes:
+			composite.Concatenate(transformNode.GetTransformToParent())
+		return np.array([composite.TransformPoint(list(point)) for point in points], dtype=float).reshape(-1, 3)
+
+	def run(self, inputVolume, outputVolume, atlasVolume, initialTrans, outputTrans, atlasFid,
+			showResult=True, pyramidLevels=None, background=False, preview=False):
 		"""
 		Run the actual algorithm
+		pyramidLevels - optional coarse-to-fine levels (see REGISTRATION_PYRAMID)
+		background - return a RegistrationJob right away instead of waiting for the registrations
+		preview - first register low resolution copies (see REGISTRATION_PREVIEW), the provisional
+		estimates are passed to the preview callbacks of the job
+		Returns a dictionary with the A-value & CDL estimates (False if inputs are invalid), in
+		background the job holds it as its result. Raises RuntimeError with the job error if the
+		registration fails outside background
 		"""
 		#check appropriate volume is selected
 		if not self.isValidInputOutputData(inputVolume, outputVolume):
 			slicer.util.errorDisplay('Input volume is the same as output volume. Choose a different output volume.')
 			return False
 
+		#Cached registrations complete right away, a preview would only delay them
+		if preview and self.isRegistrationCached(inputVolume, atlasVolume, initialTrans, outputTrans, pyramidLevels):
+			logging.info('Registration of %s found in the cache, preview skipped' % inputVolume.GetName())
+			preview = False
+
+		numberOfSteps = 2 * len(pyramidLevels or [None])
+		if self.adaptiveStopping and not pyramidLevels:
+			maximumIterations = self.affineParameters(None, None, None)['numberOfIterations']
+			numberOfSteps = 2 * int(math.ceil(maximumIterations / float(self.adaptiveStopping['chunkIterations'])))
+		if preview:
+			numberOfSteps += 2
+		job = RegistrationJob(inputVolume.GetName(), numberOfSteps)
+		if showResult:
+			job.addCallback(self.displayResult)
+		job.start(self.registrationSteps(	job, inputVolume, atlasVolume, initialTrans, outputTrans, atlasFid,
+											pyramidLevels, background, preview ))
+		if background:
+			return job
+		if job.status != 'Completed':
+			raise RuntimeError(job.error or job.status)
+		return job.result
+
+	def isRegistrationCached(self, inputVolume, atlasVolume, initialTrans, outputTrans, pyramidLevels=None):
+		"""True if both the affine & BSpline registrations of run are in the registration cache"""
+		if not self.useRegistrationCache or (self.adaptiveStopping and not pyramidLevels):
+			return False
+		#The BSpline key hashes the affine result, which is loaded into the affine transform node run uses
+		linearTrans = caseScope.reusableNode('vtkMRMLTransformNode', 'AffineTransform')
+		affineKey = registrationCache.key(self.affineParameters(inputVolume.GetID(), atlasVolume.GetID(), linearTrans.GetID()),
+										  pyramidLevels, initialTrans)
+		if affineKey is None or not registrationCache.load(affineKey, linearTrans):
+			return False
+		bsplineKey = registrationCache.key(self.bsplineParameters(inputVolume.GetID(), atlasVolume.GetID(), outputTrans.GetID(), linearTrans.GetID()),
+										   pyramidLevels, initialTrans)
+		return bsplineKey is not None and registrationCache.contains(bsplineKey)
+
+	def registrationSteps(self, job, inputVolume, atlasVolume, initialTrans, outputTrans, atlasFid,
+						  pyramidLevels=None, background=False, preview=False):
+		"""
+		Generator of the registration & A-value steps of run yielding the BRAINSFit
+		CLI nodes it starts (see RegistrationJob), the estimates are stored in job.result
+		"""
 		logging.info('.....Printing Initial Transform....')
 		logging.info(initialTrans)
 
-		#Create intermediate linear transform node
-		self.linearTrans = slicer.vtkMRMLTransformNode()
-		slicer.mrmlScene.AddNode(self.linearTrans)
+		#Intermediate linear transform node (reused between cases)
+		self.linearTrans = caseScope.reusableNode('vtkMRMLTransformNode', 'AffineTransform')
+		atlasPoints = fiducialArray(atlasFid)
+		stops = {}
+
+		if preview:
+			with stageTrace.span('preview', [inputVolume, atlasVolume]):
+				for cliNode in self.previewSteps(job, inputVolume, atlasVolume, atlasPoints, background):
+					yield cliNode
 
 		#Set parameters and run affine registration Step 1
-		cliParamsAffine = { 'fixedVolume' 		: inputVolume.GetID(),
-							'movingVolume'		: atlasVolume.GetID(),
-							'linearTransform' 	: self.linearTrans.GetID() }
+		cliParamsAffine = self.affineParameters(inputVolume.GetID(), atlasVolume.GetID(), self.linearTrans.GetID())
+		with stageTrace.span('affineRegistration', [inputVolume, atlasVolume], cached=True) as span:
+			for cliNode in self.registrationStageSteps(cliParamsAffine, atlasPoints, pyramidLevels, initialTrans, span, background):
+				span['cached'] = False
+				yield cliNode
+			stops['affine'] = span
+
+		logging.info('....Printing Affine Transform....')
+		logging.info(self.linearTrans)
+
+		# Set parameters and run BSpline registration Step 2, affine is kept as bulk transform (atlas is not resampled)
+		# BRAINSFit writes the initial affine into the BSpline output, it is the whole registration (see test_bsplineBulkTransform)
+		cliParams = self.bsplineParameters(inputVolume.GetID(), atlasVolume.GetID(), outputTrans.GetID(), self.linearTrans.GetID())
+		with stageTrace.span('bsplineRegistration', [inputVolume, atlasVolume], cached=True) as span:
+			for cliNode in self.registrationStageSteps(cliParams, atlasPoints, pyramidLevels, initialTrans, span, background):
+				span['cached'] = False
+				yield cliNode
+			stops['bspline'] = span
+
+		logging.info('....Printing BSpline Transform....')
+		logging.info(outputTrans)
+
+		with stageTrace.span('aValue'):
+			job.result = self.measureAValue(inputVolume.GetName(), atlasPoints, [outputTrans])
+		for stage, span in stops.items():
+			if 'stopReason' in span:
+				job.result[stage + 'Iterations']	= span['iterations']
+				job.result[stage + 'StopReason']	= span['stopReason']
+
+		logging.info('Processing completed') #TODO - Deal with output Volume!!
+
+	def previewSteps(self, job, inputVolume, atlasVolume, atlasPoints, background=False):
+		"""
+		Affine & BSpline registration of shrunk copies of the volumes (see
+		REGISTRATION_PREVIEW), the provisional estimates are set as the job preview.
+		Yields every BRAINSFit CLI node it starts.
+		"""
+		shrinkFactor	= REGISTRATION_PREVIEW['shrinkFactor']
+		overrides		= dict((key, value) for key, value in REGISTRATION_PREVIEW.items() if key != 'shrinkFactor')
+		fixedVolume		= self.shrinkVolume(inputVolume, shrinkFactor)
+		movingVolume	= self.shrinkVolume(atlasVolume, shrinkFactor)
+		linearTrans		= caseScope.addNode(slicer.vtkMRMLTransformNode())
+		bsplineTrans	= caseScope.addNode(slicer.vtkMRMLBSplineTransformNode())
+
+		for cliParams in (	self.affineParameters(fixedVolume.GetID(), movingVolume.GetID(), linearTrans.GetID()),
+							self.bsplineParameters(fixedVolume.GetID(), movingVolume.GetID(), bsplineTrans.GetID(), linearTrans.GetID()) ):
+			cliParams.update(overrides)
+			with threadBudget.job(inputVolume.GetName() + ' preview') as budget:
+				yield self.startBRAINSFit(cliParams, budget['threads'], background)
+
+		job.setPreview(self.measureAValue(inputVolume.GetName(), atlasPoints, [bsplineTrans]))
+		for node in (fixedVolume, movingVolume, linearTrans, bsplineTrans):
+			slicer.mrmlScene.RemoveNode(node)
+
+	def registrationStageSteps(self, cliParams, atlasPoints, pyramidLevels, initialTrans, span, background=False):
+		"""Steps of one registration stage of run, adaptive if adaptiveStopping is set (not with pyramidLevels)"""
+		if self.adaptiveStopping and not pyramidLevels:
+			return self.adaptiveRegistrationSteps(cliParams, atlasPoints, span, background)
+		return self.brainsFitSteps(cliParams, pyramidLevels, initialTrans, background)
+
+	def adaptiveRegistrationSteps(self, cliParams, atlasPoints, span, background=False):
+		"""
+		Run BRAINSFit in checkpointed chunks (see ADAPTIVE_STOPPING), each one
+		continuing from the transform of the previous chunk, up to the
+		numberOfIterations of cliParams. Stops early once the metric stops
+		improving or the atlasPoints (N x 3) mapped through the output transform
+		stop moving. Every chunk is a new optimizer run, so the improvement of a
+		chunk is measured between its own first & last metric values. Without
+		metric values only the fiducial motion can stop the registration early.
+		The iterations run, the stop reason & whether the metric was used are set
+		on span. Yields every BRAINSFit CLI node it starts, like brainsFitSteps.
+		"""
+		settings		= self.adaptiveStopping
+		outputTrans		= slicer.mrmlScene.GetNodeByID(cliParams[registrationOutputKey(cliParams)])
+		checkpointTrans	= caseScope.addNode(outputTrans.CreateNodeInstance())
+		voxelSize		= min(slicer.mrmlScene.GetNodeByID(cliParams['fixedVolume']).GetSpacing())
+
+		improvements, positions, useMetric = [], None, True
+		iterations, stopReason = 0, 'maximumIterations'
+		stageTrace.addCLICopies(2)
+		while iterations < cliParams['numberOfIterations']:
+			chunkParams = dict(cliParams, numberOfIterations=min(settings['chunkIterations'], cliParams['numberOfIterations'] - iterations))
+			if iterations:
+				#CLI results are read into new transform objects, the checkpoint keeps the previous one
+				checkpointTrans.SetAndObserveTransformFromParent(outputTrans.GetTransformFromParent())
+				chunkParams['initialTransform'] = checkpointTrans.GetID()
+			with threadBudget.job(outputTrans.GetName()) as budget:
+				cliNode = self.startBRAINSFit(chunkParams, budget['threads'], background)
+				yield cliNode
+			iterations += chunkParams['numberOfIterations']
+
+			if useMetric:
+				metrics = parseBRAINSFitMetrics(cliNode.GetOutputText()) if hasattr(cliNode, 'GetOutputText') else []
+				if len(metrics) < 2:
+					logging.warning('No BRAINSFit metric values for %s, adaptive stopping only uses the fiducial motion' % outputTrans.GetName())
+					useMetric = False
+				else:
+					improvements.append(relativeImprovement(metrics[0], metrics[-1]))
+			previousPositions, positions = positions, self.evaluateTransformsAtPoints(atlasPoints, [outputTrans])
+			if previousPositions is not None and \
+			   np.sqrt(((positions - previousPositions) ** 2).sum(axis=1)).max() < settings['motionThreshold'] * voxelSize:
+				stopReason = 'fiducialMotion'
+				break
+			if useMetric and len(improvements) >= settings['window'] and \
+			   max(improvements[-settings['window']:]) < settings['metricTolerance']:
+				stopReason = 'metricConverged'
+				break
+
+		span['iterations'], span['stopReason'], span['metricStopping'] = iterations, stopReason, useMetric
+		logging.info('%s stopped after %d iterations: %s' % (outputTrans.GetName(), iterations, stopReason))
+
+	def affineParameters(self, fixedVolume, movingVolume, linearTransform):
+		"""BRAINSFit parameters of the affine registration, volumes & transform are node IDs or file names"""
+		cliParamsAffine = { 'fixedVolume' 		: fixedVolume,
+							'movingVolume'		: movingVolume,
+							'linearTransform' 	: linearTransform }
 		cliParamsAffine.update({'samplingPercentage'	: 1,
 								'initialTransformMode' 	: 'off',
 								'transformType'			: 'Affine'})
 		cliParamsAffine.update({'numberOfIterations' 	: 3000,
 								'minimumStepLength'		: 0.00001,
 								'maximumStepLength'		: 0.05})
-		cliAffineTransREG = slicer.cli.run(slicer.modules.brainsfit, None, cliParamsAffine, wait_for_completion=True)
-
-		logging.info('....Printing Affine Transform....')
-		logging.info(self.linearTrans)
-
-		#Apply linear transform result from step 1 on Atlas Volume
-		atlasVolume.SetAndObserveTransformNodeID(self.linearTrans.GetID())
-		slicer.vtkSlicerTransformLogic().hardenTransform(atlasVolume)
-
-		# Set parameters and run BSpline registration Step 2
-		cliParams = {	'fixedVolume'		: inputVolume.GetID(),
-		 				'movingVolume'		: atlasVolume.GetID(),
-						'bsplineTransform' 	: outputTrans.GetID() }
-						#'initialTransform' 	: self.linearTrans.GetID()
+		return cliParamsAffine
+
+	def bsplineParameters(self, fixedVolume, movingVolume, bsplineTransform, initialTransform):
+		"""BRAINSFit parameters of the BSpline registration, volumes & transforms are node IDs or file names"""
+		cliParams = {	'fixedVolume'		: fixedVolume,
+		 				'movingVolume'		: movingVolume,
+						'bsplineTransform' 	: bsplineTransform,
+						'initialTransform' 	: initialTransform }
 		cliParams.update({	'samplingPercentage'	: 1,
-		 					'initialTransfomMode' 	: 'off' })
+		 					'initialTransformMode' 	: 'off' })
 		cliParams.update({	'transformType'	: 'BSpline',
 							'splineGridSize': '3,3,3'})
 		cliParams.update({	'numberOfIterations' 	: 3000,
 		 					'minimumStepLength'		: 0.00001,
 							'maximumStepLength'		: 0.05})
 		cliParams.update({'costMetric' : 'NC' })
-		cliBSplineREG = slicer.cli.run(slicer.modules.brainsfit, None, cliParams, wait_for_completion=True)
+		return cliParams
 
-		logging.info('....Printing BSpline Transform....')
-		logging.info(outputTrans)
+	def measureAValue(self, patientID, atlasPoints, transformNodes):
+		"""A-value & CDL estimates from the atlas A-value fiducial positions mapped through transformNodes"""
 
-		#Apply BSpline transform on A-Value Fiducials
-		atlasFid.SetAndObserveTransformNodeID(outputTrans.GetID())
-		slicer.vtkSlicerTransformLogic().hardenTransform(atlasFid)
-
-		#Calculate New A-Value
-		numOfFids = atlasFid.GetNumberOfFiducials()
-		fidXYZ_RW = [0,0,0] #Round Window placeholder
-		fidXYZ_LW = [0,0,0] #Lateral Wall placeholder
-		print numOfFids
-		for index in range(numOfFids):
-			if index == 0:
-				atlasFid.GetNthFiducialPosition(index, fidXYZ_RW)
-				print fidXYZ_RW
-			else:
-				atlasFid.GetNthFiducialPosition(index, fidXYZ_LW)
-				print fidXYZ_LW
+		#Evaluate the registration at the A-Value Fiducials (RWind, LatWall) instead of hardening it
+		fidXYZ = self.evaluateTransformsAtPoints(atlasPoints, transformNodes)
+		return self.aValueResult(patientID, fidXYZ[0], fidXYZ[-1]) #Round Window, Lateral Wall
 
-		newAValue = math.sqrt(	((fidXYZ_RW[0] - fidXYZ_LW[0])**2) + \
-								((fidXYZ_RW[1] - fidXYZ_LW[1])**2) + \
-								((fidXYZ_LW[2] - fidXYZ_RW[2])**2)		)
+	def aValueResult(self, patientID, fidXYZ_RW, fidXYZ_LW):
+		"""A-value & CDL estimates from the registered round window & lateral wall positions"""
+		fidXYZ_RW, fidXYZ_LW = np.asarray(fidXYZ_RW, dtype=float), np.asarray(fidXYZ_LW, dtype=float)
 
+		#A-value & every registered CDL estimate (see CDL_ESTIMATORS)
+		result = {	'patientID'		: patientID,
+					'roundWindow'	: fidXYZ_RW.tolist(),
+					'lateralWall'	: fidXYZ_LW.tolist() }
+		for name, values in computeAValues([[fidXYZ_RW, fidXYZ_LW]]).items():
+			result[name] = float(values[0])
+		return result
 
-		#Calculating CDL Estimates
-		AlexiadesCDLoc 	= 4.16 * newAValue - 4 		#CDL estimate from Alexiades et al. (2015)
-		KochCDLoc 		= 4.16 * newAValue - 5.05	#CDL estimate from Koch et al. (2017)
-		KochCDLlw		= 3.86 * newAValue + 4.99	#CDL estimtae from Koch et al. (2017)
+	def runMultiAtlas(self, inputVolume, placedLandmarks, atlases, fusion='median'):
+		"""
+		Register every atlas of atlases (see readAtlasSet) to the cropped inputVolume
+		in parallel BRAINSFit processes, initialized by the landmark registration of
+		each atlas to placedLandmarks (N x 3), and fuse their round window & lateral
+		wall positions (see fuseAtlasPositions). Atlases that fail to register are
+		left out. Returns the A-value result of the fused positions with the A-value
+		of every atlas & their spread.
+		"""
+		if fusion not in ATLAS_FUSION_METHODS:
+			raise ValueError('Unknown atlas fusion method %s' % fusion)
+		if not atlases:
+			raise ValueError('The atlas set has no atlas of this side')
+		self.brainsFitPath = slicer.modules.brainsfit.path
+		workDir = tempfile.mkdtemp(prefix='AValueMultiAtlas_')
+		pool = ThreadPool(len(atlases)) #Threads only wait on their BRAINSFit processes
+		try:
+			fixedVolume = os.path.join(workDir, 'fixed.nrrd')
+			if not slicer.util.saveNode(inputVolume, fixedVolume):
+				raise IOError('Unable to write ' + fixedVolume)
+
+			#Every atlas registration gets an equal share of the cores
+			threadBudget.setDemand(len(atlases))
+			with stageTrace.span('multiAtlasRegistration', [inputVolume], numberOfAtlases=len(atlases)):
+				transformPaths = pool.map(lambda atlas: self.registerAtlasFiles(atlas, fixedVolume, placedLandmarks, workDir), atlases)
+
+			#Registered A-value fiducials of every atlas
+			registered, weights = [], []
+			for atlas, transformPath in zip(atlases, transformPaths):
+				if transformPath is None:
+					continue
+				loaded, transformNode = slicer.util.loadTransform(transformPath, returnNode=True)
+				if not loaded:
+					logging.error('Unable to load transform of atlas ' + atlas['name'])
+					continue
+				fidXYZ = self.evaluateTransformsAtPoints(LandmarkSet.read(atlas['fiducials']).positions, [transformNode])
+				slicer.mrmlScene.RemoveNode(transformNode)
+				registered.append([fidXYZ[0], fidXYZ[-1]])
+				weights.append(atlas['weight'])
+			if not registered:
+				raise RuntimeError('No atlas could be registered')
+		finally:
+			threadBudget.setDemand(1)
+			pool.close()
+			pool.join()
+			shutil.rmtree(workDir, ignore_errors=True)
+
+		fused, spread = fuseAtlasPositions(registered, weights, fusion)
+		atlasAValues = computeAValues(registered, estimators={})['aValue'].tolist()
+		result = self.aValueResult(inputVolume.GetName(), fused[0], fused[1])
+		result.update({	'fusion'				: fusion,
+						'numberOfAtlases'		: len(registered),
+						'atlasAValues'			: atlasAValues,
+						'aValueSpread'			: float(np.std(atlasAValues)),
+						'roundWindowSpread'		: float(spread[0]),
+						'lateralWallSpread'		: float(spread[1]) })
+		logging.info('Fused A-value of %d atlases: %0.3f (spread %0.3f)' % (len(registered), result['aValue'], result['aValueSpread']))
+		return result
+
+	def registerAtlasFiles(self, atlas, fixedVolume, placedLandmarks, workDir):
+		"""
+		Worker thread part of runMultiAtlas, registers one atlas on files only.
+		Returns the path of the BSpline transform, None if the registration failed.
+		"""
+		prefix = os.path.join(workDir, atlas['name'])
+		try:
+			landmarkMatrix = fitLandmarkTransform(placedLandmarks, placementPositions(LandmarkSet.read(atlas['landmarks'])))
+			writeITKTransform(prefix + '_landmark.tfm', landmarkMatrix)
+
+			cliParams = self.affineParameters(fixedVolume, atlas['volume'], prefix + '_affine.h5')
+			cliParams['initialTransform'] = prefix + '_landmark.tfm'
+			self.runBRAINSFitExecutable(cliParams, atlas['name'] + ' affine')
+			cliParams = self.bsplineParameters(fixedVolume, atlas['volume'], prefix + '_bspline.h5', prefix + '_affine.h5')
+			self.runBRAINSFitExecutable(cliParams, atlas['name'] + ' bspline')
+		except Exception as e:
+			logging.error('Registration of atlas %s failed: %s' % (atlas['name'], e))
+			return None
+		return prefix + '_bspline.h5'
+
+	def displayResult(self, job):
+		"""Completion callback of run showing the A-value & CDL estimates"""
+		if job.status != 'Completed':
+			return
+		result = job.result
 
 		#Display Patient ID and Estimated A Valuee
-		outputDisp = "Patient ID:\n" + inputVolume.GetName() + \
-					"\n\nEstimated A Value:\n" + format(newAValue, '0.1f') + 'mm\n\n' + \
-					"Estimated CDL Values\n" + "CDL(oc)-1: " + format(AlexiadesCDLoc, '0.1f') + 'mm\n' + \
-					"CDL(oc)-2: " + format(KochCDLoc, '0.1f') + "mm\n" + \
-					"CDL(lw)-1: " + format(KochCDLlw, '0.1f') + "mm\n"
-
+		outputDisp = "Patient ID:\n" + result['patientID'] + \
+					"\n\nEstimated A Value:\n" + format(result['aValue'], '0.1f') + 'mm\n\n' + \
+					"Estimated CDL Values\n" + "CDL(oc)-1: " + format(result['cdlAlexiadesOC'], '0.1f') + 'mm\n' + \
+					"CDL(oc)-2: " + format(result['cdlKochOC'], '0.1f') + "mm\n" + \
+					"CDL(lw)-1: " + format(result['cdlKochLW'], '0.1f') + "mm\n"
 		slicer.util.infoDisplay(outputDisp)
 
-		logging.info('Processing completed') #TODO - Deal with output Volume!!
+	#Combine the single-point landmark files of a batch case into one placed landmark node
+	def loadPlacedLandmarks(self, landmarkPaths):
+
+		landmarkSets = [LandmarkSet.read(landmarkPath) for landmarkPath in landmarkPaths]
+		for landmarkPath, landmarkSet in zip(landmarkPaths, landmarkSets):
+			if not len(landmarkSet):
+				raise IOError('No fiducial found in ' + landmarkPath)
+		placedLandmarks = LandmarkSet(	[landmarkSet.positions[0] for landmarkSet in landmarkSets],
+										[landmarkSet.labels[0] for landmarkSet in landmarkSets], name='PlacedLandmarks' )
+		return caseScope.addNode(placedLandmarks.createNode())
+
+	def loadWholeVolume(self, path, name):
+		loaded, volume = slicer.util.loadVolume(path, returnNode=True)
+		if not loaded:
+			raise IOError('Unable to load volume ' + path)
+		volume.SetName(name)
+		return caseScope.addNode(volume)
+
+	#Headless equivalent of Load Atlas -> Align Volume -> Define ROI -> Crop! -> Calculate A-Value
+	def runCase(self, case):
+
+		isRight = case['side'].lower() == 'right'
+
+		#Every node of the case is freed once the A-value is computed
+		firstJob = len(threadBudget.jobs)
+		caseScope.begin(case['caseID'])
+		stageTrace.beginCase(case['caseID'])
+		try:
+			with stageTrace.span('case', side=case['side']):
+				placedLandmarkNode = self.loadPlacedLandmarks([case[key] for key in BATCH_LANDMARK_COLUMNS])
+
+				#Load atlas and run landmark registration
+				atlasLoaded, atlasVolume, atlasFid = self.runAtlasLoad('right' if isRight else 'left')
+				landmarkTrans = caseScope.reusableNode('vtkMRMLTransformNode', 'LandmarkTransform')
+				self.runFiducialRegistration(isRight, landmarkTrans, placedLandmarkNode)
+
+				#Apply Landmark transform on Atlas Volume & Fiducials then Harden
+				self.atlasView.hardenTransform(landmarkTrans)
+
+				#Crop input to the atlas region of interest, NRRD volumes are only read inside the ROI
+				atlasROI	= self.runDefineCropROIVoxel(atlasVolume)
+				inputVolume	= None
+				if case['volume'].lower().endswith(('.nrrd', '.nhdr')):
+					try:
+						inputVolume = self.loadVolumeROI(case['volume'], atlasROI, case['caseID'])
+					except ValueError as error:
+						logging.info('Reading the whole volume, %s' % error)
+				if inputVolume is None:
+					inputVolume = self.loadWholeVolume(case['volume'], case['caseID'])
+				cropVolume	= self.runCropVolume(atlasROI, inputVolume)
+
+				outputVolume	= caseScope.addNode(slicer.vtkMRMLScalarVolumeNode())
+				outputTrans		= caseScope.addNode(slicer.vtkMRMLBSplineTransformNode())
+
+				if case.get('multiAtlasFusion'):
+					atlases = readAtlasSet(case.get('atlasSetPath'))[isRight]
+					result = self.runMultiAtlas(cropVolume, fiducialArray(placedLandmarkNode),
+												atlases, case['multiAtlasFusion'])
+				else:
+					result = self.run(	cropVolume, outputVolume, atlasVolume, landmarkTrans,
+										outputTrans, atlasFid, showResult=False,
+										pyramidLevels=case.get('pyramidLevels'))
+		finally:
+			report = caseScope.finalize()
+
+		if result:
+			result['imageMemoryMB'] = format(report['imageMemoryMB'], '0.1f')
+			result.update(registrationThreads(threadBudget.jobs[firstJob:]))
+			if stageTrace.recordMemory:
+				result.update(stageTrace.memorySummary())
+		return result
+
+	def runBatch(self, manifestPath, outputPath, numberOfWorkers=None, pyramidLevels=None, tracePath=None,
+				 memoryInstrumentation=False, multiAtlasFusion=None, atlasSetPath=None, adaptiveStopping=False,
+				 tightROI=False):
+		"""
+		Run every case of a batch manifest (see readBatchManifest) in a pool of
+		headless Slicer worker processes. One row per case is written to the
+		outputPath CSV as soon as the case finishes, stage spans of every case
+		are appended to tracePath (see StageTrace). memoryInstrumentation adds
+		the peak RSS, allocated image data & full volume copies to every row.
+		multiAtlasFusion ('median' or 'weighted') registers every atlas of
+		atlasSetPath (see readAtlasSet) and fuses the results (see runMultiAtlas).
+		adaptiveStopping stops registrations early (see ADAPTIVE_STOPPING) and
+		tightROI crops the inputs to the atlas foreground (see TIGHT_ROI).
+		"""
+		cases = readBatchManifest(manifestPath)
+		for case in cases:
+			case['pyramidLevels']			= pyramidLevels
+			case['tracePath']				= tracePath or stageTrace.tracePath
+			case['memoryInstrumentation']	= memoryInstrumentation or stageTrace.recordMemory
+			case['multiAtlasFusion']		= multiAtlasFusion
+			case['atlasSetPath']			= atlasSetPath
+			case['adaptiveStopping']		= adaptiveStopping
+			case['tightROI']				= tightROI
+		if numberOfWorkers is None:
+			numberOfWorkers = cpu_count()
+		numberOfWorkers = max(1, min(numberOfWorkers, len(cases)))
+		numberOfThreads = threadBudget.threadsPerJob(numberOfWorkers)
+		for case in cases:
+			case['numberOfThreads'] = numberOfThreads
+		logging.info('Running %d batch cases on %d workers, %d threads each' % (len(cases), numberOfWorkers, numberOfThreads))
+
+		workDir = tempfile.mkdtemp(prefix='AValueBatch_')
+		pool = ThreadPool(numberOfWorkers) #Threads only wait on their worker process
+		numFailed = 0
+		try:
+			with open(outputPath, 'w') as resultFile:
+				writer = csv.DictWriter(resultFile, BATCH_RESULT_FIELDS, extrasaction='ignore')
+				writer.writeheader()
+				for row in pool.imap_unordered(lambda case: self.runBatchWorker(case, workDir), cases):
+					writer.writerow(row)
+					resultFile.flush()
+					if row['status'] != 'completed':
+						numFailed += 1
+					logging.info('Batch case %s %s' % (row['caseID'], row['status']))
+		finally:
+			pool.close()
+			pool.join()
+			shutil.rmtree(workDir, ignore_errors=True)
+
+		logging.info('Batch completed: %d of %d cases failed' % (numFailed, len(cases)))
+		return numFailed == 0
+
+	def runBatchWorker(self, case, workDir):
+		"""Process one batch case in a separate Slicer process and return its result row"""
+
+		casePath	= os.path.join(workDir, case['caseID'] + '_case.json')
+		resultPath	= os.path.join(workDir, case['caseID'] + '_result.json')
+		with open(casePath, 'w') as caseFile:
+			json.dump(case, caseFile)
+
+		workerCode = (	"import sys; sys.path.insert(0, %r); import AValue3DSlicerModule; "
+						"AValue3DSlicerModule.runBatchCase(%r, %r); sys.exit(0)" ) % (MODULE_DIR, casePath, resultPath)
+
+		startTime = time.time()
+		returnCode = subprocess.call([	slicer.app.launcherExecutableFilePath, '--no-splash',
+										'--no-main-window', '--python-code', workerCode ])
+
+		if os.path.exists(resultPath):
+			with open(resultPath) as resultFile:
+				row = json.load(resultFile)
+		else:
+			row = {	'caseID'	: case['caseID'],
+					'status'	: 'failed',
+					'error'		: 'worker exited with code %d' % returnCode }
+		row['elapsedTime'] = format(time.time() - startTime, '0.1f')
+		return row
+
+	def runBatchPipeline(self, manifestPath, outputPath, stages=PIPELINE_STAGES):
+		"""
+		Run every case of a batch manifest (see readBatchManifest) in this process,
+		streamed through the load, crop, affine, bspline & measure stages (see
+		PIPELINE_STAGES & PipelineScheduler) so the next cases are read & cropped
+		while the previous ones register. Rows are written to the outputPath CSV
+		as cases finish. Registrations run the BRAINSFit executable on files, the
+		pyramid mode & registration cache are not used.
+		"""
+		cases = readBatchManifest(manifestPath)
+
+		#Atlases & the BRAINSFit executable are looked up once on the main thread, worker stages only read them
+		atlases = dict((isRight, atlasCache.get(isRight)) for isRight in set(case['side'].lower() == 'right' for case in cases))
+		self.brainsFitPath = slicer.modules.brainsfit.path
+		states = [{	'caseID'	: case['caseID'],
+					'case'		: case,
+					'isRight'	: case['side'].lower() == 'right',
+					'atlas'		: atlases[case['side'].lower() == 'right'] } for case in cases]
+
+		scheduler = PipelineScheduler([dict(stage, run=getattr(self, stage['method'])) for stage in stages])
+		numFailed = [0]
+
+		#Registration stages share the cores, VTK filters of the main thread stages get one share
+		threadBudget.setDemand(min(len(cases), sum(stage['concurrency'] for stage in stages if stage['name'] in ('affine', 'bspline'))))
+		threadBudget.applyGlobal(threadBudget.threadsPerJob())
+		with open(outputPath, 'w') as resultFile:
+			writer = csv.DictWriter(resultFile, BATCH_RESULT_FIELDS, extrasaction='ignore')
+			writer.writeheader()
+
+			def caseFinished(state):
+				if 'workDir' in state:
+					shutil.rmtree(state['workDir'], ignore_errors=True)
+				if state.get('result'):
+					state['result'].update(registrationThreads(state.get('registrationJobs', [])))
+				row = batchResultRow(state['caseID'], state.get('result'), state.get('error'))
+				row['elapsedTime'] = format(time.time() - state['startTime'], '0.1f')
+				writer.writerow(row)
+				resultFile.flush()
+				if row['status'] != 'completed':
+					numFailed[0] += 1
+				logging.info('Batch case %s %s' % (row['caseID'], row['status']))
+
+			try:
+				scheduler.run(states, caseFinished)
+			finally:
+				threadBudget.setDemand(1)
+				threadBudget.applyGlobal(threadBudget.numberOfCores)
+
+		logging.info('Batch completed: %d of %d cases failed' % (numFailed[0], len(cases)))
+		return numFailed[0] == 0
+
+	def pipelineLoad(self, state):
+		"""Worker stage: landmark registration & read of the input voxels around the registered atlas"""
+		case, atlas = state['case'], state['atlas']
+		placedLandmarks = np.array([LandmarkSet.read(case[key]).positions[0] for key in BATCH_LANDMARK_COLUMNS])
+		state['landmarkMatrix'] = fitLandmarkTransform(placedLandmarks, placementPositions(atlas.markups['landmarks']))
+
+		#NRRD volumes are only read inside the bounds of the registered atlas, others are loaded by the crop stage
+		if case['volume'].lower().endswith(('.nrrd', '.nhdr')):
+			corners = transformArray(state['landmarkMatrix'], atlas.cornerPoints())
+			rasBounds = [bound for axis in range(3) for bound in (corners[:, axis].min(), corners[:, axis].max())]
+			try:
+				state['voxels'], state['ijkToRAS'] = readNRRDRegion(case['volume'], rasBounds)
+			except ValueError as error:
+				logging.info('Reading the whole volume, %s' % error)
+
+	def pipelineCrop(self, state):
+		"""Main thread stage: crop the input to the registered atlas ROI and write the registration inputs"""
+		caseScope.begin(state['caseID'])
+		try:
+			atlasVolume, atlasFid = self.loadAtlasNodeAndFiducials(state['isRight'])
+			landmarkTrans = caseScope.reusableNode('vtkMRMLTransformNode', 'LandmarkTransform')
+			setTransformMatrix(landmarkTrans, state['landmarkMatrix'])
+			self.atlasView.hardenTransform(landmarkTrans)
+
+			atlasROI = self.runDefineCropROIVoxel(atlasVolume)
+			if 'voxels' in state:
+				inputVolume = self.volumeFromArray(state.pop('voxels'), state.pop('ijkToRAS'), state['caseID'])
+			else:
+				inputVolume = self.loadWholeVolume(state['case']['volume'], state['caseID'])
+			cropVolume = self.runCropVolume(atlasROI, inputVolume)
+
+			state['atlasPoints']	= fiducialArray(atlasFid)
+			state['workDir']		= tempfile.mkdtemp(prefix='AValuePipeline_')
+			state['fixedVolume']	= os.path.join(state['workDir'], 'fixed.nrrd')
+			state['movingVolume']	= os.path.join(state['workDir'], 'moving.nrrd')
+			for node, path in ((cropVolume, state['fixedVolume']), (atlasVolume, state['movingVolume'])):
+				if not slicer.util.saveNode(node, path):
+					raise IOError('Unable to write ' + path)
+		finally:
+			caseScope.finalize()
+
+	def pipelineAffine(self, state):
+		"""Worker stage: affine registration of the atlas to the cropped input"""
+		state['linearTransform'] = os.path.join(state['workDir'], 'affine.h5')
+		cliParams = self.affineParameters(state['fixedVolume'], state['movingVolume'], state['linearTransform'])
+		state.setdefault('registrationJobs', []).append(self.runBRAINSFitExecutable(cliParams, state['caseID'] + ' affine'))
+
+	def pipelineBSpline(self, state):
+		"""Worker stage: BSpline registration on top of the affine transform"""
+		state['bsplineTransform'] = os.path.join(state['workDir'], 'bspline.h5')
+		cliParams = self.bsplineParameters(	state['fixedVolume'], state['movingVolume'],
+											state['bsplineTransform'], state['linearTransform'] )
+		state.setdefault('registrationJobs', []).append(self.runBRAINSFitExecutable(cliParams, state['caseID'] + ' bspline'))
+
+	def pipelineMeasure(self, state):
+		"""Main thread stage: A-value & CDL estimates from the BSpline transform"""
+		caseScope.begin(state['caseID'])
+		try:
+			loaded, transformNode = slicer.util.loadTransform(state['bsplineTransform'], returnNode=True)
+			if not loaded:
+				raise IOError('Unable to load transform ' + state['bsplineTransform'])
+			caseScope.addNode(transformNode)
+			state['result'] = self.measureAValue(state['caseID'], state['atlasPoints'], [transformNode])
+		finally:
+			caseScope.finalize()
+
+	def runBRAINSFitExecutable(self, cliParams, name='BRAINSFit'):
+		"""
+		Run BRAINSFit on files in a child process within the thread budget, safe to
+		call from worker threads. Returns the thread budget job record.
+		"""
+		with threadBudget.job(name) as budget:
+			args = [self.brainsFitPath, '--numberOfThreads', str(budget['threads'])]
+			for key, value in sorted(cliParams.items()):
+				args += ['--' + key, str(value)]
+			env = dict(os.environ, ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS=str(budget['threads']))
+
+			with tempfile.TemporaryFile() as logFile:
+				process = subprocess.Popen(args, stdout=logFile, stderr=subprocess.STDOUT, env=env)
+				if hasattr(os, 'wait4'):
+					#Resource usage of this child only, other registrations run in parallel
+					pid, status, usage = os.wait4(process.pid, 0)
+					process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+					budget['cpuTime'] = usage.ru_utime + usage.ru_stime
+				else:
+					process.wait()
+				if process.returncode:
+					logFile.seek(0)
+					raise RuntimeError('BRAINSFit exited with code %d: %s' % (process.returncode, logFile.read().strip().splitlines()[-1:]))
+		return budget
+
+
+#
+# Landmark registration
+#
+def transformArray(matrix, points):
+	"""Map N x 3 points through a 4 x 4 homogeneous matrix"""
+	points = np.asarray(points, dtype=float)
+	return points.dot(np.asarray(matrix)[:3, :3].T) + np.asarray(matrix)[:3, 3]
+
+def parseBRAINSFitMetrics(outputText):
+	"""Metric values reported in the BRAINSFit output, in order"""
+	number = r'([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)'
+	values = re.findall(r'(?:metric value|MetricValue)\s*[:=]?\s*' + number, outputText or '', re.IGNORECASE)
+	if not values:
+		#Optimizer observer lines: iteration, metric value, parameters
+		values = re.findall(r'^\s*\d+\s+' + number + r'\s', outputText or '', re.MULTILINE)
+	return [float(value) for value in values]
+
+def parseBRAINSFitMetric(outputText):
+	"""Last metric value reported in the BRAINSFit output, None if there is none"""
+	values = parseBRAINSFitMetrics(outputText)
+	return values[-1] if values else None
+
+def relativeImprovement(previous, current):
+	"""Relative decrease of a minimized metric (ITK metrics, e.g. NC, are minimized)"""
+	return (previous - current) / max(abs(previous), 1e-12)
+
+def landmarkColumn(description):
+	"""Landmark column (see BATCH_LANDMARK_COLUMNS) named by an atlas landmark description, None if unknown"""
+	key = description.lower().replace(' ', '')
+	for column in BATCH_LANDMARK_COLUMNS:
+		if key.startswith(LANDMARK_DESCRIPTIONS[column]):
+			return column
+	return None
+
+def atlasLandmarkNames(landmarks):
+	"""
+	Landmark column of every atlas landmark (LandmarkSet), from its description.
+	Atlases whose descriptions do not name each landmark once are taken to be
+	in the order the landmarks are placed (BATCH_LANDMARK_COLUMNS).
+	"""
+	columns = [landmarkColumn(description) for description in landmarks.descriptions]
+	if len(columns) != len(BATCH_LANDMARK_COLUMNS) or set(columns) != set(BATCH_LANDMARK_COLUMNS):
+		logging.warning('Landmarks %s not named by their descriptions, paired in file order' % landmarks.name)
+		return list(BATCH_LANDMARK_COLUMNS)
+	return columns
+
+def placementPositions(landmarks):
+	"""Positions of the atlas landmarks (LandmarkSet) in the order they are placed (BATCH_LANDMARK_COLUMNS)"""
+	columns = atlasLandmarkNames(landmarks)
+	return landmarks.positions[[columns.index(column) for column in BATCH_LANDMARK_COLUMNS]]
+
+def writeITKTransform(path, matrix):
+	"""
+	Write a 4 x 4 RAS matrix mapping moving to fixed points as an ITK transform
+	file, i.e. as the LPS fixed to moving transform BRAINSFit starts from
+	"""
+	rasToLPS = np.diag([-1.0, -1.0, 1.0, 1.0])
+	itkMatrix = rasToLPS.dot(np.linalg.inv(matrix)).dot(rasToLPS)
+	with open(path, 'w') as transformFile:
+		transformFile.write('#Insight Transform File V1.0\n#Transform 0\n')
+		transformFile.write('Transform: AffineTransform_double_3_3\n')
+		transformFile.write('Parameters: %s\n' % ' '.join(repr(float(value)) for value in
+														list(itkMatrix[:3, :3].ravel()) + list(itkMatrix[:3, 3])))
+		transformFile.write('FixedParameters: 0 0 0\n')
+
+def fuseAtlasPositions(positions, weights=None, method='median'):
+	"""
+	Fuse the A x P x 3 fiducial positions registered from A atlases, by their
+	coordinate-wise median or weighted mean (equal weights by default).
+	Returns the P x 3 fused positions and the RMS distance of the atlases to them.
+	"""
+	positions = np.asarray(positions, dtype=float)
+	if method == 'median':
+		fused = np.median(positions, axis=0)
+	elif method == 'weighted':
+		weights = np.ones(len(positions)) if weights is None else np.asarray(weights, dtype=float)
+		fused = np.einsum('a,api->pi', weights, positions) / weights.sum()
+	else:
+		raise ValueError('Unknown atlas fusion method %s' % method)
+	spread = np.sqrt(((positions - fused) ** 2).sum(axis=2).mean(axis=0))
+	return fused, spread
+
+
+
+#
+# Atlas cache
+#
+class CachedAtlas(object):
+	"""Decoded atlas image data & landmark arrays of one side, read once from disk"""
+
+	def __init__(self, isRight):
+		volumeFile, fiducialFile, landmarkFile = ATLAS_FILES[isRight]
+
+		loaded, volumeNode = slicer.util.loadVolume(os.path.join(MODULE_DIR, volumeFile), returnNode=True)
+		if not loaded:
+			raise IOError('Unable to load atlas ' + volumeFile)
+		self.name		= volumeNode.GetName()
+		self.imageData	= vtk.vtkImageData()
+		self.imageData.DeepCopy(volumeNode.GetImageData())
+		self.ijkToRAS	= vtk.vtkMatrix4x4()
+		volumeNode.GetIJKToRASMatrix(self.ijkToRAS)
+		slicer.mrmlScene.RemoveNode(volumeNode)
+
+		self.markups = {	'fiducials'	: LandmarkSet.read(os.path.join(MODULE_DIR, fiducialFile)),
+							'landmarks'	: LandmarkSet.read(os.path.join(MODULE_DIR, landmarkFile)) }
+
+	def memorySize(self):
+		return self.imageData.GetActualMemorySize() * 1024
+
+	def cornerPoints(self):
+		"""8 x 3 RAS positions of the atlas corner voxels"""
+		dimensions = self.imageData.GetDimensions()
+		return np.array([self.ijkToRAS.MultiplyPoint([i, j, k, 1])[:3] for i in (0, dimensions[0] - 1)
+							for j in (0, dimensions[1] - 1) for k in (0, dimensions[2] - 1)])
+
+	def createVolumeNode(self):
+		"""Add a new atlas volume node to the scene sharing the decoded (read-only) voxels"""
+		volumeNode = slicer.vtkMRMLScalarVolumeNode()
+		volumeNode.SetName(slicer.mrmlScene.GenerateUniqueName(self.name))
+		volumeNode.SetIJKToRASMatrix(self.ijkToRAS)
+		volumeNode.SetAndObserveImageData(self.imageData)
+		slicer.mrmlScene.AddNode(volumeNode)
+		volumeNode.CreateDefaultDisplayNodes()
+		return volumeNode
+
+	def createFiducialNode(self, kind):
+		"""Add a new markups node holding the cached 'fiducials' or 'landmarks'"""
+		return self.markups[kind].createNode()
+
+def readAtlasSet(path=None):
+	"""
+	Atlases of the multi-atlas mode by side (isRight), lists of dicts with the
+	name, volume, fiducials & landmarks files and the fusion weight. path is a
+	JSON file {"right": [...], "left": [...]} of atlases with the file keys &
+	optional name & weight, files relative to it. Without path every side has
+	its shipped atlas only.
+	"""
+	if path is None:
+		atlasSet = dict((isRight, [dict(zip(('volume', 'fiducials', 'landmarks'), files))])
+						for isRight, files in ATLAS_FILES.items())
+		baseDir = MODULE_DIR
+	else:
+		with open(path) as atlasSetFile:
+			sides = json.load(atlasSetFile)
+		atlasSet = {True: sides.get('right', []), False: sides.get('left', [])}
+		baseDir = os.path.dirname(os.path.abspath(path))
+
+	for isRight, atlases in atlasSet.items():
+		for index, atlas in enumerate(atlases):
+			for key in ('volume', 'fiducials', 'landmarks'):
+				atlas[key] = os.path.join(baseDir, atlas[key])
+			atlas['name']	= '%d_%s' % (index, atlas.get('name', os.path.splitext(os.path.basename(atlas['volume']))[0]))
+			atlas['weight']	= float(atlas.get('weight', 1.0))
+	return atlasSet
+
+class AtlasView(object):
+	"""
+	Per-case handle on a cached atlas. The volume node shares the master voxels
+	until they have to be resampled, the fiducial node is a fresh copy of the
+	master arrays, so transforms can be hardened without touching the master.
+	"""
+
+	def __init__(self, atlas):
+		self.atlas			= atlas
+		self.volumeNode		= atlas.createVolumeNode()
+		self.fiducialNode	= atlas.createFiducialNode('fiducials')
+
+	def isShared(self):
+		return self.volumeNode.GetImageData() is self.atlas.imageData
+
+	def hardenTransform(self, transformNode):
+		with stageTrace.span('harden', [self.volumeNode]):
+			for node in (self.volumeNode, self.fiducialNode):
+				hardenCopyOnWrite(node, transformNode)
+
+def hardenCopyOnWrite(node, transformNode):
+	"""
+	Harden transformNode on node. Linear transforms only update the volume
+	geometry, other transforms resample the voxels so volumes sharing cached
+	atlas voxels get their own copy first.
+	"""
+	if node.IsA('vtkMRMLVolumeNode') and not transformNode.IsTransformToWorldLinear() \
+			and atlasCache.isShared(node.GetImageData()):
+		imageData = vtk.vtkImageData()
+		imageData.DeepCopy(node.GetImageData())
+		node.SetAndObserveImageData(imageData)
+	node.SetAndObserveTransformNodeID(transformNode.GetID())
+	slicer.vtkSlicerTransformLogic().hardenTransform(node)
+
+class AtlasCache(object):
+	"""
+	Process-wide cache of decoded atlases keyed by laterality & the modification
+	time of the atlas files. Least recently used atlases are evicted once the
+	cached image data exceeds maxBytes.
+	"""
+
+	def __init__(self, maxBytes=2 * 1024**3):
+		self.maxBytes	= maxBytes
+		self.entries	= collections.OrderedDict() #oldest first
+
+	def key(self, isRight):
+		return (isRight,) + tuple(os.path.getmtime(os.path.join(MODULE_DIR, fileName))
+									for fileName in ATLAS_FILES[isRight])
+
+	def get(self, isRight):
+		key = self.key(isRight)
+		atlas = self.entries.pop(key, None)
+		if atlas is None:
+			#Drop outdated copies of this side before reading it again
+			for staleKey in [k for k in self.entries if k[0] == isRight]:
+				del self.entries[staleKey]
+			atlas = CachedAtlas(isRight)
+		self.entries[key] = atlas
+		self.evict()
+		return atlas
+
+	def evict(self):
+		#Always keep the most recently used atlas
+		while len(self.entries) > 1 and sum(atlas.memorySize() for atlas in self.entries.values()) > self.maxBytes:
+			self.entries.popitem(last=False)
+
+	def isShared(self, imageData):
+		return self.identity(imageData) is not None
+
+	def identity(self, imageData):
+		"""Cache key (laterality & file times) of the atlas owning imageData, None if not an atlas"""
+		for key, atlas in self.entries.items():
+			if atlas.imageData is imageData:
+				return key
+		return None
+
+	def clear(self):
+		self.entries.clear()
+
+atlasCache = AtlasCache()
+
+
+#
+# Stage tracing
+#
+#Set STAGE_TRACE_FILE to record the stage trace of every case, STAGE_TRACE_MEMORY to record memory use as well
+stageTrace = StageTrace('AValue3DSlicerModule', os.environ.get('STAGE_TRACE_FILE'), bool(os.environ.get('STAGE_TRACE_MEMORY')))
+
+
+#
+# Case node lifecycle
+#
+class CaseNodeScope(object):
+	"""
+	MRML nodes created while processing one case. Transform, parameter & ROI nodes
+	are pooled by role and reused by the following cases, every other node added
+	through the scope is removed from the scene when the case is finalized.
+	"""
 
+	def __init__(self):
+		self.caseID	= None
+		self.nodes	= []
+		self.pool	= {}
+		self.owner	= None
+
+	def begin(self, caseID=None):
+		"""Finalize the current case (if any) and start a new one"""
+		if self.nodes or self.caseID is not None:
+			self.finalize()
+		self.caseID = caseID
+
+	def addNode(self, node):
+		"""Add node to the scene (if not already there), it is removed when the case is finalized"""
+		if node is None:
+			return None
+		if not slicer.mrmlScene.IsNodePresent(node):
+			slicer.mrmlScene.AddNode(node)
+		if node not in self.nodes:
+			self.nodes.append(node)
+		return node
+
+	def keep(self, node):
+		"""Stop tracking node, e.g. a result that must outlive the case"""
+		if node in self.nodes:
+			self.nodes.remove(node)
+		return node
+
+	def detach(self):
+		"""
+		Hand the nodes of the current case over to a new scope & start an empty case.
+		The pooled nodes go with it, so a registration still running on them is not
+		disturbed by the next case; they return to the pool when the scope is finalized.
+		"""
+		scope = CaseNodeScope()
+		scope.caseID, scope.nodes, scope.pool = self.caseID, self.nodes, self.pool
+		scope.owner = self
+		self.caseID, self.nodes, self.pool = None, [], {}
+		return scope
+
+	def reusableNode(self, className, role):
+		"""Pooled node of className for role, created on first use & reset when the case is finalized"""
+		node = self.pool.get(role)
+		if node is None or not node.IsA(className) or not slicer.mrmlScene.IsNodePresent(node):
+			node = getattr(slicer, className)()
+			node.SetName(role)
+			slicer.mrmlScene.AddNode(node)
+			self.pool[role] = node
+		return node
+
+	def memoryReport(self):
+		"""Number of scene nodes held by the case & memory (MB) of the image data it owns"""
+		nodes = [node for node in self.nodes + list(self.pool.values()) if slicer.mrmlScene.IsNodePresent(node)]
+		imageKB = 0
+		for node in nodes:
+			imageData = node.GetImageData() if node.IsA('vtkMRMLVolumeNode') else None
+			if imageData is not None and not atlasCache.isShared(imageData):
+				imageKB += imageData.GetActualMemorySize()
+		return {	'caseID'			: self.caseID,
+					'numberOfNodes'		: len(nodes),
+					'imageMemoryMB'		: imageKB / 1024.0,
+					'sceneNodes'		: slicer.mrmlScene.GetNumberOfNodes() }
+
+	def finalize(self):
+		"""Remove the nodes of the case from the scene, reset the pooled nodes & return the memory report"""
+		report = self.memoryReport()
+		numberOfFreed = len(self.nodes)
+		for node in reversed(self.nodes):
+			dependents = []
+			if node.IsA('vtkMRMLDisplayableNode'):
+				dependents += [node.GetNthDisplayNode(index) for index in range(node.GetNumberOfDisplayNodes())]
+			if node.IsA('vtkMRMLStorableNode'):
+				dependents.append(node.GetStorageNode())
+			for dependent in [node] + dependents:
+				if dependent is not None and slicer.mrmlScene.IsNodePresent(dependent):
+					slicer.mrmlScene.RemoveNode(dependent)
+		self.nodes = []
+
+		for node in self.pool.values():
+			if not slicer.mrmlScene.IsNodePresent(node):
+				continue
+			if node.IsA('vtkMRMLTransformNode'):
+				node.SetMatrixTransformToParent(vtk.vtkMatrix4x4())
+			elif node.IsA('vtkMRMLCropVolumeParametersNode'):
+				node.SetInputVolumeNodeID(None)
+				node.SetOutputVolumeNodeID(None)
+				node.SetROINodeID(None)
+			elif node.IsA('vtkMRMLAnnotationROINode'):
+				node.SetDisplayVisibility(0)
+
+		#Detached scope, pooled nodes the owner has not replaced meanwhile go back to its pool
+		if self.owner is not None:
+			for role, node in self.pool.items():
+				if not slicer.mrmlScene.IsNodePresent(node):
+					continue
+				pooled = self.owner.pool.get(role)
+				if pooled is None or not slicer.mrmlScene.IsNodePresent(pooled):
+					self.owner.pool[role] = node
+				else:
+					slicer.mrmlScene.RemoveNode(node)
+			self.pool = {}
+
+		logging.info('Finalized case %s: freed %d nodes, %0.1f MB of image data (%d nodes left in scene)'
+					% (report['caseID'], numberOfFreed, report['imageMemoryMB'],
+					   slicer.mrmlScene.GetNumberOfNodes()))
+		self.caseID = None
+		return report
+
+caseScope = CaseNodeScope()
+
+
+#
+# Registration cache
+#
+def registrationOutputKey(cliParams):
+	return 'bsplineTransform' if 'bsplineTransform' in cliParams else 'linearTransform'
+
+class RegistrationCache(object):
+	"""
+	On-disk cache of BRAINSFit output transforms keyed by a hash of the fixed
+	voxels, the moving atlas identity, the initial transform & the registration
+	parameters. Least recently used transforms are deleted past maxBytes.
+	"""
+
+	def __init__(self, cacheDir=None, maxBytes=512 * 1024**2):
+		self.cacheDir = cacheDir
+		self.maxBytes = maxBytes
+
+	def directory(self):
+		if self.cacheDir is None:
+			self.cacheDir = os.path.join(slicer.app.temporaryPath, 'AValueRegistrationCache')
+		if not os.path.isdir(self.cacheDir):
+			os.makedirs(self.cacheDir)
+		return self.cacheDir
+
+	def path(self, key):
+		return os.path.join(self.directory(), key + '.h5')
+
+	def key(self, cliParams, pyramidLevels=None, initialTrans=None):
+		"""Return the cache key of a registration, None if an input cannot be hashed"""
+		digest = hashlib.sha1()
+		outputKey = registrationOutputKey(cliParams)
+		for name in sorted(cliParams):
+			value = cliParams[name]
+			node = slicer.mrmlScene.GetNodeByID(value) if isinstance(value, str) else None
+			if name == outputKey:
+				digest.update(('%s=output;' % name).encode('utf-8'))
+			elif node is None:
+				digest.update(('%s=%r;' % (name, value)).encode('utf-8'))
+			elif not self.hashNode(digest, name, node):
+				return None
+		digest.update(json.dumps(pyramidLevels, sort_keys=True).encode('utf-8'))
+		if initialTrans is not None and not self.hashNode(digest, 'initialTrans', initialTrans):
+			return None
+		return digest.hexdigest()
+
+	def hashNode(self, digest, name, node):
+		"""Add the content of a volume or linear transform node to digest"""
+		matrix = vtk.vtkMatrix4x4()
+		if node.IsA('vtkMRMLVolumeNode'):
+			node.GetIJKToRASMatrix(matrix)
+			imageData = node.GetImageData()
+			atlasKey = atlasCache.identity(imageData)
+			if atlasKey is not None:
+				contents = [repr(atlasKey)] #Cached atlas voxels are identified by their files
+			else:
+				contents = [repr(imageData.GetDimensions()), imageData.GetScalarTypeAsString()]
+				digest.update(np.ascontiguousarray(vtk_to_numpy(imageData.GetPointData().GetScalars())))
+		elif node.IsA('vtkMRMLTransformNode') and node.IsTransformToWorldLinear():
+			node.GetMatrixTransformToWorld(matrix)
+			contents = []
+		else:
+			return False
+		contents += [repr(matrix.GetElement(row, column)) for row in range(4) for column in range(4)]
+		digest.update(('%s=%s;' % (name, ','.join(contents))).encode('utf-8'))
 		return True
 
+	def contains(self, key):
+		return os.path.exists(self.path(key))
+
+	def load(self, key, outputTrans):
+		"""Copy the cached transform into outputTrans, returns False on a cache miss"""
+		path = self.path(key)
+		if not os.path.exists(path):
+			return False
+		loaded, cachedTrans = slicer.util.loadTransform(path, returnNode=True)
+		if not loaded:
+			return False
+		transform = cachedTrans.GetTransformToParent().MakeTransform()
+		transform.DeepCopy(cachedTrans.GetTransformToParent())
+		outputTrans.SetAndObserveTransformToParent(transform)
+		slicer.mrmlScene.RemoveNode(cachedTrans)
+		os.utime(path, None) #mark as recently used
+		return True
+
+	def store(self, key, outputTrans):
+		slicer.util.saveNode(outputTrans, self.path(key))
+		self.evict()
+
+	def evict(self):
+		cachedFiles = sorted((os.path.getmtime(path), os.path.getsize(path), path)
+							 for path in glob.glob(os.path.join(self.directory(), '*.h5')))
+		totalBytes = sum(size for mtime, size, path in cachedFiles)
+		while cachedFiles and totalBytes > self.maxBytes:
+			mtime, size, path = cachedFiles.pop(0)
+			os.remove(path)
+			totalBytes -= size
+
+	def clear(self):
+		for path in glob.glob(os.path.join(self.directory(), '*.h5')):
+			os.remove(path)
+
+registrationCache = RegistrationCache()
+
+
+#
+# Thread budget
+#
+class ThreadBudget(object):
+	"""
+	Splits the cores between the registrations running at once, so concurrent
+	BRAINSFit runs do not oversubscribe the machine. A new registration gets the
+	cores divided by the larger of the number of registrations running and the
+	expected queue depth (setDemand). Finished jobs record their achieved CPU
+	utilization, CPU time / (wall time x threads).
+	"""
+
+	def __init__(self, numberOfCores=None):
+		self.numberOfCores	= numberOfCores or cpu_count()
+		self.demand			= 1
+		self.running		= 0
+		self.jobs			= []
+		self.lock			= threading.Lock()
+
+	def setDemand(self, numberOfJobs):
+		"""Number of registrations expected to run at once, e.g. the worker or stage slots"""
+		self.demand = max(1, numberOfJobs)
+
+	def threadsPerJob(self, numberOfJobs=None):
+		if numberOfJobs is None:
+			numberOfJobs = max(self.running, self.demand)
+		return max(1, self.numberOfCores // max(1, numberOfJobs))
+
+	def applyGlobal(self, numberOfThreads):
+		"""Limit the VTK filters of this process & ITK in the CLI processes it starts"""
+		vtk.vtkMultiThreader.SetGlobalMaximumNumberOfThreads(numberOfThreads)
+		os.environ['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'] = str(numberOfThreads)
+
+	@contextlib.contextmanager
+	def job(self, name):
+		"""
+		Account the enclosed registration as running. Yields the job record, its
+		'threads' is the budget to pass on. Callers that know the CPU time of the
+		job set 'cpuTime', otherwise the CPU time of reaped child processes is used.
+		"""
+		with self.lock:
+			self.running += 1
+			record = {'name': name, 'threads': self.threadsPerJob(), 'cpuTime': None}
+		startTimes, startWall = os.times(), time.time()
+		try:
+			yield record
+		finally:
+			endTimes = os.times()
+			record['wallTime'] = time.time() - startWall
+			if record['cpuTime'] is None and os.name != 'nt': #Child times are not reported on Windows
+				record['cpuTime'] = endTimes[2] + endTimes[3] - startTimes[2] - startTimes[3]
+			record['cpuUtilization'] = jobsUtilization([record])
+			with self.lock:
+				self.running -= 1
+				self.jobs.append(record)
+			logging.info('%s ran on %d threads, CPU utilization %s' % (name, record['threads'], record['cpuUtilization']))
+
+def jobsUtilization(jobs):
+	"""Achieved CPU utilization of finished thread budget jobs, None if not measured"""
+	jobs = [job for job in jobs if job['cpuTime'] is not None]
+	budget = sum(job['wallTime'] * job['threads'] for job in jobs)
+	return round(sum(job['cpuTime'] for job in jobs) / budget, 3) if budget > 0 else None
+
+#Set AVALUE_NUMBER_OF_CORES to share fewer cores than the machine has between the registrations
+threadBudget = ThreadBudget(int(os.environ.get('AVALUE_NUMBER_OF_CORES', 0)) or None)
+
+
+#
+# Background registration jobs
+#
+class RegistrationJob(object):
+	"""
+	Handle of a registration running step by step. steps is a generator yielding
+	the CLI nodes it starts, it is resumed once each of them completes so CLI
+	modules started without waiting do not block the UI. Progress callbacks get
+	the job while a CLI module runs, completion callbacks once the job is
+	Completed, Failed or Cancelled.
+	"""
+
+	def __init__(self, name, numberOfSteps=1):
+		self.name				= name
+		self.numberOfSteps		= numberOfSteps
+		self.completedSteps		= 0
+		self.status				= 'Scheduled'
+		self.result				= None
+		self.error				= None
+		self.steps				= None
+		self.cliNode			= None
+		self.observer			= None
+		self.preview			= None
+		self.callbacks			= []
+		self.progressCallbacks	= []
+		self.previewCallbacks	= []
+
+	def isDone(self):
+		return self.status in ('Completed', 'Failed', 'Cancelled')
+
+	def progress(self):
+		"""Fraction of the job done, from 0 to 1"""
+		if self.status == 'Completed':
+			return 1.0
+		current = self.cliNode.GetProgress() / 100.0 if self.cliNode is not None else 0
+		return min(1.0, (self.completedSteps + current) / float(self.numberOfSteps))
+
+	def addCallback(self, callback):
+		"""Call callback(job) when the job is done, right away if it already is"""
+		if self.isDone():
+			callback(self)
+		else:
+			self.callbacks.append(callback)
+
+	def addProgressCallback(self, callback):
+		self.progressCallbacks.append(callback)
+
+	def addPreviewCallback(self, callback):
+		"""Call callback(job) once a provisional result is set as job.preview"""
+		self.previewCallbacks.append(callback)
+
+	def setPreview(self, preview):
+		self.preview = preview
+		for callback in self.previewCallbacks:
+			try:
+				callback(self)
+			except Exception:
+				logging.exception('Registration job %s preview callback failed' % self.name)
+
+	def start(self, steps):
+		self.steps	= steps
+		self.status	= 'Running'
+		self.resume()
+		return self
+
+	def cancel(self):
+		if self.isDone():
+			return
+		if self.cliNode is not None and self.cliNode.IsBusy():
+			self.cliNode.Cancel() #Job is finished once the CLI module reports it was cancelled
+		else:
+			self.finish('Cancelled')
+
+	def resume(self):
+		"""Run the steps up to the next CLI module still running"""
+		while True:
+			try:
+				cliNode = next(self.steps)
+			except StopIteration:
+				self.finish('Completed')
+				return
+			except Exception as e:
+				logging.exception('Registration job %s failed' % self.name)
+				self.finish('Failed', str(e))
+				return
+			if cliNode.IsBusy():
+				self.cliNode	= cliNode
+				self.observer	= cliNode.AddObserver('ModifiedEvent', self.onCLIModified)
+				return
+			if not self.stepCompleted(cliNode):
+				return
+
+	def onCLIModified(self, cliNode, event):
+		if cliNode.IsBusy():
+			for callback in self.progressCallbacks:
+				callback(self)
+			return
+		cliNode.RemoveObserver(self.observer)
+		self.cliNode, self.observer = None, None
+		if self.stepCompleted(cliNode):
+			self.resume()
+
+	def stepCompleted(self, cliNode):
+		"""Count a finished CLI module, finish the job if it did not complete"""
+		status = cliNode.GetStatusString()
+		if status == 'Completed':
+			self.completedSteps += 1
+			return True
+		self.finish('Cancelled' if status == 'Cancelled' else 'Failed', '%s %s' % (cliNode.GetName(), status))
+		return False
+
+	def finish(self, status, error=None):
+		self.status, self.error = status, error
+		self.steps.close()
+		logging.info('Registration job %s %s' % (self.name, status))
+		callbacks, self.callbacks = self.callbacks, []
+		for callback in callbacks:
+			try:
+				callback(self)
+			except Exception:
+				logging.exception('Registration job %s callback failed' % self.name)
+
+
+#
+# Pipeline scheduler
+#
+class PipelineScheduler(object):
+	"""
+	Streams cases through a chain of stages, each a dict with name, run(state),
+	thread ('worker' or 'main'), concurrency & queueSize (see PIPELINE_STAGES).
+	A stage works on at most concurrency cases taken from a queue of at most
+	queueSize cases. A case that finished a stage keeps its slot until the next
+	queue has room, so slow stages hold back the earlier ones and at most
+	sum(concurrency + queueSize) cases are in memory. Worker stages run in a
+	thread pool, main stages on the calling thread. run(state) reads & adds to
+	the per-case state dict, an exception fails the case.
+	"""
+
+	def __init__(self, stages):
+		self.stages = stages
+
+	def run(self, states, finished):
+		"""Push every state through the stages, finished(state) is called on the calling thread as cases leave"""
+		lastStage	= len(self.stages) - 1
+		pending		= collections.deque(states)
+		queues		= [collections.deque() for stage in self.stages]
+		blocked		= [collections.deque() for stage in self.stages]
+		running		= [0] * len(self.stages)
+		completions	= Queue.Queue()
+		pool = ThreadPool(max(1, sum(stage['concurrency'] for stage in self.stages if stage['thread'] == 'worker')))
+		inFlight = 0
+		try:
+			while pending or inFlight:
+				progressed = False
+
+				#Hand cases on to the next stage while its queue has room, last stage first
+				for index in reversed(range(lastStage)):
+					while blocked[index] and len(queues[index + 1]) < self.stages[index + 1]['queueSize']:
+						queues[index + 1].append(blocked[index].popleft())
+						progressed = True
+
+				while pending and len(queues[0]) < self.stages[0]['queueSize']:
+					state = pending.popleft()
+					state['startTime'] = time.time()
+					queues[0].append(state)
+					inFlight += 1
+					progressed = True
+
+				#Start queued cases on the free slots
+				for index, stage in enumerate(self.stages):
+					while queues[index] and running[index] + len(blocked[index]) < stage['concurrency']:
+						state = queues[index].popleft()
+						running[index] += 1
+						progressed = True
+						if stage['thread'] == 'worker':
+							pool.apply_async(self.runStage, (index, state), callback=completions.put)
+						else:
+							completions.put(self.runStage(index, state))
+
+				#Wait for a worker only when nothing else could move
+				block = not progressed
+				while True:
+					try:
+						index, state, record = completions.get(block)
+					except Queue.Empty:
+						break
+					block = False
+					running[index] -= 1
+					if record is not None:
+						stageTrace.write(record)
+					if state.get('error') or index == lastStage:
+						inFlight -= 1
+						finished(state)
+					else:
+						blocked[index].append(state)
+		finally:
+			pool.close()
+			pool.join()
+
+	def runStage(self, index, state):
+		"""Run one stage of a case, returns (index, state, trace record of a worker stage)"""
+		stage = self.stages[index]
+		record = None
+		try:
+			if stage['thread'] == 'main':
+				stageTrace.beginCase(state['caseID'])
+				with stageTrace.span(stage['name']):
+					stage['run'](state)
+			else:
+				#Worker spans are written by the calling thread, the trace stack belongs to the main thread
+				record = {	'module'	: stageTrace.module,
+							'caseID'	: state['caseID'],
+							'stage'		: stage['name'],
+							'parent'	: None,
+							'depth'		: 0,
+							'pid'		: os.getpid(),
+							'status'	: 'failed',
+							'start'		: time.time() }
+				stage['run'](state)
+				record['status'] = 'completed'
+		except Exception as e:
+			logging.exception('Pipeline stage %s of case %s failed' % (stage['name'], state['caseID']))
+			state['error'] = '%s: %s' % (stage['name'], e)
+		if record is not None:
+			record['wallTime'] = time.time() - record['start']
+		return index, state, record
+
+
+#Batch processing helpers
+def readBatchManifest(manifestPath):
+	"""
+	Read a batch manifest CSV with the columns caseID, volume, side (left/right)
+	and one single-fiducial .fcsv file per landmark: OW, CN, A, RW.
+	Relative paths are resolved against the folder of the manifest.
+	"""
+	baseDir = os.path.dirname(os.path.abspath(manifestPath))
+	cases = []
+	with open(manifestPath) as manifestFile:
+		for row in csv.DictReader(manifestFile):
+			case = dict((key.strip(), value.strip()) for key, value in row.items())
+			for key in ['volume'] + BATCH_LANDMARK_COLUMNS:
+				case[key] = os.path.join(baseDir, case[key])
+			if case['side'].lower() not in ('left', 'right'):
+				raise ValueError('Case %s: side must be left or right' % case['caseID'])
+			cases.append(case)
+	return cases
+
+def resultSummary(result):
+	"""One line summary of the A-value & CDL estimates of a result"""
+	return 'A-value %0.1f mm, CDL(oc)-1 %0.1f mm, CDL(oc)-2 %0.1f mm, CDL(lw)-1 %0.1f mm' % (
+			result['aValue'], result['cdlAlexiadesOC'], result['cdlKochOC'], result['cdlKochLW'] )
+
+def registrationThreads(jobs):
+	"""Thread budget & achieved CPU utilization of the registrations of a case"""
+	return {	'threads'			: max([job['threads'] for job in jobs] or [None]),
+				'cpuUtilization'	: jobsUtilization(jobs) }
+
+def batchResultRow(caseID, result=None, error=None):
+	"""Batch result file row of a case, failed unless result holds its A-value"""
+	row = {'caseID': caseID}
+	if result:
+		row.update(result)
+		for key in ('roundWindow', 'lateralWall'):
+			row[key] = ' '.join(format(coord, '0.4f') for coord in result[key])
+		row['status'] = 'completed'
+	else:
+		row.update({'status': 'failed', 'error': error or 'A-value calculation failed'})
+	return row
+
+def runBatchCase(casePath, resultPath):
+	"""Entry point executed inside a batch worker process"""
+
+	with open(casePath) as caseFile:
+		case = json.load(caseFile)
+	if case.get('tracePath'):
+		stageTrace.tracePath = case['tracePath']
+	stageTrace.recordMemory = case.get('memoryInstrumentation', False)
+	if case.get('numberOfThreads'):
+		#The worker owns its share of the cores, registrations of the case run one at a time
+		threadBudget.numberOfCores = case['numberOfThreads']
+		threadBudget.applyGlobal(case['numberOfThreads'])
+
+	try:
+		logic = AValue3DSlicerModuleLogic()
+		logic.adaptiveStopping = ADAPTIVE_STOPPING if case.get('adaptiveStopping') else None
+		logic.tightROI = TIGHT_ROI if case.get('tightROI') else None
+		result = logic.runCase(case)
+		if not result:
+			raise RuntimeError('A-value calculation failed')
+		row = batchResultRow(case['caseID'], result)
+	except Exception as e:
+		logging.error('Batch case %s failed: %s' % (case['caseID'], e))
+		row = batchResultRow(case['caseID'], error=str(e))
+
+	with open(resultPath, 'w') as resultFile:
+		json.dump(row, resultFile)
+
 
 class AValue3DSlicerModuleTest(ScriptedLoadableModuleTest):
   """
@@ -682,6 +2398,17 @@ class AValue3DSlicerModuleTest(ScriptedLoadableModuleTest):
 	"""
 	self.setUp()
 	self.test_AValue3DSlicerModule1()
+	self.test_fitLandmarkTransform()
+	self.test_computeAValues()
+	self.test_fitROIToForeground()
+	self.test_bsplineBulkTransform()
+	self.test_readNRRDRegion()
+	self.test_landmarkSetFiles()
+	self.test_pipelineScheduler()
+	self.test_fuseAtlasPositions()
+	self.test_parseBRAINSFitMetric()
+	self.test_registrationCacheKey()
+	self.test_atlasCacheEvict()
 
   def test_AValue3DSlicerModule1(self):
 	""" Ideally you should have several levels of tests.  At the lowest level
@@ -718,3 +2445,333 @@ class AValue3DSlicerModuleTest(ScriptedLoadableModuleTest):
 	logic = AValue3DSlicerModuleLogic()
 	self.assertIsNotNone( logic.hasImageData(volumeNode) )
 	self.delayDisplay('Test passed!')
+
+  def test_fitLandmarkTransform(self):
+	""" Landmark registration recovers a known rigid transform, also when
+	several landmark sets with skipped landmarks are solved in one call
+	"""
+	self.delayDisplay("Starting the landmark registration test")
+
+	angle		= math.radians(30)
+	rotation	= np.array([[math.cos(angle), -math.sin(angle), 0],
+							[math.sin(angle),  math.cos(angle), 0],
+							[0, 0, 1]])
+	moving		= np.array([[28.26, -2.09, 15.13], [22.89, -0.08, 15.57],
+							[24.80,  2.96, 14.83], [26.84, -2.43, 11.68]])
+	fixed		= moving.dot(rotation.T) + [5, -3, 2]
+
+	matrix = fitLandmarkTransform(fixed, moving)
+	self.assertTrue(np.allclose(matrix[:3, :3], rotation))
+	self.assertTrue(np.allclose(matrix[:3, 3], [5, -3, 2]))
+
+	#second landmark of the second set is off and masked out
+	corrupted = fixed.copy()
+	corrupted[1] += 10
+	matrices = fitLandmarkTransform([fixed, corrupted], [moving, moving], mask=[[1,1,1,1], [1,0,1,1]])
+	self.assertTrue(np.allclose(matrices, matrix))
+	self.delayDisplay('Test passed!')
+
+  def test_computeAValues(self):
+	""" Cohort A-values & CDL estimates match the single case formulas and
+	registered estimators are computed with them
+	"""
+	self.delayDisplay("Starting the cohort A-value test")
+
+	positions = np.array([[[26.59, -2.55, 11.72], [22.08, 1.93, 17.96]],
+						  [[0, 0, 0], [3, 4, 0]]])
+	results = computeAValues(positions)
+	self.assertTrue(np.allclose(results['aValue'][1], 5.0))
+	self.assertTrue(np.allclose(results['cdlAlexiadesOC'], 4.16 * results['aValue'] - 4))
+	self.assertTrue(np.allclose(results['cdlKochLW'], 3.86 * results['aValue'] + 4.99))
+
+	estimators = collections.OrderedDict([('doubled', lambda aValue: 2 * aValue)])
+	self.assertEqual(list(computeAValues(positions, estimators)), ['aValue', 'doubled'])
+	self.assertEqual(cohortStatistics(results)['aValue']['count'], 2)
+	self.delayDisplay('Test passed!')
+
+  def test_fitROIToForeground(self):
+	""" The tight ROI encloses the foreground voxels plus the margin and the
+	voxels it crops by index range
+	"""
+	self.delayDisplay("Starting the tight ROI test")
+
+	imageData = vtk.vtkImageData()
+	imageData.SetDimensions(30, 20, 10)
+	imageData.AllocateScalars(vtk.VTK_SHORT, 1)
+	voxels = vtk_to_numpy(imageData.GetPointData().GetScalars()).reshape(10, 20, 30)
+	voxels[:] = 0
+	voxels[3:6, 5:9, 10:20] = 1000
+	self.assertEqual(maskBoundingBox(voxels >= otsuThreshold(voxels)), [(10, 20), (5, 9), (3, 6)])
+	self.assertIsNone(maskBoundingBox(voxels > 1000))
+
+	volume = slicer.vtkMRMLScalarVolumeNode()
+	volume.SetSpacing(0.5, 0.5, 0.5)
+	volume.SetAndObserveImageData(imageData)
+	slicer.mrmlScene.AddNode(volume)
+	roi = slicer.vtkMRMLAnnotationROINode()
+	slicer.mrmlScene.AddNode(roi)
+
+	fitROIToForeground(roi, volume, margin=1.0)
+	self.assertEqual(voxelCropRange(roi, volume), [(8, 22), (3, 11), (1, 8)])
+	self.delayDisplay('Test passed!')
+
+  def test_bsplineBulkTransform(self):
+	""" The BSpline transform written by BRAINSFit contains the affine initial
+	transform as bulk transform, measureAValue evaluates the BSpline output only
+	"""
+	self.delayDisplay("Starting the BSpline bulk transform test")
+
+	#Two blobs, so the registration has a unique solution
+	imageData = vtk.vtkImageData()
+	imageData.SetDimensions(40, 40, 40)
+	imageData.AllocateScalars(vtk.VTK_SHORT, 1)
+	voxels = vtk_to_numpy(imageData.GetPointData().GetScalars()).reshape(40, 40, 40)
+	k, j, i = np.mgrid[0:40, 0:40, 0:40]
+	voxels[:] = 1000 * np.exp(-((i - 16) ** 2 + (j - 18) ** 2 + (k - 20) ** 2) / 40.0) + \
+				600 * np.exp(-((i - 26) ** 2 + (j - 24) ** 2 + (k - 18) ** 2) / 20.0)
+	fixedVolume, movingVolume = slicer.vtkMRMLScalarVolumeNode(), slicer.vtkMRMLScalarVolumeNode()
+	for volume in (fixedVolume, movingVolume):
+		volume.SetAndObserveImageData(imageData)
+		slicer.mrmlScene.AddNode(volume)
+
+	affineMatrix = np.identity(4)
+	affineMatrix[:3, 3] = [3.0, -2.0, 1.5]
+	linearTrans = slicer.vtkMRMLTransformNode()
+	slicer.mrmlScene.AddNode(linearTrans)
+	setTransformMatrix(linearTrans, affineMatrix)
+	bsplineTrans = slicer.vtkMRMLBSplineTransformNode()
+	slicer.mrmlScene.AddNode(bsplineTrans)
+
+	#A single BSpline iteration barely deforms, the output is the affine
+	logic = AValue3DSlicerModuleLogic()
+	cliParams = logic.bsplineParameters(fixedVolume.GetID(), movingVolume.GetID(), bsplineTrans.GetID(), linearTrans.GetID())
+	cliParams['numberOfIterations'] = 1
+	cliNode = logic.startBRAINSFit(cliParams, 1)
+	self.assertEqual(cliNode.GetStatusString(), 'Completed')
+
+	points = np.array([[15.0, 18.0, 20.0], [26.0, 24.0, 18.0], [20.0, 20.0, 20.0]])
+	expected = logic.evaluateTransformsAtPoints(points, [linearTrans])
+	self.assertTrue(np.allclose(logic.evaluateTransformsAtPoints(points, [bsplineTrans]), expected, atol=0.5))
+	self.delayDisplay('Test passed!')
+
+  def test_readNRRDRegion(self):
+	""" Regions read from raw & gzip NRRD files hold the voxels written inside
+	the RAS bounds and the IJKToRAS of their first voxel
+	"""
+	self.delayDisplay("Starting the NRRD region test")
+
+	voxels = np.arange(6 * 5 * 4, dtype=np.int16).reshape(6, 5, 4)
+	ijkToRAS = np.diag([0.5, 0.5, 2.0, 1.0])
+	ijkToRAS[:3, 3] = [10, -5, 3]
+	tempDir = tempfile.mkdtemp()
+	try:
+		for compress in (False, True):
+			path = os.path.join(tempDir, 'region.nrrd')
+			writeNRRD(path, voxels, ijkToRAS, compress)
+			region, regionIJKToRAS = readNRRDRegion(path, [10.5, 11, -4.5, -4, 5, 7], margin=0)
+			self.assertTrue(np.array_equal(region, voxels[1:3, 1:3, 1:3]))
+			self.assertTrue(np.allclose(regionIJKToRAS[:3, 3], [10.5, -4.5, 5]))
+			region, regionIJKToRAS = readNRRDRegion(path, [-100, 100, -100, 100, -100, 100])
+			self.assertTrue(np.array_equal(region, voxels))
+			self.assertTrue(np.allclose(regionIJKToRAS, ijkToRAS))
+			self.assertRaises(ValueError, readNRRDRegion, path, [100, 110, 100, 110, 100, 110])
+	finally:
+		shutil.rmtree(tempDir)
+	self.delayDisplay('Test passed!')
+
+  def test_landmarkSetFiles(self):
+	""" Landmark sets read LPS .fcsv files in RAS with quoted labels and
+	descriptions, and read back what they write
+	"""
+	self.delayDisplay("Starting the landmark file test")
+
+	tempDir = tempfile.mkdtemp()
+	try:
+		lpsPath = os.path.join(tempDir, 'placed.fcsv')
+		with open(lpsPath, 'w') as fcsvFile:
+			fcsvFile.write(	'# Markups fiducial file version = 4.5\n# CoordinateSystem = 1\n'
+							'# columns = id,x,y,z,ow,ox,oy,oz,vis,sel,lock,label,desc,associatedNodeID\n'
+							'vtkMRMLMarkupsFiducialNode_0,1.5,-2,3,0,0,0,1,1,1,0,"Round, Window",RW,\n'
+							'vtkMRMLMarkupsFiducialNode_1,4,5,6,0,0,0,1,1,0,0,Apex,"the ""A"" landmark",\n' )
+		landmarks = LandmarkSet.read(lpsPath)
+		self.assertEqual(landmarks.name, 'placed')
+		self.assertTrue(np.allclose(landmarks.positions, [[-1.5, 2, 3], [-4, -5, 6]]))
+		self.assertEqual(landmarks.labels, ['Round, Window', 'Apex'])
+		self.assertEqual(landmarks.descriptions, ['RW', 'the "A" landmark'])
+		self.assertEqual(landmarks.selected.tolist(), [True, False])
+
+		rasPath = os.path.join(tempDir, 'written.fcsv')
+		landmarks.write(rasPath)
+		written = LandmarkSet.read(rasPath)
+		self.assertTrue(np.allclose(written.positions, landmarks.positions))
+		self.assertEqual(written.labels, landmarks.labels)
+		self.assertEqual(written.descriptions, landmarks.descriptions)
+		self.assertEqual(written.selected.tolist(), landmarks.selected.tolist())
+	finally:
+		shutil.rmtree(tempDir)
+	self.delayDisplay('Test passed!')
+
+  def test_pipelineScheduler(self):
+	""" A case failing a worker or main stage leaves the pipeline with its
+	error and the other cases still go through every stage
+	"""
+	self.delayDisplay("Starting the pipeline scheduler test")
+
+	def load(state):
+		if state['caseID'] == 'badLoad':
+			raise IOError('unreadable volume')
+		state['loaded'] = True
+
+	def measure(state):
+		if state['caseID'] == 'badMeasure':
+			raise ValueError('no fiducials')
+		state['measured'] = state['loaded']
+
+	stages = [	{'name': 'load', 'run': load, 'thread': 'worker', 'concurrency': 2, 'queueSize': 2},
+				{'name': 'measure', 'run': measure, 'thread': 'main', 'concurrency': 1, 'queueSize': 1} ]
+	caseIDs = ['case1', 'badLoad', 'case2', 'badMeasure', 'case3']
+	finished = {}
+	PipelineScheduler(stages).run([{'caseID': caseID} for caseID in caseIDs],
+								  lambda state: finished.setdefault(state['caseID'], state))
+
+	self.assertEqual(sorted(finished), sorted(caseIDs))
+	self.assertTrue(finished['badLoad']['error'].startswith('load:'))
+	self.assertNotIn('measured', finished['badLoad'])
+	self.assertTrue(finished['badMeasure']['error'].startswith('measure:'))
+	for caseID in ('case1', 'case2', 'case3'):
+		self.assertNotIn('error', finished[caseID])
+		self.assertTrue(finished[caseID]['measured'])
+	self.delayDisplay('Test passed!')
+
+  def test_fuseAtlasPositions(self):
+	""" Atlas positions fuse to their median or weighted mean with the RMS
+	spread of the atlases, landmark transforms are written as the inverse LPS
+	transform BRAINSFit reads
+	"""
+	self.delayDisplay("Starting the atlas fusion test")
+
+	positions = np.array([	[[0, 0, 0], [10, 0, 0]],
+							[[1, 0, 0], [10, 2, 0]],
+							[[5, 0, 0], [10, 4, 0]] ])
+	fused, spread = fuseAtlasPositions(positions)
+	self.assertTrue(np.allclose(fused, [[1, 0, 0], [10, 2, 0]]))
+	self.assertTrue(np.allclose(spread, [np.sqrt(17 / 3.0), np.sqrt(8 / 3.0)]))
+	fused, spread = fuseAtlasPositions(positions, [1, 1, 2], method='weighted')
+	self.assertTrue(np.allclose(fused, [[2.75, 0, 0], [10, 2.5, 0]]))
+	self.assertRaises(ValueError, fuseAtlasPositions, positions, method='mean')
+
+	angle = math.radians(30)
+	matrix = np.identity(4)
+	matrix[:3, :3] = [[math.cos(angle), -math.sin(angle), 0], [math.sin(angle), math.cos(angle), 0], [0, 0, 1]]
+	matrix[:3, 3] = [5, -3, 2]
+	tempDir = tempfile.mkdtemp()
+	try:
+		path = os.path.join(tempDir, 'landmark.tfm')
+		writeITKTransform(path, matrix)
+		with open(path) as transformFile:
+			fields = dict(line.split(':', 1) for line in transformFile if ':' in line)
+	finally:
+		shutil.rmtree(tempDir)
+	self.assertEqual(fields['Transform'].strip(), 'AffineTransform_double_3_3')
+	parameters = [float(value) for value in fields['Parameters'].split()]
+	itkMatrix = np.identity(4)
+	itkMatrix[:3, :3] = np.reshape(parameters[:9], (3, 3))
+	itkMatrix[:3, 3] = parameters[9:]
+	rasToLPS = np.diag([-1.0, -1.0, 1.0, 1.0])
+	self.assertTrue(np.allclose(np.linalg.inv(rasToLPS.dot(itkMatrix).dot(rasToLPS)), matrix))
+	self.delayDisplay('Test passed!')
+
+  def test_parseBRAINSFitMetric(self):
+	""" The last metric value of the BRAINSFit output is read from the metric
+	lines or the optimizer observer lines, None without one
+	"""
+	self.delayDisplay("Starting the BRAINSFit metric test")
+
+	outputText = (	'Starting registration\n'
+					'Metric value: -0.8512\n'
+					'MetricValue = -9.5e-01\n'
+					'Registration done\n' )
+	self.assertEqual(parseBRAINSFitMetric(outputText), -0.95)
+	observerText = (	'  0   -0.412   [0.1, 0.2, 0.3]\n'
+						'  1   -0.733   [0.1, 0.2, 0.3]\n' )
+	self.assertEqual(parseBRAINSFitMetric(observerText), -0.733)
+	self.assertIsNone(parseBRAINSFitMetric('Registration done\n'))
+	self.assertIsNone(parseBRAINSFitMetric(None))
+	self.assertEqual(parseBRAINSFitMetrics(observerText), [-0.412, -0.733])
+	self.assertEqual(parseBRAINSFitMetrics(None), [])
+	self.assertTrue(np.allclose(relativeImprovement(-0.8, -0.88), 0.1))
+	self.delayDisplay('Test passed!')
+
+  def test_registrationCacheKey(self):
+	""" Registration cache keys are stable for identical registrations and
+	change with the fixed voxels, the parameters & the initial transform
+	"""
+	self.delayDisplay("Starting the registration cache key test")
+
+	imageData = vtk.vtkImageData()
+	imageData.SetDimensions(8, 8, 8)
+	imageData.AllocateScalars(vtk.VTK_SHORT, 1)
+	voxels = vtk_to_numpy(imageData.GetPointData().GetScalars())
+	voxels[:] = np.arange(len(voxels))
+	fixedVolume, movingVolume = slicer.vtkMRMLScalarVolumeNode(), slicer.vtkMRMLScalarVolumeNode()
+	fixedVolume.SetAndObserveImageData(imageData)
+	movingVolume.SetAndObserveImageData(imageData)
+	initialTrans, outputTrans, otherOutputTrans = slicer.vtkMRMLTransformNode(), slicer.vtkMRMLTransformNode(), slicer.vtkMRMLTransformNode()
+	for node in (fixedVolume, movingVolume, initialTrans, outputTrans, otherOutputTrans):
+		slicer.mrmlScene.AddNode(node)
+
+	cache = RegistrationCache(tempfile.mkdtemp())
+	logic = AValue3DSlicerModuleLogic()
+	cliParams = logic.affineParameters(fixedVolume.GetID(), movingVolume.GetID(), outputTrans.GetID())
+	key = cache.key(cliParams, None, initialTrans)
+	self.assertIsNotNone(key)
+	self.assertEqual(cache.key(dict(cliParams), None, initialTrans), key)
+	self.assertEqual(cache.key(dict(cliParams, linearTransform=otherOutputTrans.GetID()), None, initialTrans), key)
+
+	self.assertNotEqual(cache.key(dict(cliParams, numberOfIterations=10), None, initialTrans), key)
+	self.assertNotEqual(cache.key(cliParams, [{'shrinkFactor': 2}], initialTrans), key)
+	matrix = np.identity(4)
+	matrix[:3, 3] = [1, 0, 0]
+	setTransformMatrix(initialTrans, matrix)
+	self.assertNotEqual(cache.key(cliParams, None, initialTrans), key)
+	setTransformMatrix(initialTrans, np.identity(4))
+	self.assertEqual(cache.key(cliParams, None, initialTrans), key)
+	voxels[0] += 1
+	imageData.Modified()
+	self.assertNotEqual(cache.key(cliParams, None, initialTrans), key)
+
+	#Nodes other than volumes & linear transforms can not be hashed
+	markupsNode = slicer.vtkMRMLMarkupsFiducialNode()
+	slicer.mrmlScene.AddNode(markupsNode)
+	self.assertIsNone(cache.key(dict(cliParams, initialTransform=markupsNode.GetID())))
+	shutil.rmtree(cache.cacheDir)
+	self.delayDisplay('Test passed!')
+
+  def test_atlasCacheEvict(self):
+	""" The atlas cache evicts the least recently used atlases first and always
+	keeps the most recently used one
+	"""
+	self.delayDisplay("Starting the atlas cache eviction test")
+
+	class SizedAtlas(object):
+		def __init__(self, size):
+			self.size = size
+		def memorySize(self):
+			return self.size
+
+	cache = AtlasCache(maxBytes=250)
+	for key in ('a', 'b', 'c'):
+		cache.entries[key] = SizedAtlas(100)
+	cache.evict()
+	self.assertEqual(list(cache.entries), ['b', 'c'])
+
+	#Using an atlas moves it to the end, like get does
+	cache.entries['b'] = cache.entries.pop('b')
+	cache.entries['d'] = SizedAtlas(100)
+	cache.evict()
+	self.assertEqual(list(cache.entries), ['b', 'd'])
+
+	cache.entries['e'] = SizedAtlas(1000)
+	cache.evict()
+	self.assertEqual(list(cache.entries), ['e'])
+	self.delayDisplay('Test passed!')
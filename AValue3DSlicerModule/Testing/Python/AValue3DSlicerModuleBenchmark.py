@@ -0,0 +1,242 @@
+"""
+Offline performance benchmark of the A-value pipeline.
+
+Cochlea-like phantoms are made by resampling the bundled atlas through a known
+similarity transform at several voxel spacings & fields of view, with noise
+added. The placed landmarks and the A-value fiducials are mapped through the
+same transform, so the A-value of every phantom is known. Every phantom runs
+through AValue3DSlicerModuleLogic.runCase with stage tracing & memory
+instrumentation; per-stage timings, memory & the A-value error are written as
+JSON so the results of different versions can be compared.
+
+Run inside Slicer:
+	Slicer --no-main-window --python-script AValue3DSlicerModuleBenchmark.py [results.json]
+"""
+import os
+import sys
+import json
+import time
+import math
+import shutil
+import logging
+import tempfile
+import platform
+import subprocess
+import collections
+import unittest
+import vtk, slicer
+from slicer.ScriptedLoadableModule import *
+import numpy as np
+from vtk.util.numpy_support import vtk_to_numpy
+from multiprocessing import cpu_count
+
+import AValue3DSlicerModule
+from AValue3DSlicerModule import AValue3DSlicerModuleLogic, atlasCache, stageTrace, landmarkColumn
+from OtolaryngologyLib import LandmarkSet
+
+#Phantom voxel spacing & padding (mm) around the transformed atlas. scale, rotation
+#(degrees about the S axis) & translation (mm) define the known similarity transform
+BENCHMARK_PHANTOMS = [	{'name': 'coarse',		'spacing': 0.3,	'padding': 2.0,	'scale': 1.0,	'rotation': 0,		'translation': (0, 0, 0)},
+						{'name': 'clinical',	'spacing': 0.2,	'padding': 5.0,	'scale': 1.1,	'rotation': 10,		'translation': (2, -1, 3)},
+						{'name': 'microCT',		'spacing': 0.1,	'padding': 5.0,	'scale': 0.9,	'rotation': -15,	'translation': (-3, 2, 1)} ]
+
+#Standard deviation of the added gaussian noise, as a fraction of the atlas intensity range
+BENCHMARK_NOISE = 0.02
+
+#Largest accepted difference (mm) between the measured & known A-value
+BENCHMARK_AVALUE_TOLERANCE = 0.5
+
+
+def similarityMatrix(scale, rotation, translation):
+	"""4 x 4 matrix scaling, rotating (degrees about S) & translating RAS points"""
+	angle = math.radians(rotation)
+	matrix = np.eye(4)
+	matrix[:2, :2] = [[math.cos(angle), -math.sin(angle)], [math.sin(angle), math.cos(angle)]]
+	matrix[:3, :3] *= scale
+	matrix[:3, 3] = translation
+	return matrix
+
+def matrixArray(vtkMatrix):
+	return np.array([[vtkMatrix.GetElement(row, column) for column in range(4)] for row in range(4)])
+
+def arrayMatrix(matrix):
+	vtkMatrix = vtk.vtkMatrix4x4()
+	for row in range(4):
+		for column in range(4):
+			vtkMatrix.SetElement(row, column, matrix[row, column])
+	return vtkMatrix
+
+def transformPoints(matrix, points):
+	points = np.asarray(points, dtype=float)
+	return matrix[:3, :3].dot(points.T).T + matrix[:3, 3]
+
+def makePhantom(phantom, isRight, workDir, seed=0):
+	"""
+	Resample the atlas of one side through the phantom's known transform, add
+	noise and write the volume & the placed landmarks to workDir. Returns the
+	batch case (see readBatchManifest), the known A-value & the phantom size.
+	"""
+	atlas = atlasCache.get(isRight)
+	known = similarityMatrix(phantom['scale'], phantom['rotation'], phantom['translation'])
+	caseID = '%s_%s' % (phantom['name'], 'right' if isRight else 'left')
+
+	#Phantom grid covers the transformed atlas box plus padding
+	dimensions		= atlas.imageData.GetDimensions()
+	atlasIJKToRAS	= matrixArray(atlas.ijkToRAS)
+	corners			= [[i, j, k] for i in (0, dimensions[0] - 1) for j in (0, dimensions[1] - 1) for k in (0, dimensions[2] - 1)]
+	cornersRAS		= transformPoints(known.dot(atlasIJKToRAS), corners)
+	lower			= cornersRAS.min(axis=0) - phantom['padding']
+	size			= np.ceil((cornersRAS.max(axis=0) + phantom['padding'] - lower) / phantom['spacing']).astype(int) + 1
+	phantomIJKToRAS	= np.diag([phantom['spacing']] * 3 + [1.0])
+	phantomIJKToRAS[:3, 3] = lower
+
+	#Phantom voxel -> phantom RAS -> atlas RAS -> atlas voxel
+	reslice = vtk.vtkImageReslice()
+	reslice.SetInputData(atlas.imageData)
+	reslice.SetResliceAxes(arrayMatrix(np.linalg.inv(atlasIJKToRAS).dot(np.linalg.inv(known)).dot(phantomIJKToRAS)))
+	reslice.SetInterpolationModeToLinear()
+	reslice.SetBackgroundLevel(atlas.imageData.GetScalarRange()[0])
+	reslice.SetOutputOrigin(0, 0, 0)
+	reslice.SetOutputSpacing(1, 1, 1)
+	reslice.SetOutputExtent(0, size[0] - 1, 0, size[1] - 1, 0, size[2] - 1)
+	reslice.Update()
+	imageData = vtk.vtkImageData()
+	imageData.DeepCopy(reslice.GetOutput())
+
+	voxels = vtk_to_numpy(imageData.GetPointData().GetScalars())
+	scalarRange = atlas.imageData.GetScalarRange()
+	noisy = voxels + np.random.RandomState(seed).normal(0, BENCHMARK_NOISE * (scalarRange[1] - scalarRange[0]), voxels.shape)
+	if voxels.dtype.kind in 'iu':
+		noisy = np.clip(np.round(noisy), np.iinfo(voxels.dtype).min, np.iinfo(voxels.dtype).max)
+	voxels[:] = noisy
+	imageData.Modified()
+
+	volumeNode = slicer.vtkMRMLScalarVolumeNode()
+	volumeNode.SetName(caseID)
+	volumeNode.SetIJKToRASMatrix(arrayMatrix(phantomIJKToRAS))
+	volumeNode.SetAndObserveImageData(imageData)
+	slicer.mrmlScene.AddNode(volumeNode)
+	case = {'caseID': caseID, 'side': 'right' if isRight else 'left', 'volume': os.path.join(workDir, caseID + '.nrrd')}
+	slicer.util.saveNode(volumeNode, case['volume'])
+	slicer.mrmlScene.RemoveNode(volumeNode)
+
+	#Placed landmarks are written to the column of the atlas landmark they come from
+	landmarks = atlas.markups['landmarks']
+	placedLandmarks = transformPoints(known, landmarks.positions)
+	for description, position in zip(landmarks.descriptions, placedLandmarks):
+		column = landmarkColumn(description)
+		if column is None:
+			raise ValueError('Unknown atlas landmark ' + description)
+		case[column] = os.path.join(workDir, '%s_%s.fcsv' % (caseID, column))
+		LandmarkSet([position], [column]).write(case[column])
+
+	#A-value fiducials are the round window (first) & lateral wall (last) points
+	aValueFiducials = transformPoints(known, atlas.markups['fiducials'].positions)
+	knownAValue = float(np.linalg.norm(aValueFiducials[0] - aValueFiducials[-1]))
+	return case, knownAValue, size.tolist()
+
+def gitRevision():
+	"""Commit of the module sources, None outside a git checkout"""
+	try:
+		return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=AValue3DSlicerModule.MODULE_DIR).decode('ascii').strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+def runBenchmark(outputPath=None, phantoms=BENCHMARK_PHANTOMS, sides=(True, False), pyramidLevels=None):
+	"""Run the pipeline on every phantom & side, return (and write to outputPath) the benchmark report"""
+	logic = AValue3DSlicerModuleLogic()
+	logic.useRegistrationCache = False #Every phantom is registered from scratch
+	recordMemory = stageTrace.recordMemory
+	stageTrace.recordMemory = True
+
+	workDir = tempfile.mkdtemp(prefix='AValueBenchmark_')
+	results = []
+	try:
+		for phantom in phantoms:
+			for isRight in sides:
+				case, knownAValue, size = makePhantom(phantom, isRight, workDir)
+				case['pyramidLevels'] = pyramidLevels
+				row = {	'phantom'		: phantom['name'],
+						'side'			: case['side'],
+						'dimensions'	: size,
+						'spacing'		: phantom['spacing'],
+						'knownAValue'	: knownAValue }
+
+				startTime = time.time()
+				try:
+					result = logic.runCase(case)
+					if not result:
+						raise RuntimeError('A-value calculation failed')
+					row.update({	'status'			: 'completed',
+									'aValue'			: result['aValue'],
+									'aValueError'		: abs(result['aValue'] - knownAValue),
+									'peakRSSMB'			: result['peakRSSMB'],
+									'childPeakRSSMB'	: result['childPeakRSSMB'],
+									'imageAllocatedMB'	: result['imageAllocatedMB'],
+									'fullCopies'		: result['fullCopies'] })
+				except Exception as e:
+					logging.error('Benchmark phantom %s failed: %s' % (case['caseID'], e))
+					row.update({'status': 'failed', 'error': str(e)})
+				row['wallTime'] = time.time() - startTime
+
+				#Per stage totals of the spans recorded for the case
+				stages = collections.OrderedDict()
+				for record in sorted(stageTrace.finished, key=lambda record: record['start']):
+					stage = stages.setdefault(record['stage'], {	'count': 0, 'wallTime': 0, 'cpuTime': 0, 'childCpuTime': 0,
+																	'peakRSSMB': 0, 'imageAllocatedMB': 0, 'fullCopies': 0 })
+					stage['count'] += 1
+					for key in ('wallTime', 'cpuTime', 'childCpuTime', 'imageAllocatedMB', 'fullCopies'):
+						stage[key] += record[key]
+					stage['peakRSSMB'] = max(stage['peakRSSMB'], record['peakRSSMB'] or 0)
+				row['stages'] = stages
+				results.append(row)
+				logging.info('Benchmark phantom %s: %s' % (case['caseID'], json.dumps(row)))
+	finally:
+		stageTrace.recordMemory = recordMemory
+		shutil.rmtree(workDir, ignore_errors=True)
+
+	report = {	'benchmark'			: 'AValue3DSlicerModule',
+				'date'				: time.strftime('%Y-%m-%dT%H:%M:%S'),
+				'revision'			: gitRevision(),
+				'slicerVersion'		: slicer.app.applicationVersion,
+				'slicerRevision'	: slicer.app.repositoryRevision,
+				'platform'			: platform.platform(),
+				'cpuCount'			: cpu_count(),
+				'pyramidLevels'		: pyramidLevels,
+				'results'			: results }
+	if outputPath:
+		with open(outputPath, 'w') as outputFile:
+			json.dump(report, outputFile, indent=2, sort_keys=True)
+	return report
+
+
+class AValue3DSlicerModuleBenchmark(ScriptedLoadableModuleTest):
+	"""
+	Runs the benchmark as a test, results are written to AVALUE_BENCHMARK_OUTPUT
+	(AValueBenchmark.json in the Slicer temporary folder by default)
+	"""
+
+	def setUp(self):
+		slicer.mrmlScene.Clear(0)
+
+	def runTest(self):
+		self.setUp()
+		self.test_Benchmark()
+
+	def test_Benchmark(self):
+		""" Every phantom runs through the pipeline and the known A-value is recovered
+		"""
+		self.delayDisplay("Starting the A-value benchmark")
+
+		outputPath = os.environ.get('AVALUE_BENCHMARK_OUTPUT', os.path.join(slicer.app.temporaryPath, 'AValueBenchmark.json'))
+		report = runBenchmark(outputPath)
+		for result in report['results']:
+			self.assertEqual(result['status'], 'completed', result.get('error'))
+			self.assertLess(result['aValueError'], BENCHMARK_AVALUE_TOLERANCE)
+
+		self.delayDisplay('Benchmark results written to ' + outputPath)
+
+
+if __name__ == '__main__':
+	runBenchmark(sys.argv[1] if len(sys.argv) > 1 else os.path.join(slicer.app.temporaryPath, 'AValueBenchmark.json'))
+	sys.exit(0)
@@ -1,9 +1,30 @@
 import os
+import sys
 import inspect
 import unittest
 import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 import logging
+import json
+import collections
+import numpy as np
+from vtk.util.numpy_support import vtk_to_numpy
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+try:
+    import OtolaryngologyLib
+except ImportError: #Source tree, the shared package is only installed next to the modules by the build
+    sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))), 'OtolaryngologyLib'))
+from OtolaryngologyLib import LandmarkSet, matchLandmarks, setTransformMatrix, fitLandmarkTransform, writeNRRD
+from OtolaryngologyLib.regions import TIGHT_ROI, fitROIToForeground, voxelCropRange, cropArrayView, extractVoxelRange
+from OtolaryngologyLib.tracing import StageTrace
+
+#Template landmarks of the alignment modes in template order, also the order they are placed in
+ALIGNMENT_LANDMARKS = { 'cochlea'       : ['OW', 'CN', 'A', 'RW'],
+                        'temporalBone'  : ['PA', 'GG', 'SF', 'AE', 'PSC', 'OW', 'RW'] }
+
+#File name of the template ROI sidecar written next to batch cropped volumes
+TEMPLATE_ROI_SIDECAR = 'Template_ROI.json'
 
 #
 # AlignCrop3DSlicerModule
@@ -307,6 +328,35 @@ class AlignCrop3DSlicerModuleWidget(ScriptedLoadableModuleWidget):
         imageCropping.addWidget(self.cropButton)
         parametersFormLayoutCrop.addRow("Select & Crop Region of Interest: ", imageCropping)
 
+        #
+        # Tight ROI checkbox
+        #
+        self.tightROICheckBox = qt.QCheckBox()
+        self.tightROICheckBox.checked = False
+        self.tightROICheckBox.setToolTip("If checked the ROI only encloses the template foreground plus a margin, so less background is cropped")
+        parametersFormLayoutCrop.addRow("Tight ROI: ", self.tightROICheckBox)
+
+        #
+        # Batch crop - aligned volumes cropped against the template ROI & saved
+        #
+        self.batchCropSelector = slicer.qMRMLCheckableNodeComboBox()
+        self.batchCropSelector.nodeTypes = ["vtkMRMLScalarVolumeNode"]
+        self.batchCropSelector.showHidden = False
+        self.batchCropSelector.showChildNodeTypes = False
+        self.batchCropSelector.setMRMLScene( slicer.mrmlScene )
+        self.batchCropSelector.setToolTip( "select the aligned volumes to crop " )
+        parametersFormLayoutCrop.addRow("Batch Crop Volumes: ", self.batchCropSelector)
+
+        self.batchCropDirectory = ctk.ctkPathLineEdit()
+        self.batchCropDirectory.filters = ctk.ctkPathLineEdit.Dirs
+        self.batchCropDirectory.setToolTip( "cropped volumes & the template ROI are saved to this folder " )
+        parametersFormLayoutCrop.addRow("Batch Crop Output Folder: ", self.batchCropDirectory)
+
+        self.batchCropButton		 	= qt.QPushButton('Batch Crop')
+        self.batchCropButton.toolTip 	= "Crop the checked volumes with the template ROI & save them"
+        self.batchCropButton.enabled	= False
+        parametersFormLayoutCrop.addRow(self.batchCropButton)
+
         #
         # Volume connections
         #
@@ -339,6 +389,7 @@ class AlignCrop3DSlicerModuleWidget(ScriptedLoadableModuleWidget):
         self.cropInputSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelectCrop)
         self.defineCropButton.connect('clicked(bool)', self.onDefineCropButton)
         self.cropButton.connect('clicked(bool)', self.onCropButton)
+        self.batchCropButton.connect('clicked(bool)', self.onBatchCropButton)
 
         # Add vertical spacer
         self.layout.addStretch(1)
@@ -450,15 +501,34 @@ class AlignCrop3DSlicerModuleWidget(ScriptedLoadableModuleWidget):
 
         logic = AlignCrop3DSlicerModuleLogic()
         if(self.movingFiducialNodeCO.GetNumberOfFiducials() > 2):
-            logic.runAlignmentRegistration(self.landmarkTransformCO, self.templateFidCO, self.movingFiducialNodeCO, self.placementListCO)
+            landmarkNames = ALIGNMENT_LANDMARKS['cochlea']
+            placedNames = [name for name in landmarkNames if self.placementListCO[name]]
+            try:
+                rigMatrix = logic.runAlignmentRegistration(self.landmarkTransformCO, self.templateFidCO, self.movingFiducialNodeCO,
+                                                           landmarkNames, placedNames)
+            except ValueError as e:
+                #Placed & confirmed landmarks do not agree, align can be retried once they are fixed
+                slicer.util.errorDisplay('Alignment registration failed: ' + str(e))
+                slicer.mrmlScene.RemoveNode(self.landmarkTransformCO)
+                self.alignButtonCO.enabled = True
+                return
+            self.onAlignmentCompletedCO(rigMatrix)
         else:
             slicer.util.infoDisplay("At least 3 fiducials required for registration to proceed")
+            self.onAlignmentCompletedCO(None)
+
+    def onAlignmentCompletedCO(self, rigMatrix):
+
+        if rigMatrix is not None:
+            logging.info('Alignment transform:\n%s' % rigMatrix)
 
-        #Apply Landmark transform on input Volume & Fiducials and Harden
+        #Apply Landmark transform on input Volume & Fiducials and Harden. The landmark transform is
+        #linear, hardening only updates the volume geometry and the voxels are not resampled
         self.inputVolumeCO.SetAndObserveTransformNodeID(self.landmarkTransformCO.GetID())
-        slicer.vtkSlicerTransformLogic().hardenTransform(self.inputVolumeCO)
         self.movingFiducialNodeCO.SetAndObserveTransformNodeID(self.landmarkTransformCO.GetID())
-        slicer.vtkSlicerTransformLogic().hardenTransform(self.movingFiducialNodeCO)
+        with stageTrace.span('harden'):
+            slicer.vtkSlicerTransformLogic().hardenTransform(self.inputVolumeCO)
+            slicer.vtkSlicerTransformLogic().hardenTransform(self.movingFiducialNodeCO)
 
 
         #Set template to foreground in Slice Views
@@ -551,7 +621,7 @@ class AlignCrop3DSlicerModuleWidget(ScriptedLoadableModuleWidget):
             self.SFButton.enabled = False
             self.AEButton.enabled = True
         else:
-            self.placementListTB['GG'] = False
+            self.placementListTB['SF'] = False
             #Enable/Disable Buttons
             self.SFButton.enabled = False
             self.AEButton.enabled = True
@@ -647,18 +717,34 @@ class AlignCrop3DSlicerModuleWidget(ScriptedLoadableModuleWidget):
 
         logic = AlignCrop3DSlicerModuleLogic()
         if(self.movingFiducialNode.GetNumberOfFiducials() > 2):
-            logic.runAlignmentRegistration(self.landmarkTransform, self.templateFidTB, self.movingFiducialNode, self.placementListTB)
+            landmarkNames = ALIGNMENT_LANDMARKS['temporalBone']
+            placedNames = [name for name in landmarkNames if self.placementListTB[name]]
+            try:
+                rigMatrix = logic.runAlignmentRegistration(self.landmarkTransform, self.templateFidTB, self.movingFiducialNode,
+                                                           landmarkNames, placedNames)
+            except ValueError as e:
+                #Placed & confirmed landmarks do not agree, align can be retried once they are fixed
+                slicer.util.errorDisplay('Alignment registration failed: ' + str(e))
+                slicer.mrmlScene.RemoveNode(self.landmarkTransform)
+                self.alignButtonTB.enabled = True
+                return
+            self.onAlignmentCompletedTB(rigMatrix)
         else:
             slicer.util.infoDisplay("At least 3 fiducials required for registration to proceed")
+            self.onAlignmentCompletedTB(None)
 
-        #Apply Landmark transform on input Volume & Fiducials and Harden
-        self.inputVolumeTB.SetAndObserveTransformNodeID(self.landmarkTransform.GetID())
-        slicer.vtkSlicerTransformLogic().hardenTransform(self.inputVolumeTB)
-        self.movingFiducialNode.SetAndObserveTransformNodeID(self.landmarkTransform.GetID())
-        slicer.vtkSlicerTransformLogic().hardenTransform(self.movingFiducialNode)
+    def onAlignmentCompletedTB(self, rigMatrix):
 
+        if rigMatrix is not None:
+            logging.info('Alignment transform:\n%s' % rigMatrix)
 
-        #TODO - Align output is incorrect!! Investigate (Jan 17th - 2018)
+        #Apply Landmark transform on input Volume & Fiducials and Harden. The landmark transform is
+        #linear, hardening only updates the volume geometry and the voxels are not resampled
+        self.inputVolumeTB.SetAndObserveTransformNodeID(self.landmarkTransform.GetID())
+        self.movingFiducialNode.SetAndObserveTransformNodeID(self.landmarkTransform.GetID())
+        with stageTrace.span('harden'):
+            slicer.vtkSlicerTransformLogic().hardenTransform(self.inputVolumeTB)
+            slicer.vtkSlicerTransformLogic().hardenTransform(self.movingFiducialNode)
 
         #Set template to foreground in Slice Views
         applicationLogic 	= slicer.app.applicationLogic()
@@ -687,9 +773,10 @@ class AlignCrop3DSlicerModuleWidget(ScriptedLoadableModuleWidget):
     #Cropping Buttons
     def onDefineCropButton(self):
 
-        #Define logic & retrieve atlas/template region of interest (ROI)
+        #Define logic & retrieve atlas/template region of interest (ROI), computed once per template
         logic = AlignCrop3DSlicerModuleLogic()
-        self.templateROI = logic.runDefineCropROIVoxel(self.cropTemplateVolume)
+        logic.tightROI = TIGHT_ROI if self.tightROICheckBox.checked else None
+        self.templateROI = logic.runTemplateROI(self.cropTemplateVolume)
 
         #Enable cropping button
         self.cropButton.enabled = True
@@ -702,12 +789,32 @@ class AlignCrop3DSlicerModuleWidget(ScriptedLoadableModuleWidget):
                                 self.cropInputSelector.currentNode())
 
 
+        #Memory used by the stages of this volume, the next one starts from scratch
+        if stageTrace.recordMemory:
+            logging.info('Memory by stage: %s' % json.dumps(stageTrace.memorySummary()))
+            stageTrace.beginCase()
+
         #TODO - setup layout on slicer view after cropping.
         #centre slice viewer on image
         slicer.app.applicationLogic().FitSliceToAll()
 
         self.cropButton.enabled = False
 
+    def onBatchCropButton(self):
+
+        volumes = self.batchCropSelector.checkedNodes()
+        outputDir = self.batchCropDirectory.currentPath
+        if not volumes or not outputDir:
+            slicer.util.errorDisplay('Check the volumes to crop and select an output folder')
+            return
+
+        logic = AlignCrop3DSlicerModuleLogic()
+        logic.tightROI = TIGHT_ROI if self.tightROICheckBox.checked else None
+        rows = logic.runBatchCrop(self.cropTemplateSelector.currentNode(), volumes, outputDir)
+        failed = [row['volume'] for row in rows if row['status'] != 'completed']
+        if failed:
+            slicer.util.errorDisplay('Cropping failed for %s, see the log for details' % ', '.join(failed))
+
     def cleanup(self):
         pass
 
@@ -738,6 +845,8 @@ class AlignCrop3DSlicerModuleWidget(ScriptedLoadableModuleWidget):
             self.cropTemplateVolume = self.cropTemplateSelector.currentNode()
             self.cropInputVolume    = self.cropInputSelector.currentNode()
 
+        self.batchCropButton.enabled = self.cropTemplateSelector.currentNode() is not None
+
 
 #
 # AlignCrop3DSlicerModuleLogic
@@ -752,6 +861,9 @@ class AlignCrop3DSlicerModuleLogic(ScriptedLoadableModuleLogic):
     Uses ScriptedLoadableModuleLogic base class, available at:
     https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py"""
 
+    #Fit ROIs to the template foreground (see TIGHT_ROI), None fits them to the whole template
+    tightROI = None
+
     def hasImageData(self,volumeNode):
         """This is an example logic method that
         returns true if the passed in volume
@@ -779,48 +891,28 @@ class AlignCrop3DSlicerModuleLogic(ScriptedLoadableModuleLogic):
           return False
         return True
 
-    def runAlignmentRegistration(self, transform, fixedFiducial, movingFiducial, placementChecklist):
-
-        logging.info("Now running Alignment Registration")
-
-        #deselected unused fiducials
-        if len(placementChecklist) == 4:
-            for key, value in placementChecklist.iteritems():
-                if value != True:
-                    if key == 'OW':
-                        fixedFiducial.SetNthFiducialSelected(0, 0)
-                    if key == 'CN':
-                        fixedFiducial.SetNthFiducialSelected(1, 0)
-                    if key == 'A':
-                        fixedFiducial.SetNthFiducialSelected(2, 0)
-                    if key == 'RW':
-                        fixedFiducial.SetNthFiducialSelected(3, 0)
-        else:
-            for key, value in placementChecklist.iteritems():
-                if value != True:
-                    if key == 'PA':
-                        fixedFiducial.SetNthFiducialSelected(0, 0)
-                    if key == 'GG':
-                        fixedFiducial.SetNthFiducialSelected(1, 0)
-                    if key == 'SF':
-                        fixedFiducial.SetNthFiducialSelected(2, 0)
-                    if key == 'AE':
-                        fixedFiducial.SetNthFiducialSelected(3, 0)
-                    if key == 'PSC':
-                        fixedFiducial.SetNthFiducialSelected(4, 0)
-                    if key == 'OW':
-                        fixedFiducial.SetNthFiducialSelected(5, 0)
-                    if key == 'RW':
-                        fixedFiducial.SetNthFiducialSelected(6, 0)
-
-        #Setup and Run Landmark Registration
-        cliParamsFidReg = {	'fixedLandmarks'	: fixedFiducial.GetID(),
-		                    'movingLandmarks' 	: movingFiducial.GetID(),
-		                    'TransformType' 	: 'Rigid',
-		                    'saveTransform' 	: transform.GetID() }
-
-        cliRigTrans = slicer.cli.run( slicer.modules.fiducialregistration, None,
-		                              cliParamsFidReg, wait_for_completion=True )
+    def setMemoryInstrumentation(self, enabled):
+        """Record peak RSS, allocated image data & full volume copies of every stage (see StageTrace)"""
+        stageTrace.recordMemory = enabled
+
+    def runAlignmentRegistration(self, transform, fixedFiducial, movingFiducial, landmarkNames, placedNames):
+        """
+        Fit the rigid landmark transform & set it on transform. landmarkNames names
+        the template (fixedFiducial) landmarks in order, placedNames the landmarks
+        of movingFiducial in placement order, skipped landmarks are left out (see
+        matchLandmarks). The template node is not modified. Returns the matrix.
+        """
+
+        with stageTrace.span('landmarkRegistration'):
+            logging.info("Now running Alignment Registration")
+
+            #Solve the rigid landmark registration in-process on the landmarks placed on both
+            fixedLandmarks, movingLandmarks = matchLandmarks(    LandmarkSet.fromNode(fixedFiducial), landmarkNames,
+                                                                LandmarkSet.fromNode(movingFiducial), placedNames )
+            rigMatrix = fitLandmarkTransform(fixedLandmarks, movingLandmarks)
+            setTransformMatrix(transform, rigMatrix)
+
+        return rigMatrix
 
 
     def runDefineCropROI(self, cropParam):
@@ -848,44 +940,339 @@ class AlignCrop3DSlicerModuleLogic(ScriptedLoadableModuleLogic):
 
         roi.SetXYZ(volCenter)
         roi.SetRadiusXYZ(volDim[0]/2, volDim[1]/2, volDim[2]/2 )
+        if self.tightROI:
+            fitROIToForeground(roi, vol, **self.tightROI)
         return roi
 
     def runDefineCropROIVoxel(self, inputVol):
 
-        #create crop volume parameter node
-        cropParamNode = slicer.vtkMRMLCropVolumeParametersNode()
-        cropParamNode.SetScene(slicer.mrmlScene)
-        cropParamNode.SetName('Template_ROI')
-        cropParamNode.SetInputVolumeNodeID(inputVol.GetID())
+        with stageTrace.span('defineROI', [inputVol]):
+            #create crop volume parameter node
+            cropParamNode = slicer.vtkMRMLCropVolumeParametersNode()
+            cropParamNode.SetScene(slicer.mrmlScene)
+            cropParamNode.SetName('Template_ROI')
+            cropParamNode.SetInputVolumeNodeID(inputVol.GetID())
+
+            #create ROI
+            template_roi = slicer.vtkMRMLAnnotationROINode()
+            slicer.mrmlScene.AddNode(template_roi)
+            cropParamNode.SetROINodeID(template_roi.GetID())
 
-        #create ROI
-        template_roi = slicer.vtkMRMLAnnotationROINode()
-        slicer.mrmlScene.AddNode(template_roi)
-        cropParamNode.SetROINodeID(template_roi.GetID())
+            #Fit roi to input image
+            slicer.mrmlScene.AddNode(cropParamNode)
+            slicer.modules.cropvolume.logic().SnapROIToVoxelGrid(cropParamNode)
+            slicer.modules.cropvolume.logic().FitROIToInputVolume(cropParamNode)
+            if self.tightROI:
+                fitROIToForeground(template_roi, inputVol, **self.tightROI)
 
-        #Fit roi to input image
-        slicer.mrmlScene.AddNode(cropParamNode)
-        slicer.modules.cropvolume.logic().SnapROIToVoxelGrid(cropParamNode)
-        slicer.modules.cropvolume.logic().FitROIToInputVolume(cropParamNode)
+            #Only the ROI is kept, the parameter node would pile up in the scene with every template
+            slicer.mrmlScene.RemoveNode(cropParamNode)
 
         return template_roi
 
+    def runTemplateROI(self, templateVolume, sidecarPath=None):
+        """
+        Template ROI fitted to templateVolume, computed once & reused until the
+        template changes (see TemplateROICache). The ROI box is also written to
+        the JSON sidecarPath if given.
+        """
+        roi = templateROICache.get(templateVolume, self.tightROI)
+        if roi is None:
+            roi = self.runDefineCropROIVoxel(templateVolume)
+            templateROICache.add(templateVolume, roi, self.tightROI)
+        else:
+            logging.info('Reusing the cached ROI of template %s' % templateVolume.GetName())
+
+        if sidecarPath:
+            writeROISidecar(sidecarPath, roi, templateVolume)
+        return roi
+
+    def runBatchCrop(self, templateVolume, volumes, outputDir, numberOfWorkers=None, compress=True):
+        """
+        Crop every volume with the ROI of templateVolume and save it to outputDir
+        as <volume name>-subvolume.nrrd, next to the template ROI sidecar.
+        The main thread only sets up each crop (see cropTask) without adding
+        nodes to the scene, the worker threads copy or resample the voxels and
+        compress & write them. Returns one result row per volume.
+        """
+        if not os.path.isdir(outputDir):
+            os.makedirs(outputDir)
+        roi = self.runTemplateROI(templateVolume, os.path.join(outputDir, TEMPLATE_ROI_SIDECAR))
+
+        if numberOfWorkers is None:
+            numberOfWorkers = cpu_count()
+        numberOfWorkers = max(1, min(numberOfWorkers, len(volumes)))
+        logging.info('Batch cropping %d volumes, %d worker threads' % (len(volumes), numberOfWorkers))
+
+        #Crops in flight are bounded, the main thread waits for the oldest one
+        pool = ThreadPool(numberOfWorkers)
+        pending = collections.deque()
+        rows = []
+        try:
+            for volume in volumes:
+                row = {'volume': volume.GetName(), 'path': None, 'status': 'failed', 'error': None}
+                rows.append(row)
+                try:
+                    with stageTrace.span('crop', [volume]) as span:
+                        crop, span['method'] = self.cropTask(roi, volume)
+                    row['path'] = os.path.join(outputDir, volume.GetName() + '-subvolume.nrrd')
+                    pending.append((row, pool.apply_async(self.batchCropWrite, (crop, row['path'], compress))))
+                except Exception as e:
+                    logging.error('Cropping %s failed: %s' % (volume.GetName(), e))
+                    row['error'] = str(e)
+                while len(pending) > numberOfWorkers or (pending and pending[0][1].ready()):
+                    self.finishBatchCropWrite(*pending.popleft())
+            while pending:
+                self.finishBatchCropWrite(*pending.popleft())
+        finally:
+            pool.close()
+            pool.join()
+
+        logging.info('Batch crop completed: %d of %d volumes failed' % (sum(row['status'] != 'completed' for row in rows), len(rows)))
+        return rows
+
+    def finishBatchCropWrite(self, row, write):
+        """Wait for the crop & write of one batch volume and record its outcome in row"""
+        try:
+            row['dimensions'] = write.get()
+            row['status'] = 'completed'
+            logging.info('Saved cropped %s to %s' % (row['volume'], row['path']))
+        except Exception as e:
+            logging.error('Saving cropped %s failed: %s' % (row['volume'], e))
+            row['error'] = str(e)
+
+    def cropTask(self, roi, volume):
+        """
+        Crop of volume inside roi, set up on the calling (main) thread: returns a
+        function giving the (k, j, i) voxels & their IJKToRAS (numpy), and the crop
+        method. Voxel aligned ROIs give a zero-copy view, aligned (transformed) &
+        oblique volumes are resampled once into the ROI grid when the function is
+        called. It only reads the volume voxels, so it can run in a worker thread.
+        """
+        if volume.GetParentTransformNode() is None:
+            voxels = cropArrayView(roi, volume)
+            if voxels is not None:
+                (i0, i1), (j0, j1), (k0, k1) = voxelCropRange(roi, volume)
+                ijkToRAS = vtk.vtkMatrix4x4()
+                volume.GetIJKToRASMatrix(ijkToRAS)
+                ijkToRAS = np.array([[ijkToRAS.GetElement(row, column) for column in range(4)] for row in range(4)])
+                ijkToRAS[:3, 3] = ijkToRAS.dot([i0, j0, k0, 1])[:3]
+                return (lambda: (voxels, ijkToRAS)), 'voxelRange'
+
+        reslice, outputIJKToRAS = self.alignAndCropReslice(roi, volume)
+        ijkToRAS = np.array([[outputIJKToRAS.GetElement(row, column) for column in range(4)] for row in range(4)])
+        def resample():
+            reslice.Update()
+            imageData = reslice.GetOutput()
+            return vtk_to_numpy(imageData.GetPointData().GetScalars()).reshape(imageData.GetDimensions()[::-1]), ijkToRAS
+        return resample, 'alignAndCrop'
+
+    def batchCropWrite(self, crop, path, compress):
+        """Worker thread part of runBatchCrop, crops (see cropTask) & writes one volume. Returns its dimensions"""
+        voxels, ijkToRAS = crop()
+        writeNRRD(path, voxels, ijkToRAS, compress)
+        return list(voxels.shape[::-1])
+
+    def runCropVolumeVoxel(self, volume, ranges):
+        """Crop volume by voxel index ranges, no interpolation & only the ROI voxels are copied"""
+        imageData, ijkToRAS = extractVoxelRange(volume, ranges)
+
+        cropVol = slicer.vtkMRMLScalarVolumeNode()
+        cropVol.SetName(slicer.mrmlScene.GenerateUniqueName(volume.GetName() + '-subvolume'))
+        cropVol.SetIJKToRASMatrix(ijkToRAS)
+        cropVol.SetAndObserveImageData(imageData)
+        slicer.mrmlScene.AddNode(cropVol)
+        cropVol.CreateDefaultDisplayNodes()
+        logging.info('Cropped %s by voxel index range %s' % (volume.GetName(), ranges))
+        return cropVol
+
     def runCropVolume(self, roi, volume):
 
-        logging.info('Cropping processing started')
+        with stageTrace.span('crop', [volume]) as span:
+            voxelRange = voxelCropRange(roi, volume)
 
-        #Create Crop Volume Parameter node
-        cropParamNode = slicer.vtkMRMLCropVolumeParametersNode()
-        cropParamNode.SetScene(slicer.mrmlScene)
-        cropParamNode.SetName('Crop_volume_Node1')
-        cropParamNode.SetInputVolumeNodeID(volume.GetID())
-        cropParamNode.SetROINodeID(roi.GetID())
-        slicer.mrmlScene.AddNode(cropParamNode)
+            #Volumes still under a transform (e.g. a BSpline one, linear ones are hardened) are aligned & cropped in a single resampling pass
+            if volume.GetParentTransformNode() is not None:
+                span['method'] = 'alignAndCrop'
+                cropVol = self.runAlignAndCrop(roi, volume)
 
-        #Apply Cropping
-        slicer.modules.cropvolume.logic().Apply(cropParamNode)
+            #Voxel aligned ROIs are cropped by index range, only oblique ROIs are resampled
+            elif voxelRange is not None:
+                span['method'] = 'voxelRange'
+                cropVol = self.runCropVolumeVoxel(volume, voxelRange)
 
-        logging.info('Cropping processing completed')
+            else:
+                span['method'] = 'cropVolume'
+                logging.info('Cropping processing started')
+
+                #Create Crop Volume Parameter node
+                cropParamNode = slicer.vtkMRMLCropVolumeParametersNode()
+                cropParamNode.SetScene(slicer.mrmlScene)
+                cropParamNode.SetName('Crop_volume_Node1')
+                cropParamNode.SetInputVolumeNodeID(volume.GetID())
+                cropParamNode.SetROINodeID(roi.GetID())
+                slicer.mrmlScene.AddNode(cropParamNode)
+
+                #Apply Cropping
+                slicer.modules.cropvolume.logic().Apply(cropParamNode)
+
+                logging.info('Cropping processing completed')
+                cropVol = slicer.mrmlScene.GetNodeByID(cropParamNode.GetOutputVolumeNodeID())
+
+                #Only the output volume is kept, the parameter node would pile up in the scene with every crop
+                slicer.mrmlScene.RemoveNode(cropParamNode)
+            span['volumes'].append(cropVol)
+
+        return cropVol
+
+    def runAlignAndCrop(self, roi, volume, transformNodes=()):
+        """
+        Resample volume straight into the ROI voxel grid through its parent
+        transforms and any extra transformNodes (applied in order, as if hardened).
+        Landmark, linear & BSpline transforms and the crop are composed so the
+        voxels are interpolated only once.
+        """
+        logging.info('Single pass align & crop started')
+
+        imageData, outputIJKToRAS = self.alignAndCropImage(roi, volume, transformNodes)
+
+        outputVolume = slicer.vtkMRMLScalarVolumeNode()
+        outputVolume.SetName(slicer.mrmlScene.GenerateUniqueName(volume.GetName() + '-subvolume'))
+        outputVolume.SetIJKToRASMatrix(outputIJKToRAS)
+        outputVolume.SetAndObserveImageData(imageData)
+        slicer.mrmlScene.AddNode(outputVolume)
+        outputVolume.CreateDefaultDisplayNodes()
+
+        logging.info('Single pass align & crop completed')
+        return outputVolume
+
+    def alignedSpacing(self, volume, transformNodes=()):
+        """
+        Voxel spacing of volume along the R, A & S axes once aligned: each RAS axis
+        takes the spacing of the input voxel axis closest to it after the linear
+        part of the parent & extra transforms, so oblique or permuted IJK to RAS
+        directions keep their resolution. Non-linear transforms are left out.
+        """
+        ijkToRAS = vtk.vtkMatrix4x4()
+        volume.GetIJKToRASMatrix(ijkToRAS)
+        steps = np.array([[ijkToRAS.GetElement(row, column) for column in range(3)] for row in range(3)])
+
+        transformMatrix = vtk.vtkMatrix4x4()
+        parent = volume.GetParentTransformNode()
+        if parent is not None and parent.IsTransformToWorldLinear():
+            parent.GetMatrixTransformToWorld(transformMatrix)
+            steps = np.dot(np.array([[transformMatrix.GetElement(row, column) for column in range(3)] for row in range(3)]), steps)
+        for transformNode in transformNodes:
+            if transformNode.IsTransformToParentLinear():
+                transformNode.GetMatrixTransformToParent(transformMatrix)
+                steps = np.dot(np.array([[transformMatrix.GetElement(row, column) for column in range(3)] for row in range(3)]), steps)
+
+        #Columns are the RAS step of one voxel along I, J & K
+        stepLengths = np.linalg.norm(steps, axis=0)
+        cosines = np.abs(steps) / stepLengths
+        return [float(stepLengths[np.argmax(cosines[axis])]) for axis in range(3)]
+
+    def alignAndCropImage(self, roi, volume, transformNodes=()):
+        """Resampled image data & IJKToRAS matrix of runAlignAndCrop, no node is added to the scene"""
+        reslice, outputIJKToRAS = self.alignAndCropReslice(roi, volume, transformNodes)
+        reslice.Update()
+        return reslice.GetOutput(), outputIJKToRAS
+
+    def alignAndCropReslice(self, roi, volume, transformNodes=()):
+        """Reslice filter (not updated yet) & output IJKToRAS matrix of alignAndCropImage"""
+
+        #Output grid - ROI box sampled at the input voxel spacing
+        center, radius = [0,0,0], [0,0,0]
+        roi.GetXYZ(center)
+        roi.GetRadiusXYZ(radius)
+        spacing = self.alignedSpacing(volume, transformNodes)
+        dimensions = [max(1, int(round(2 * radius[axis] / spacing[axis]))) for axis in range(3)]
+        outputIJKToRAS = vtk.vtkMatrix4x4()
+        for axis in range(3):
+            outputIJKToRAS.SetElement(axis, axis, spacing[axis])
+            outputIJKToRAS.SetElement(axis, 3, center[axis] - radius[axis] + spacing[axis] / 2.0)
+
+        #Output voxel -> RAS -> (inverse transforms) -> input RAS -> input voxel
+        worldToVolume = vtk.vtkGeneralTransform()
+        if volume.GetParentTransformNode() is not None:
+            volume.GetParentTransformNode().GetTransformFromWorld(worldToVolume)
+        inputRASToIJK = vtk.vtkMatrix4x4()
+        volume.GetRASToIJKMatrix(inputRASToIJK)
+
+        resliceTransform = vtk.vtkGeneralTransform()
+        resliceTransform.PostMultiply()
+        resliceTransform.Concatenate(outputIJKToRAS)
+        for transformNode in reversed(list(transformNodes)):
+            resliceTransform.Concatenate(transformNode.GetTransformFromParent())
+        resliceTransform.Concatenate(worldToVolume)
+        resliceTransform.Concatenate(inputRASToIJK)
+
+        reslice = vtk.vtkImageReslice()
+        reslice.SetInputData(volume.GetImageData())
+        reslice.SetResliceTransform(resliceTransform)
+        reslice.SetInterpolationModeToLinear()
+        reslice.SetOutputOrigin(0, 0, 0)
+        reslice.SetOutputSpacing(1, 1, 1)
+        reslice.SetOutputExtent(0, dimensions[0] - 1, 0, dimensions[1] - 1, 0, dimensions[2] - 1)
+        return reslice, outputIJKToRAS
+
+
+
+#
+# Template ROI cache
+#
+def roiBox(roi):
+    """Center & radius (RAS, mm) of an annotation ROI node"""
+    center, radius = [0,0,0], [0,0,0]
+    roi.GetXYZ(center)
+    roi.GetRadiusXYZ(radius)
+    return center, radius
+
+def writeROISidecar(path, roi, templateVolume):
+    """Write the ROI box & the template it was fitted to as JSON"""
+    center, radius = roiBox(roi)
+    with open(path, 'w') as sidecarFile:
+        json.dump({ 'template'  : templateVolume.GetName(),
+                    'center'    : center,
+                    'radius'    : radius,
+                    'space'     : 'RAS' }, sidecarFile, indent=2, sort_keys=True)
+
+class TemplateROICache(object):
+    """
+    Template ROI nodes by template volume & tight ROI settings. An entry is reused
+    while the ROI node is in the scene and the template voxels & geometry are unchanged.
+    """
+
+    def __init__(self):
+        self.entries = {}
+
+    def key(self, templateVolume):
+        ijkToRAS = vtk.vtkMatrix4x4()
+        templateVolume.GetIJKToRASMatrix(ijkToRAS)
+        imageData = templateVolume.GetImageData()
+        return (imageData.GetMTime() if imageData is not None else None,
+                tuple(ijkToRAS.GetElement(row, column) for row in range(3) for column in range(4)))
+
+    def get(self, templateVolume, tightROI=None):
+        entry = self.entries.get((templateVolume.GetID(), tuple(sorted(tightROI.items())) if tightROI else None))
+        if entry is None or entry[0] != self.key(templateVolume) or not slicer.mrmlScene.IsNodePresent(entry[1]):
+            return None
+        return entry[1]
+
+    def add(self, templateVolume, roi, tightROI=None):
+        self.entries[(templateVolume.GetID(), tuple(sorted(tightROI.items())) if tightROI else None)] = (self.key(templateVolume), roi)
+
+    def clear(self):
+        self.entries = {}
+
+templateROICache = TemplateROICache()
+
+
+#
+# Stage tracing
+#
+#Set STAGE_TRACE_FILE to record the stage trace of every case, STAGE_TRACE_MEMORY to record memory use as well
+stageTrace = StageTrace('AlignCrop3DSlicerModule', os.environ.get('STAGE_TRACE_FILE'), bool(os.environ.get('STAGE_TRACE_MEMORY')))
 
 
 
@@ -907,6 +1294,8 @@ class AlignCrop3DSlicerModuleTest(ScriptedLoadableModuleTest):
     """
     self.setUp()
     self.test_AlignCrop3DSlicerModule1()
+    self.test_matchLandmarks()
+    self.test_batchCrop()
 
   def test_AlignCrop3DSlicerModule1(self):
     """ Ideally you should have several levels of tests.  At the lowest level
@@ -943,3 +1332,63 @@ class AlignCrop3DSlicerModuleTest(ScriptedLoadableModuleTest):
     logic = AlignCrop3DSlicerModuleLogic()
     self.assertIsNotNone( logic.hasImageData(volumeNode) )
     self.delayDisplay('Test passed!')
+
+  def test_matchLandmarks(self):
+    """ Placed landmarks are matched to the template by name, skipped & deselected
+    landmarks are left out and the template is not modified
+    """
+    self.delayDisplay("Starting the landmark correspondence test")
+
+    landmarkNames = ALIGNMENT_LANDMARKS['temporalBone']
+    template = LandmarkSet(np.arange(21).reshape(7, 3), landmarkNames)
+    placed = LandmarkSet(np.arange(9).reshape(3, 3) + 100, ['RW', 'PA', 'SF'], selected=[True, True, False])
+
+    fixed, moving = matchLandmarks(template, landmarkNames, placed, placed.labels)
+    self.assertTrue(np.array_equal(fixed, template.positions[[6, 0]]))
+    self.assertTrue(np.array_equal(moving, placed.positions[:2]))
+    self.assertTrue(template.selected.all())
+    self.assertRaises(ValueError, matchLandmarks, template, landmarkNames, placed, ['RW', 'PA', 'XX'])
+    self.assertRaises(ValueError, matchLandmarks, template, landmarkNames, placed, ['RW', 'PA'])
+    self.assertRaises(ValueError, matchLandmarks, template, landmarkNames, placed, ['RW', 'PA', 'PA'])
+    self.delayDisplay('Test passed!')
+
+  def test_batchCrop(self):
+    """ Batch cropped volumes are written with the template ROI sidecar and
+    match a voxel range crop, the template ROI is computed once
+    """
+    self.delayDisplay("Starting the batch crop test")
+
+    import tempfile, shutil
+    imageData = vtk.vtkImageData()
+    imageData.SetDimensions(20, 16, 12)
+    imageData.AllocateScalars(vtk.VTK_SHORT, 1)
+    voxels = vtk_to_numpy(imageData.GetPointData().GetScalars())
+    voxels[:] = np.arange(voxels.size) % 1000
+    volumes = []
+    for name in ('template', 'aligned'):
+      volume = slicer.vtkMRMLScalarVolumeNode()
+      volume.SetName(name)
+      volume.SetSpacing(0.5, 0.5, 0.5)
+      volume.SetAndObserveImageData(imageData)
+      slicer.mrmlScene.AddNode(volume)
+      volumes.append(volume)
+
+    logic = AlignCrop3DSlicerModuleLogic()
+    roi = logic.runTemplateROI(volumes[0])
+    self.assertEqual(logic.runTemplateROI(volumes[0]).GetID(), roi.GetID())
+    logic.tightROI = TIGHT_ROI
+    self.assertNotEqual(logic.runTemplateROI(volumes[0]).GetID(), roi.GetID())
+    logic.tightROI = None
+
+    outputDir = tempfile.mkdtemp()
+    try:
+      rows = logic.runBatchCrop(volumes[0], volumes[1:], outputDir)
+      self.assertEqual(rows[0]['status'], 'completed', rows[0]['error'])
+      with open(os.path.join(outputDir, TEMPLATE_ROI_SIDECAR)) as sidecarFile:
+        self.assertTrue(np.allclose(json.load(sidecarFile)['radius'], roiBox(roi)[1]))
+      cropped = slicer.util.loadVolume(rows[0]['path'], returnNode=True)[1]
+      expected = cropArrayView(roi, volumes[1])
+      self.assertTrue(np.array_equal(slicer.util.array(cropped.GetID()), expected))
+    finally:
+      shutil.rmtree(outputDir, ignore_errors=True)
+    self.delayDisplay('Test passed!')
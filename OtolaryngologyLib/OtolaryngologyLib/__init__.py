@@ -0,0 +1,10 @@
+"""
+Helpers shared by the scripted modules of the extension. The package itself
+only needs numpy: landmark sets & landmark registration, NRRD files, A-value
+& CDL estimates. Voxel regions of interest (vtk) & stage tracing (slicer) are
+imported from their modules, OtolaryngologyLib.regions & OtolaryngologyLib.tracing.
+Nothing here depends on a module widget or logic, so both modules import it.
+"""
+from .landmarks import FCSV_COLUMNS, LandmarkSet, fiducialArray, matchLandmarks, setTransformMatrix, fitLandmarkTransform
+from .nrrd import NRRD_TYPES, NRRD_TYPE_NAMES, readNRRDHeader, nrrdIJKToRAS, readNRRDRegion, writeNRRD
+from .avalues import CDL_ESTIMATORS, registerCDLEstimator, computeAValues, cohortStatistics, readCohortPositions
@@ -0,0 +1,60 @@
+"""
+A-value & cochlear duct length (CDL) estimates of single cases & cohorts,
+numpy only so cohorts can be analysed outside Slicer
+"""
+import csv
+import collections
+import numpy as np
+
+#CDL estimators, result name -> formula of an array of A-values (mm). Estimators added with
+#registerCDLEstimator are computed by computeAValues & reported with every A-value result
+CDL_ESTIMATORS = collections.OrderedDict([
+	('cdlAlexiadesOC',	lambda aValue: 4.16 * aValue - 4),		#CDL(oc) estimate from Alexiades et al. (2015)
+	('cdlKochOC',		lambda aValue: 4.16 * aValue - 5.05),	#CDL(oc) estimate from Koch et al. (2017)
+	('cdlKochLW',		lambda aValue: 3.86 * aValue + 4.99) ])	#CDL(lw) estimate from Koch et al. (2017)
+
+def registerCDLEstimator(name, formula):
+	"""Add (or replace) a CDL estimator, formula maps an array of A-values to CDL estimates"""
+	CDL_ESTIMATORS[name] = formula
+
+def computeAValues(positions, estimators=None):
+	"""
+	A-values & CDL estimates of a cohort in one vectorized pass. positions are the
+	N x 2 x 3 round window & lateral wall positions, estimators maps result names
+	to formulas (CDL_ESTIMATORS by default). Returns an OrderedDict of N arrays,
+	'aValue' first then one per estimator.
+	"""
+	positions = np.asarray(positions, dtype=float).reshape(-1, 2, 3)
+	aValues = np.sqrt(((positions[:, 0] - positions[:, 1]) ** 2).sum(axis=1))
+	results = collections.OrderedDict([('aValue', aValues)])
+	for name, formula in (CDL_ESTIMATORS if estimators is None else estimators).items():
+		results[name] = np.broadcast_to(np.asarray(formula(aValues), dtype=float), aValues.shape)
+	return results
+
+def cohortStatistics(results):
+	"""Count, mean, standard deviation, minimum, median & maximum of every array of computeAValues"""
+	statistics = collections.OrderedDict()
+	for name, values in results.items():
+		values = np.asarray(values, dtype=float)
+		if not len(values):
+			statistics[name] = {'count': 0}
+			continue
+		percentiles = np.percentile(values, [0, 50, 100])
+		statistics[name] = {	'count'		: len(values),
+								'mean'		: float(values.mean()),
+								'std'		: float(values.std()),
+								'min'		: float(percentiles[0]),
+								'median'	: float(percentiles[1]),
+								'max'		: float(percentiles[2]) }
+	return statistics
+
+def readCohortPositions(resultPath):
+	"""Case IDs & N x 2 x 3 round window & lateral wall positions of the completed cases of a batch result file"""
+	caseIDs, positions = [], []
+	with open(resultPath) as resultFile:
+		for row in csv.DictReader(resultFile):
+			if row['status'] != 'completed':
+				continue
+			caseIDs.append(row['caseID'])
+			positions.append([[float(value) for value in row[key].split()] for key in ('roundWindow', 'lateralWall')])
+	return caseIDs, np.array(positions, dtype=float).reshape(-1, 2, 3)
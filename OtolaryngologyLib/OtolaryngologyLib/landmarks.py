@@ -0,0 +1,189 @@
+"""
+Landmark sets & closed-form landmark registration. Only the node helpers use
+vtk & slicer and import them when called, so .fcsv files can be read & written
+outside Slicer
+"""
+import os
+import csv
+import numpy as np
+
+
+#Columns of the Markups fiducial (.fcsv) files written by LandmarkSet.write, 4.5 files have the same columns
+FCSV_COLUMNS = ['id', 'x', 'y', 'z', 'ow', 'ox', 'oy', 'oz', 'vis', 'sel', 'lock', 'label', 'desc', 'associatedNodeID']
+
+class LandmarkSet(object):
+	"""
+	Landmarks held in arrays instead of a markups node: N x 3 RAS positions,
+	labels, descriptions & a selection mask. read & write handle Markups
+	fiducial .fcsv files (version 4.5 & 4.6) without touching the scene, so
+	they can be used in batch & worker threads. fromNode & createNode convert
+	from & to markups fiducial nodes.
+	"""
+	__slots__ = ('name', 'positions', 'labels', 'descriptions', 'selected')
+
+	def __init__(self, positions=(), labels=None, descriptions=None, selected=None, name=''):
+		self.name			= name
+		self.positions		= np.array(positions, dtype=float).reshape(-1, 3)
+		numOfPoints			= len(self.positions)
+		self.labels			= list(labels) if labels is not None else ['%s-%d' % (name, index + 1) for index in range(numOfPoints)]
+		self.descriptions	= list(descriptions) if descriptions is not None else [''] * numOfPoints
+		self.selected		= np.ones(numOfPoints, dtype=bool) if selected is None else np.array(selected, dtype=bool)
+		if not len(self.labels) == len(self.descriptions) == len(self.selected) == numOfPoints:
+			raise ValueError('Landmark labels, descriptions & selection must match the positions')
+
+	def __len__(self):
+		return len(self.positions)
+
+	@classmethod
+	def read(cls, path):
+		"""Read a Markups fiducial .fcsv file, LPS coordinates (CoordinateSystem = 1 / LPS) are flipped to RAS"""
+		columns, isLPS, lines = FCSV_COLUMNS, False, []
+		with open(path) as fcsvFile:
+			for line in fcsvFile:
+				if line.startswith('#'):
+					key, separator, value = line[1:].partition('=')
+					if key.strip() == 'CoordinateSystem':
+						isLPS = value.strip().upper() in ('1', 'LPS')
+					elif key.strip() == 'columns':
+						columns = [column.strip() for column in value.split(',')]
+				elif line.strip():
+					lines.append(line)
+		rows = list(csv.reader(lines))
+		if any(len(row) < len(columns) for row in rows):
+			raise IOError('Incomplete fiducial rows in ' + path)
+
+		index = dict((column, position) for position, column in enumerate(columns))
+		positions = np.array([[row[index[axis]] for axis in 'xyz'] for row in rows], dtype=float).reshape(-1, 3)
+		if isLPS:
+			positions[:, :2] *= -1
+		return cls(	positions,
+					[row[index['label']] for row in rows] if 'label' in index else None,
+					[row[index['desc']] for row in rows] if 'desc' in index else None,
+					[row[index['sel']] != '0' for row in rows] if 'sel' in index else None,
+					os.path.splitext(os.path.basename(path))[0] )
+
+	def write(self, path):
+		"""Write a Markups fiducial 4.6 .fcsv file in RAS coordinates"""
+		with open(path, 'w') as fcsvFile:
+			fcsvFile.write('# Markups fiducial file version = 4.6\n# CoordinateSystem = 0\n')
+			fcsvFile.write('# columns = %s\n' % ','.join(FCSV_COLUMNS))
+			writer = csv.writer(fcsvFile, lineterminator='\n')
+			for index in range(len(self)):
+				writer.writerow(['vtkMRMLMarkupsFiducialNode_%d' % index] + [repr(float(value)) for value in self.positions[index]] +
+								[0, 0, 0, 1, 1, int(self.selected[index]), 0, self.labels[index], self.descriptions[index], ''])
+
+	@classmethod
+	def fromNode(cls, fidNode):
+		"""Copy the fiducials of a markups node"""
+		numOfFids = fidNode.GetNumberOfFiducials()
+		positions = np.zeros((numOfFids, 3))
+		fidXYZ = [0,0,0]
+		for index in range(numOfFids):
+			fidNode.GetNthFiducialPosition(index, fidXYZ)
+			positions[index] = fidXYZ
+		return cls(	positions,
+					[fidNode.GetNthFiducialLabel(index) for index in range(numOfFids)],
+					[fidNode.GetNthMarkupDescription(index) for index in range(numOfFids)],
+					[fidNode.GetNthFiducialSelected(index) for index in range(numOfFids)],
+					fidNode.GetName() )
+
+	def createNode(self):
+		"""Add a new markups fiducial node holding the landmarks to the scene"""
+		import slicer
+		fidNode = slicer.vtkMRMLMarkupsFiducialNode()
+		fidNode.SetName(slicer.mrmlScene.GenerateUniqueName(self.name))
+		slicer.mrmlScene.AddNode(fidNode)
+		fidNode.CreateDefaultDisplayNodes()
+		for index in range(len(self)):
+			fidNode.AddFiducialFromArray(self.positions[index], self.labels[index])
+			fidNode.SetNthMarkupDescription(index, self.descriptions[index])
+			fidNode.SetNthFiducialSelected(index, bool(self.selected[index]))
+		return fidNode
+
+
+def fiducialArray(fidNode, selectedOnly=False):
+	"""Return the fiducial positions of a markups node as an N x 3 array"""
+	fidXYZ = [0,0,0]
+	positions = []
+	for index in range(fidNode.GetNumberOfFiducials()):
+		if selectedOnly and not fidNode.GetNthFiducialSelected(index):
+			continue
+		fidNode.GetNthFiducialPosition(index, fidXYZ)
+		positions.append(list(fidXYZ))
+	return np.array(positions, dtype=float).reshape(-1, 3)
+
+def matchLandmarks(template, landmarkNames, placed, placedNames):
+	"""
+	Label-indexed correspondence of placed & template landmarks. template &
+	placed are LandmarkSets, landmarkNames names every template landmark in
+	order & placedNames every placed one (any subset of landmarkNames, in any
+	order). Returns the fixed (template) & moving (placed) N x 3 arrays of the
+	landmarks selected in both sets, neither set is modified.
+	"""
+	if len(landmarkNames) != len(template):
+		raise ValueError('%d template landmarks for %d names' % (len(template), len(landmarkNames)))
+	if len(placedNames) != len(placed):
+		raise ValueError('%d placed landmarks for %d names' % (len(placed), len(placedNames)))
+	if len(set(placedNames)) != len(placedNames):
+		raise ValueError('Landmarks are named more than once: %s' % ', '.join(placedNames))
+	templateIndex = dict((name, index) for index, name in enumerate(landmarkNames))
+	unknown = [name for name in placedNames if name not in templateIndex]
+	if unknown:
+		raise ValueError('Landmarks %s are not in the template' % ', '.join(unknown))
+
+	indices = np.array([templateIndex[name] for name in placedNames], dtype=int)
+	used = template.selected[indices] & placed.selected
+	return template.positions[indices[used]], placed.positions[used]
+
+def setTransformMatrix(transformNode, matrix):
+	"""Set a 4 x 4 array as the to-parent matrix of a linear transform node"""
+	import vtk
+	vtkMatrix = vtk.vtkMatrix4x4()
+	for row in range(4):
+		for column in range(4):
+			vtkMatrix.SetElement(row, column, matrix[row][column])
+	transformNode.SetMatrixTransformToParent(vtkMatrix)
+
+def fitLandmarkTransform(fixedPoints, movingPoints, mask=None, scaling=False):
+	"""
+	Closed-form least squares rigid (or similarity if scaling) transform that maps
+	movingPoints onto fixedPoints, solved with an SVD (Kabsch/Umeyama).
+	Points are N x 3, or B x N x 3 to solve B landmark sets in one call. mask
+	(N or B x N, True for used landmarks) excludes skipped landmarks.
+	Returns a 4 x 4 (or B x 4 x 4) homogeneous matrix.
+	"""
+	fixed = np.asarray(fixedPoints, dtype=float)
+	moving = np.asarray(movingPoints, dtype=float)
+	isSingle = fixed.ndim == 2
+	if isSingle:
+		fixed, moving = fixed[np.newaxis], moving[np.newaxis]
+	if fixed.shape != moving.shape:
+		raise ValueError('Fixed and moving landmarks must have the same shape')
+
+	weights = np.ones(fixed.shape[:2]) if mask is None else np.broadcast_to(np.asarray(mask, dtype=float), fixed.shape[:2])
+	numOfPoints = weights.sum(axis=1)
+	if (numOfPoints < 3).any():
+		raise ValueError('At least 3 landmarks are required for registration')
+
+	#Centre both point sets on their (weighted) centroids
+	fixedMean = np.einsum('bn,bni->bi', weights, fixed) / numOfPoints[:, np.newaxis]
+	movingMean = np.einsum('bn,bni->bi', weights, moving) / numOfPoints[:, np.newaxis]
+	fixedCentred = fixed - fixedMean[:, np.newaxis]
+	movingCentred = moving - movingMean[:, np.newaxis]
+
+	#Rotation from the SVD of the cross-covariance, reflections are flipped out
+	covariance = np.einsum('bn,bni,bnj->bij', weights, fixedCentred, movingCentred)
+	U, S, Vt = np.linalg.svd(covariance)
+	signs = np.ones_like(S)
+	signs[:, 2] = np.sign(np.linalg.det(np.matmul(U, Vt)))
+	rotation = np.matmul(U * signs[:, np.newaxis, :], Vt)
+
+	scale = np.ones(len(fixed))
+	if scaling:
+		scale = (S * signs).sum(axis=1) / np.einsum('bn,bni,bni->b', weights, movingCentred, movingCentred)
+
+	matrix = np.tile(np.eye(4), (len(fixed), 1, 1))
+	matrix[:, :3, :3] = scale[:, np.newaxis, np.newaxis] * rotation
+	matrix[:, :3, 3] = fixedMean - np.einsum('bij,bj->bi', matrix[:, :3, :3], movingMean)
+	return matrix[0] if isSingle else matrix
+
@@ -0,0 +1,148 @@
+"""
+Region of interest reader & writer of 3D scalar NRRD files, numpy only so
+they are safe to use from worker threads
+"""
+import os
+import re
+import gzip
+import numpy as np
+
+NRRD_TYPES = {	'int8': 'i1', 'int8_t': 'i1', 'signed char': 'i1',
+				'uint8': 'u1', 'uint8_t': 'u1', 'uchar': 'u1', 'unsigned char': 'u1',
+				'int16': 'i2', 'int16_t': 'i2', 'short': 'i2', 'short int': 'i2', 'signed short': 'i2', 'signed short int': 'i2',
+				'uint16': 'u2', 'uint16_t': 'u2', 'ushort': 'u2', 'unsigned short': 'u2', 'unsigned short int': 'u2',
+				'int32': 'i4', 'int32_t': 'i4', 'int': 'i4', 'signed int': 'i4',
+				'uint32': 'u4', 'uint32_t': 'u4', 'uint': 'u4', 'unsigned int': 'u4',
+				'float': 'f4', 'double': 'f8' }
+
+def readNRRDHeader(path):
+	"""Return the fields of a NRRD header and the byte offset of the attached data"""
+	header = {}
+	with open(path, 'rb') as nrrdFile:
+		magic = nrrdFile.readline().decode('latin-1')
+		if not magic.startswith('NRRD'):
+			raise ValueError('%s is not a NRRD file' % path)
+		while True:
+			line = nrrdFile.readline().decode('latin-1')
+			if not line.strip():
+				break
+			if line.startswith('#') or ':=' in line:
+				continue
+			key, value = line.split(':', 1)
+			header[key.strip()] = value.strip()
+		header['dataOffset'] = nrrdFile.tell()
+	return header
+
+def nrrdIJKToRAS(header):
+	"""4 x 4 voxel to RAS matrix of a 3D NRRD header"""
+	if 'space directions' not in header or 'space origin' not in header:
+		raise ValueError('NRRD without space directions & origin is not supported')
+	directions = [[float(value) for value in vector.split(',')]
+					for vector in re.findall(r'\(([^)]*)\)', header['space directions'])]
+	origin = [float(value) for value in re.findall(r'\(([^)]*)\)', header['space origin'])[0].split(',')]
+	ijkToRAS = np.eye(4)
+	ijkToRAS[:3, :3] = np.array(directions).T
+	ijkToRAS[:3, 3] = origin
+	if header.get('space', '').lower() in ('left-posterior-superior', 'lps'):
+		ijkToRAS[:2] *= -1
+	elif header.get('space', '').lower() not in ('right-anterior-superior', 'ras'):
+		raise ValueError('NRRD space %s is not supported' % header.get('space'))
+	return ijkToRAS
+
+def readNRRDRegion(path, rasBounds, margin=1):
+	"""
+	Read only the voxels of a raw or gzip 3D NRRD file covering rasBounds
+	[xmin, xmax, ymin, ymax, zmin, zmax] (plus margin voxels). Raw data is
+	memory-mapped, gzip data is decompressed slice by slice and slices outside
+	the region are discarded. Returns the (k, j, i) voxels and their IJKToRAS.
+	"""
+	header = readNRRDHeader(path)
+	sizes = [int(size) for size in header['sizes'].split()]
+	if int(header['dimension']) != 3 or header['type'] not in NRRD_TYPES:
+		raise ValueError('Only 3D scalar NRRD files are supported')
+	dtype = np.dtype(NRRD_TYPES[header['type']]).newbyteorder('>' if header.get('endian') == 'big' else '<')
+	ijkToRAS = nrrdIJKToRAS(header)
+
+	#Voxel index range enclosing the 8 corners of the RAS box
+	corners = np.array([[x, y, z, 1] for x in rasBounds[0:2] for y in rasBounds[2:4] for z in rasBounds[4:6]])
+	cornersIJK = np.linalg.inv(ijkToRAS).dot(corners.T)[:3]
+	start	= np.clip(np.floor(cornersIJK.min(axis=1)).astype(int) - margin, 0, sizes)
+	end		= np.clip(np.ceil(cornersIJK.max(axis=1)).astype(int) + margin + 1, 0, sizes)
+	if (end <= start).any():
+		raise ValueError('Region of interest does not overlap %s' % path)
+	(i0, j0, k0), (i1, j1, k1) = start, end
+
+	dataPath, dataOffset = path, header['dataOffset']
+	if 'data file' in header:
+		dataPath, dataOffset = os.path.join(os.path.dirname(path), header['data file']), 0
+	sliceShape = (sizes[1], sizes[0])
+	encoding = header.get('encoding', 'raw')
+
+	if encoding == 'raw':
+		byteSkip = int(header.get('byte skip', 0))
+		if byteSkip == -1:
+			dataOffset = os.path.getsize(dataPath) - dtype.itemsize * np.prod(sizes)
+		else:
+			dataOffset += byteSkip
+		voxels = np.memmap(dataPath, dtype=dtype, mode='r', offset=dataOffset, shape=(sizes[2],) + sliceShape)
+		region = np.array(voxels[k0:k1, j0:j1, i0:i1])
+		del voxels
+	elif encoding in ('gzip', 'gz'):
+		sliceBytes = dtype.itemsize * sizes[0] * sizes[1]
+		region = np.empty((k1 - k0, j1 - j0, i1 - i0), dtype=dtype)
+		with open(dataPath, 'rb') as nrrdFile:
+			nrrdFile.seek(dataOffset)
+			with gzip.GzipFile(fileobj=nrrdFile) as dataFile:
+				for k in range(k1):
+					sliceData = dataFile.read(sliceBytes)
+					if len(sliceData) != sliceBytes:
+						raise IOError('Unexpected end of data in %s' % path)
+					if k >= k0:
+						region[k - k0] = np.frombuffer(sliceData, dtype=dtype).reshape(sliceShape)[j0:j1, i0:i1]
+	else:
+		raise ValueError('NRRD encoding %s is not supported' % encoding)
+
+	regionIJKToRAS = ijkToRAS.copy()
+	regionIJKToRAS[:3, 3] = ijkToRAS.dot([i0, j0, k0, 1])[:3]
+	return region.astype(dtype.newbyteorder('='), copy=False), regionIJKToRAS
+
+
+#NRRD type of the numpy voxel types written by writeNRRD
+NRRD_TYPE_NAMES = {	'i1': 'int8', 'u1': 'uint8', 'i2': 'short', 'u2': 'ushort',
+					'i4': 'int', 'u4': 'uint', 'f4': 'float', 'f8': 'double' }
+
+def writeNRRD(path, voxels, ijkToRAS, compress=True):
+	"""
+	Write (k, j, i) voxels & their 4 x 4 IJKToRAS matrix as a 3D NRRD file,
+	one slice at a time so non-contiguous views are not copied as a whole.
+	Safe to call from worker threads, no VTK or scene objects are used.
+	"""
+	dtype = voxels.dtype.newbyteorder('<') if voxels.dtype.itemsize > 1 else voxels.dtype
+	if dtype.str[1:] not in NRRD_TYPE_NAMES:
+		raise ValueError('Voxel type %s can not be written as NRRD' % voxels.dtype)
+
+	#Written in LPS, the space Slicer itself writes NRRD files in
+	ijkToLPS = np.array(ijkToRAS, dtype=float)
+	ijkToLPS[:2] *= -1
+	vector = lambda values: '(%s)' % ','.join(repr(float(value)) for value in values)
+	header = [	'NRRD0004',
+				'type: %s' % NRRD_TYPE_NAMES[dtype.str[1:]],
+				'dimension: 3',
+				'space: left-posterior-superior',
+				'sizes: %d %d %d' % tuple(voxels.shape[::-1]),
+				'space directions: %s' % ' '.join(vector(ijkToLPS[:3, axis]) for axis in range(3)),
+				'kinds: domain domain domain',
+				'endian: little',
+				'encoding: %s' % ('gzip' if compress else 'raw'),
+				'space origin: %s' % vector(ijkToLPS[:3, 3]) ]
+
+	with open(path, 'wb') as nrrdFile:
+		nrrdFile.write(('\n'.join(header) + '\n\n').encode('latin-1'))
+		dataFile = gzip.GzipFile(fileobj=nrrdFile, mode='wb', compresslevel=1) if compress else nrrdFile
+		try:
+			for voxelSlice in voxels:
+				dataFile.write(np.ascontiguousarray(voxelSlice, dtype=dtype).tobytes())
+		finally:
+			if compress:
+				dataFile.close()
+
@@ -0,0 +1,134 @@
+"""
+Voxel regions of interest: foreground bounding boxes & ROIs snapped to voxel grids
+"""
+import math
+import logging
+import numpy as np
+import vtk
+from vtk.util.numpy_support import vtk_to_numpy
+
+#Tight (content-aware) ROI mode of Define ROI: the ROI encloses the template voxels at or above threshold
+#(None - Otsu foreground threshold, or e.g. a bone intensity) plus margin (mm) instead of the whole template
+TIGHT_ROI = {'threshold': None, 'margin': 2.0}
+
+def otsuThreshold(voxels, bins=256):
+	"""Intensity separating the foreground from the background of voxels (Otsu), from their histogram"""
+	counts, edges	= np.histogram(voxels, bins)
+	centers			= (edges[:-1] + edges[1:]) / 2.0
+	weightBelow		= np.cumsum(counts).astype(float)
+	weightAbove		= weightBelow[-1] - weightBelow
+	sumBelow		= np.cumsum(counts * centers)
+	meanBelow		= sumBelow / np.maximum(weightBelow, 1)
+	meanAbove		= (sumBelow[-1] - sumBelow) / np.maximum(weightAbove, 1)
+	return edges[np.argmax(weightBelow * weightAbove * (meanBelow - meanAbove) ** 2) + 1]
+
+def maskBoundingBox(mask):
+	"""
+	Voxel index ranges [(i0, i1), (j0, j1), (k0, k1)] enclosing the true voxels of
+	a (k, j, i) mask, None if there are none. The mask is reduced to its (k, j)
+	projection once, the i range is only searched inside the k & j ranges.
+	"""
+	projection	= mask.any(axis=2)
+	kIndices	= np.flatnonzero(projection.any(axis=1))
+	if not len(kIndices):
+		return None
+	jIndices	= np.flatnonzero(projection.any(axis=0))
+	(k0, k1), (j0, j1) = (kIndices[0], kIndices[-1] + 1), (jIndices[0], jIndices[-1] + 1)
+	iIndices	= np.flatnonzero(mask[k0:k1, j0:j1].any(axis=(0, 1)))
+	return [(int(iIndices[0]), int(iIndices[-1]) + 1), (int(j0), int(j1)), (int(k0), int(k1))]
+
+def fitROIToForeground(roi, volume, threshold=None, margin=0):
+	"""
+	Fit roi to the box of the volume voxels at or above threshold (Otsu
+	foreground threshold if None) grown by margin (mm). ROI faces lie on voxel
+	boundaries, so axis aligned volumes are still cropped by index range.
+	"""
+	imageData	= volume.GetImageData()
+	dimensions	= imageData.GetDimensions()
+	voxels		= vtk_to_numpy(imageData.GetPointData().GetScalars()).reshape(dimensions[::-1])
+	if threshold is None:
+		threshold = otsuThreshold(voxels)
+	ranges = maskBoundingBox(voxels >= threshold)
+	if ranges is None:
+		logging.warning('No voxel of %s is at or above %g, the ROI is not fitted' % (volume.GetName(), threshold))
+		return roi
+
+	spacing = volume.GetSpacing()
+	ranges	= [(max(0, start - int(math.ceil(margin / spacing[axis]))), min(dimensions[axis], end + int(math.ceil(margin / spacing[axis]))))
+				for axis, (start, end) in enumerate(ranges)]
+	ijkToRAS = vtk.vtkMatrix4x4()
+	volume.GetIJKToRASMatrix(ijkToRAS)
+	corners = np.array([ijkToRAS.MultiplyPoint([i - 0.5, j - 0.5, k - 0.5, 1])[:3]
+						for i in ranges[0] for j in ranges[1] for k in ranges[2]])
+	lower, upper = corners.min(axis=0), corners.max(axis=0)
+	roi.SetXYZ(((lower + upper) / 2).tolist())
+	roi.SetRadiusXYZ(((upper - lower) / 2).tolist())
+	logging.info('ROI fitted to the foreground of %s (threshold %g), voxel ranges %s' % (volume.GetName(), threshold, ranges))
+	return roi
+
+def voxelCropRange(roi, volume):
+	"""
+	Return the voxel index ranges [(i0, i1), (j0, j1), (k0, k1)] covered by roi
+	when it is snapped to the voxel grid of an axis-aligned volume, None otherwise
+	"""
+	if volume.GetParentTransformNode() is not None or roi.GetParentTransformNode() is not None:
+		return None
+
+	#Volume axes must be aligned with the ROI (RAS) axes, flips & permutations are allowed
+	ijkToRAS = vtk.vtkMatrix4x4()
+	volume.GetIJKToRASMatrix(ijkToRAS)
+	directions = np.array([[ijkToRAS.GetElement(row, column) for column in range(3)] for row in range(3)])
+	if ((np.abs(directions) > 1e-6 * np.abs(directions).max()).sum(axis=0) != 1).any():
+		return None
+
+	#ROI faces must lie on voxel boundaries (half integer voxel coordinates)
+	center, radius = [0,0,0], [0,0,0]
+	roi.GetXYZ(center)
+	roi.GetRadiusXYZ(radius)
+	rasToIJK = vtk.vtkMatrix4x4()
+	volume.GetRASToIJKMatrix(rasToIJK)
+	corners = np.array([rasToIJK.MultiplyPoint([center[axis] + sign * radius[axis] for axis in range(3)] + [1])[:3]
+						for sign in (-1, 1)])
+	edges = np.sort(corners, axis=0) + 0.5
+	if (np.abs(edges - np.round(edges)) > 1e-3).any():
+		return None
+
+	dimensions = volume.GetImageData().GetDimensions()
+	ranges = [(max(0, int(round(edges[0][axis]))), min(dimensions[axis], int(round(edges[1][axis]))))
+			  for axis in range(3)]
+	if any(end <= start for start, end in ranges):
+		return None
+	return ranges
+
+def cropArrayView(roi, volume):
+	"""Zero-copy (k, j, i) numpy view of the voxels inside a voxel aligned roi, None if oblique"""
+	ranges = voxelCropRange(roi, volume)
+	if ranges is None:
+		return None
+	imageData = volume.GetImageData()
+	voxels = vtk_to_numpy(imageData.GetPointData().GetScalars()).reshape(imageData.GetDimensions()[::-1])
+	(i0, i1), (j0, j1), (k0, k1) = ranges
+	return voxels[k0:k1, j0:j1, i0:i1]
+
+def extractVoxelRange(volume, ranges):
+	"""
+	Image data & IJKToRAS matrix of the voxels of volume inside voxel index ranges,
+	no interpolation & only the ROI voxels are copied
+	"""
+	(i0, i1), (j0, j1), (k0, k1) = ranges
+
+	extract = vtk.vtkExtractVOI()
+	extract.SetInputData(volume.GetImageData())
+	extract.SetVOI(i0, i1 - 1, j0, j1 - 1, k0, k1 - 1)
+	extract.Update()
+	imageData = vtk.vtkImageData()
+	imageData.ShallowCopy(extract.GetOutput())
+	imageData.SetExtent(0, i1 - i0 - 1, 0, j1 - j0 - 1, 0, k1 - k0 - 1)
+
+	#Same voxel axes, origin moved to the first voxel of the ROI
+	ijkToRAS = vtk.vtkMatrix4x4()
+	volume.GetIJKToRASMatrix(ijkToRAS)
+	origin = ijkToRAS.MultiplyPoint([i0, j0, k0, 1])
+	for axis in range(3):
+		ijkToRAS.SetElement(axis, 3, origin[axis])
+	return imageData, ijkToRAS
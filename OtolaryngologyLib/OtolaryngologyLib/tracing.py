@@ -0,0 +1,151 @@
+"""
+Stage tracing: nested wall, CPU time & memory spans of the pipeline stages
+"""
+import os
+import sys
+import time
+import json
+import logging
+import contextlib
+import collections
+import slicer
+try:
+	import resource
+except ImportError: #Not available on Windows, peak RSS is not recorded
+	resource = None
+
+
+def volumeSize(volumeNode):
+	"""Dimensions, spacing & image memory (MB) of a volume node, as written in trace records"""
+	imageData = volumeNode.GetImageData() if volumeNode is not None else None
+	if imageData is None:
+		return None
+	return {	'name'			: volumeNode.GetName(),
+				'dimensions'	: list(imageData.GetDimensions()),
+				'spacing'		: list(volumeNode.GetSpacing()),
+				'memoryMB'		: imageData.GetActualMemorySize() / 1024.0 }
+
+def sceneImageData():
+	"""Address -> (memory in bytes, number of voxels) of the image data of every volume node in the scene"""
+	images = {}
+	volumeNodes = slicer.mrmlScene.GetNodesByClass('vtkMRMLVolumeNode')
+	for index in range(volumeNodes.GetNumberOfItems()):
+		imageData = volumeNodes.GetItemAsObject(index).GetImageData()
+		if imageData is not None:
+			images[imageData.GetAddressAsString('vtkImageData')] = (imageData.GetActualMemorySize() * 1024,
+																	imageData.GetNumberOfPoints())
+	return images
+
+def peakRSS(children=False):
+	"""Peak resident set size (MB) of this process or of its largest waited-for child, None if unknown"""
+	if resource is None:
+		return None
+	usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+	return usage.ru_maxrss / (2.0 ** 20 if sys.platform == 'darwin' else 1024.0)
+
+class StageTrace(object):
+	"""
+	Nested wall & CPU time spans of the pipeline stages. Every finished span is
+	appended as one JSON line to tracePath (children before their parent), so
+	traces of many cases & worker processes can share one file. CPU time of
+	waited-for subprocesses, e.g. the BRAINSFit CLI, is reported as childCpuTime.
+
+	With recordMemory set, spans also record the peak RSS of the process & its
+	children, the image data left allocated in the scene by the stage and the
+	number of full volume copies (new image data as large as the biggest input
+	volume of the span, plus volumes handed off to CLI modules).
+	"""
+
+	def __init__(self, module, tracePath=None, recordMemory=False):
+		self.module			= module
+		self.tracePath		= tracePath
+		self.recordMemory	= recordMemory
+		self.caseID			= None
+		self.stack			= []
+		self.finished		= []
+
+	def beginCase(self, caseID=None):
+		self.caseID		= caseID
+		self.finished	= []
+
+	@contextlib.contextmanager
+	def span(self, stage, volumes=(), **fields):
+		"""
+		Time the enclosed block as stage. Yields the span record, volume nodes
+		appended to record['volumes'] & extra keys are written with it.
+		"""
+		record = {	'module'	: self.module,
+					'caseID'	: self.caseID,
+					'stage'		: stage,
+					'parent'	: self.stack[-1]['stage'] if self.stack else None,
+					'depth'		: len(self.stack),
+					'pid'		: os.getpid(),
+					'volumes'	: list(volumes),
+					'status'	: 'failed' }
+		record.update(fields)
+		if self.stack:
+			self.stack[-1]['childSpans'] = self.stack[-1].get('childSpans', 0) + 1
+		if self.recordMemory:
+			record['cliCopies'] = 0
+			startImages		= sceneImageData()
+			startPeakRSS	= peakRSS()
+			fullSize		= max([volume.GetImageData().GetNumberOfPoints() for volume in volumes
+									if volume is not None and volume.GetImageData() is not None] or [None])
+		self.stack.append(record)
+		startTimes, startWall = os.times(), time.time()
+		try:
+			yield record
+			record['status'] = 'completed'
+		finally:
+			endTimes = os.times()
+			self.stack.remove(record) #Spans of background jobs may end out of order
+			record['start']			= startWall
+			record['wallTime']		= time.time() - startWall
+			record['cpuTime']		= endTimes[0] + endTimes[1] - startTimes[0] - startTimes[1]
+			record['childCpuTime']	= endTimes[2] + endTimes[3] - startTimes[2] - startTimes[3]
+			record['volumes']		= [size for size in map(volumeSize, record['volumes']) if size is not None]
+			if self.recordMemory:
+				allocated = [image for address, image in sceneImageData().items() if address not in startImages]
+				record['peakRSSMB']			= peakRSS()
+				record['peakRSSGrowthMB']	= record['peakRSSMB'] - startPeakRSS if startPeakRSS is not None else None
+				record['childPeakRSSMB']	= peakRSS(children=True)
+				record['imageAllocatedMB']	= sum(memory for memory, voxels in allocated) / 2.0 ** 20
+				record['fullCopies']		= record['cliCopies'] + len([voxels for memory, voxels in allocated
+																		if fullSize and voxels >= fullSize])
+				self.finished.append(record)
+			logging.info('%s%s %s in %0.2fs (%0.2fs CPU)' % ('  ' * record['depth'], stage, record['status'],
+															record['wallTime'], record['cpuTime'] + record['childCpuTime']))
+			self.write(record)
+
+	def addCLICopies(self, numberOfCopies):
+		"""Count volumes written out for a CLI module as full copies of the running spans"""
+		for record in self.stack:
+			if 'cliCopies' in record:
+				record['cliCopies'] += numberOfCopies
+
+	def memorySummary(self):
+		"""
+		Peak RSS, allocated image data (MB) & full copies of the case, in total and
+		by stage. Copies are counted in the innermost spans, where the input volume
+		sizes are known.
+		"""
+		stages = collections.OrderedDict()
+		for record in sorted(self.finished, key=lambda record: record['start']):
+			stage = stages.setdefault(record['stage'], {'peakRSSMB': 0, 'imageAllocatedMB': 0, 'fullCopies': 0})
+			stage['peakRSSMB']			= max(stage['peakRSSMB'], record['peakRSSMB'] or 0)
+			stage['imageAllocatedMB']	+= record['imageAllocatedMB']
+			stage['fullCopies']			+= record['fullCopies']
+		return {	'peakRSSMB'			: max([record['peakRSSMB'] or 0 for record in self.finished] or [0]),
+					'childPeakRSSMB'	: peakRSS(children=True),
+					'imageAllocatedMB'	: sum(record['imageAllocatedMB'] for record in self.finished if record['depth'] == 0),
+					'fullCopies'		: sum(record['fullCopies'] for record in self.finished if not record.get('childSpans')),
+					'stages'			: stages }
+
+	def write(self, record):
+		if self.tracePath is None:
+			return
+		try:
+			with open(self.tracePath, 'a') as traceFile:
+				traceFile.write(json.dumps(record) + '\n')
+		except IOError as e:
+			logging.warning('Unable to write stage trace %s: %s' % (self.tracePath, e))